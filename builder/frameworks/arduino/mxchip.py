@@ -182,13 +182,13 @@ if "build.variant" in env.BoardConfig():
     ])
 
     libs.append(
-        env.BuildLibrary(
+        env.BuildFrameworkLibrary(
             join("$BUILD_DIR", "FrameworkArduinoVariant"),
             join(FRAMEWORK_DIR, "variants",
                  env.BoardConfig().get("build.variant"))))
 
 libs.append(
-    env.BuildLibrary(
+    env.BuildFrameworkLibrary(
         join("$BUILD_DIR", "FrameworkArduino"),
         join(FRAMEWORK_DIR, "cores", env.BoardConfig().get("build.core"))))
 
@@ -28,6 +28,8 @@ from os.path import isfile, isdir, join
 from SCons.Script import DefaultEnvironment
 from platformio import util
 
+from stm32tools import corefeatures, ldscripts, libindex, pch
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
@@ -184,27 +186,6 @@ env.Append(
 
 env.ProcessFlags(board.get("build.framework_extra_flags.arduino", ""))
 
-#
-# Linker requires preprocessing with correct RAM|ROM sizes
-#
-
-if not isfile(join(variant_dir, "ldscript.ld")):
-    print("Warning! Cannot find linker script for the current target!\n")
-
-
-linker_script = env.Command(
-    join("$BUILD_DIR", "preproc.ld"),
-    join(variant_dir, "ldscript.ld"),
-    env.VerboseAction(
-        '{} -E -P $_CPPDEFFLAGS $_CPPINCFLAGS {} {} $SOURCE -o $TARGET'.format(
-            env.subst("$GDB").replace("-gdb", "-cpp"),
-            "-DLD_MAX_SIZE=%d" % board.get("upload.maximum_size"),
-            "-DLD_MAX_DATA_SIZE=%d" % board.get("upload.maximum_ram_size")),
-        "Generating LD script $TARGET"))
-
-env.Depends("$BUILD_DIR/$PROGNAME$PROGSUFFIX", linker_script)
-env.Replace(LDSCRIPT_PATH=linker_script)
-
 #
 # Process configuration flags
 #
@@ -216,15 +197,33 @@ process_usb_configuration(cpp_defines)
 process_usb_speed_configuration(cpp_defines)
 process_usart_configuration(cpp_defines)
 
+#
+# Linker requires preprocessing with correct RAM|ROM sizes
+#
+
+if not isfile(join(variant_dir, "ldscript.ld")):
+    print("Warning! Cannot find linker script for the current target!\n")
+
+# only the macros referenced by the script are passed to the preprocessor,
+# configuration flags are processed above
+linker_script = ldscripts.preprocess_ldscript(
+    env, join("$BUILD_DIR", "preproc.ld"), join(variant_dir, "ldscript.ld"),
+    [("LD_MAX_SIZE", board.get("upload.maximum_size")),
+     ("LD_MAX_DATA_SIZE", board.get("upload.maximum_ram_size"))])
+
+env.Depends("$BUILD_DIR/$PROGNAME$PROGSUFFIX", linker_script)
+env.Replace(LDSCRIPT_PATH=linker_script)
+
 # copy CCFLAGS to ASFLAGS (-x assembler-with-cpp mode)
 env.Append(ASFLAGS=env.get("CCFLAGS", [])[:])
 
-env.Append(
-    LIBSOURCE_DIRS=[
+# only the bundled libraries reachable from the project includes
+libindex.configure_libraries(
+    env, [
         join(FRAMEWORK_DIR, "libraries", "__cores__", "arduino"),
         join(FRAMEWORK_DIR, "libraries")
-    ]
-)
+    ], platform.get_package_version("framework-arduinocorestm32"),
+    [variant_dir])
 
 #
 # Target: Build Core Library
@@ -236,13 +235,23 @@ if "build.variant" in env.BoardConfig():
     env.Append(
         CPPPATH=[variant_dir]
     )
-    env.BuildSources(
+    env.BuildFrameworkSources(
         join("$BUILD_DIR", "FrameworkArduinoVariant"),
         variant_dir
     )
 
-env.BuildSources(
+# skip sources and include paths of disabled features (USB, serial)
+core_src_filter = corefeatures.prune_core(
+    env, FRAMEWORK_DIR, join(FRAMEWORK_DIR, "cores", "arduino"),
+    [variant_dir])
+
+env.BuildFrameworkSources(
     join("$BUILD_DIR", "FrameworkArduino"),
-    join(FRAMEWORK_DIR, "cores", "arduino"))
+    join(FRAMEWORK_DIR, "cores", "arduino"),
+    src_filter=core_src_filter)
 
 env.Prepend(LIBS=libs)
+
+# precompiled "Arduino.h" for sources of the project and libraries
+pch.configure(env, join(FRAMEWORK_DIR, "cores", "arduino", "Arduino.h"),
+              ["c++"])
@@ -29,6 +29,8 @@ from SCons.Script import DefaultEnvironment
 #from platformio.project import helpers
 from platformio.project.helpers import get_project_dir
 
+from stm32tools import libindex
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
@@ -259,12 +261,13 @@ process_usart_configuration(cpp_defines)
 # copy CCFLAGS to ASFLAGS (-x assembler-with-cpp mode)
 env.Append(ASFLAGS=env.get("CCFLAGS", [])[:])
 
-env.Append(
-    LIBSOURCE_DIRS=[
+# only the bundled libraries reachable from the project includes
+libindex.configure_libraries(
+    env, [
         join(FRAMEWORK_DIR, "libraries", "__cores__", "arduino"),
         join(FRAMEWORK_DIR, "libraries")
-    ]
-)
+    ], platform.get_package_version("framework-arduinocorestm32"),
+    [variant_dir])
 
 #
 # Target: Build Core Library
@@ -276,12 +279,12 @@ if isdir(variant_dir):
     env.Append(
         CPPPATH=[variant_dir]
     )
-    env.BuildSources(
+    env.BuildFrameworkSources(
         join("$BUILD_DIR", "FrameworkArduinoVariant"),
         variant_dir
     )
 
-env.BuildSources(
+env.BuildFrameworkSources(
     join("$BUILD_DIR", "FrameworkArduino"),
     join(FRAMEWORK_DIR, "cores", "arduino"))
 
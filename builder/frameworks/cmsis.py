@@ -27,12 +27,12 @@ http://www.arm.com/products/processors/cortex-m/cortex-microcontroller-software-
 """
 
 import sys
-from glob import glob
-from string import Template
-from os.path import isdir, isfile, join
+from os.path import isdir, join
 
 from SCons.Script import DefaultEnvironment
 
+from stm32tools import ldscripts, mcuindex
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 
@@ -56,57 +56,55 @@ VARIANT_DIR_EXCEPTIONS = {
 }
 
 
-def get_variant_dir(mcu):
-    if len(mcu) > 12:
-        mcu = mcu[:-2]
+def resolve_variant_dir(mcu):
+    if mcu in VARIANT_DIR_EXCEPTIONS:
+        return VARIANT_DIR_EXCEPTIONS[mcu]
 
-    mcu_family_path = join(FRAMEWORK_DIR, "variants", PLATFORM_NAME, mcu[0:7])
-    mcu_pattern = mcu[0:9] + "[" + mcu[9] + "|x]" + "[" + mcu[10] + "|x]"
-    variant_path = join(mcu_family_path, mcu_pattern)
-    variant_dirs = glob(variant_path)
+    return mcuindex.match_part_number(mcu, mcuindex.listdir(
+        join(FRAMEWORK_DIR, "variants", PLATFORM_NAME, mcu[0:7])))
 
-    if mcu in VARIANT_DIR_EXCEPTIONS:
-        return join(mcu_family_path, VARIANT_DIR_EXCEPTIONS[mcu])
 
-    if not variant_dirs:
+def resolve_linker_script(mcu):
+    ldscript = mcu[0:11].upper() + "_FLASH.ld"
+    if ldscript in mcuindex.listdir(
+            join(FRAMEWORK_DIR, "platformio", "ldscripts", PLATFORM_NAME)):
+        return ldscript
+    return None
+
+
+MCU_INDEX = mcuindex.load_index(
+    env, "framework-cmsis", dict(
+        variant_dir=resolve_variant_dir,
+        ldscript=resolve_linker_script
+    ), framework="cmsis", required=("variant_dir", ))
+
+
+def get_variant_dir(mcu):
+    variant_dir = MCU_INDEX.get(mcu, "variant_dir")
+
+    if not variant_dir:
         sys.stderr.write(
             """Error: There is no variant dir for %s MCU!
             Please add initialization code to your project manually!""" % mcu)
-    return variant_dirs[0]
+        env.Exit(1)
+    return join(FRAMEWORK_DIR, "variants", PLATFORM_NAME, mcu[0:7],
+                variant_dir)
 
 
 def get_linker_script(mcu):
-    ldscript = join(FRAMEWORK_DIR, "platformio", "ldscripts", PLATFORM_NAME,
-                    mcu[0:11].upper() + "_FLASH.ld")
-
-    if isfile(ldscript):
-        return ldscript
+    ldscript = MCU_INDEX.get(mcu, "ldscript")
 
-    default_ldscript = join(FRAMEWORK_DIR, "platformio", "ldscripts",
-                            PLATFORM_NAME, mcu[0:11].upper() + "_DEFAULT.ld")
+    if ldscript:
+        return join(FRAMEWORK_DIR, "platformio", "ldscripts", PLATFORM_NAME,
+                    ldscript)
 
     print("Warning! Cannot find a linker script for the required board! "
           "Firmware will be linked with a default linker script!")
 
-    if isfile(default_ldscript):
-        return default_ldscript
-
-    ram = env.BoardConfig().get("upload.maximum_ram_size", 0)
-    flash = env.BoardConfig().get("upload.maximum_size", 0)
-    template_file = join(FRAMEWORK_DIR, "platformio",
-                         "ldscripts", PLATFORM_NAME, "tpl", "linker.tpl")
-    content = ""
-    with open(template_file) as fp:
-        data = Template(fp.read())
-        content = data.substitute(
-            stack=hex(0x20000000 + ram),  # 0x20000000 - start address for RAM
-            ram=str(int(ram / 1024)) + "K",
-            flash=str(int(flash / 1024)) + "K")
-
-    with open(default_ldscript, "w") as fp:
-        fp.write(content)
-
-    return default_ldscript
+    return ldscripts.generate_default_ldscript(
+        env, join(FRAMEWORK_DIR, "platformio", "ldscripts", PLATFORM_NAME,
+                  "tpl", "linker.tpl"),
+        mcu[0:11].upper() + "_DEFAULT.ld")
 
 env.Append(CPPPATH=[
     join(FRAMEWORK_DIR, "CMSIS", "Core", "Include"),
@@ -126,13 +124,13 @@ env.Replace(
 
 libs = []
 
-libs.append(env.BuildLibrary(
+libs.append(env.BuildFrameworkLibrary(
     join("$BUILD_DIR", "FrameworkCMSISVariant"),
     get_variant_dir(env.BoardConfig().get("build.mcu"))
 ))
 
 libs.append(
-    env.BuildLibrary(
+    env.BuildFrameworkLibrary(
         join("$BUILD_DIR", "FrameworkCMSISCommon"),
         join(FRAMEWORK_DIR, "variants", PLATFORM_NAME,
              env.BoardConfig().get("build.mcu")[0:7], "common"))
@@ -23,11 +23,12 @@ directly with the registers.
 http://www.st.com/web/en/catalog/tools/FM147/CL1794/SC961/SS1743?sc=stm32embeddedsoftware
 """
 
-from os.path import isdir, isfile, join
-from string import Template
+from os.path import isdir, join
 
 from SCons.Script import DefaultEnvironment
 
+from stm32tools import ldscripts, mcuindex
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 
@@ -37,39 +38,32 @@ FRAMEWORK_DIR = platform.get_package_dir("framework-spl")
 assert isdir(FRAMEWORK_DIR)
 
 
-def get_linker_script(mcu):
-    ldscript = join(FRAMEWORK_DIR, "platformio",
-                    "ldscripts", mcu[0:11].upper() + "_FLASH.ld")
-
-    if isfile(ldscript):
+def resolve_linker_script(mcu):
+    ldscript = mcu[0:11].upper() + "_FLASH.ld"
+    if ldscript in mcuindex.listdir(
+            join(FRAMEWORK_DIR, "platformio", "ldscripts")):
         return ldscript
+    return None
 
-    default_ldscript = join(FRAMEWORK_DIR, "platformio",
-                            "ldscripts", mcu[0:11].upper() + "_DEFAULT.ld")
 
-    print("Warning! Cannot find a linker script for the required board! "
-          "Firmware will be linked with a default linker script!")
+MCU_INDEX = mcuindex.load_index(
+    env, "framework-spl", dict(ldscript=resolve_linker_script),
+    framework="spl")
 
-    if isfile(default_ldscript):
-        return default_ldscript
 
-    ram = env.BoardConfig().get("upload.maximum_ram_size", 0)
-    flash = env.BoardConfig().get("upload.maximum_size", 0)
-    template_file = join(FRAMEWORK_DIR, "platformio",
-                         "ldscripts", "tpl", "linker.tpl")
-    content = ""
-    with open(template_file) as fp:
-        data = Template(fp.read())
-        content = data.substitute(
-            stack=hex(0x20000000 + ram), # 0x20000000 - start address for RAM
-            ram=str(int(ram/1024)) + "K",
-            flash=str(int(flash/1024)) + "K"
-        )
+def get_linker_script(mcu):
+    ldscript = MCU_INDEX.get(mcu, "ldscript")
+
+    if ldscript:
+        return join(FRAMEWORK_DIR, "platformio", "ldscripts", ldscript)
 
-    with open(default_ldscript, "w") as fp:
-        fp.write(content)
+    print("Warning! Cannot find a linker script for the required board! "
+          "Firmware will be linked with a default linker script!")
 
-    return default_ldscript
+    return ldscripts.generate_default_ldscript(
+        env, join(FRAMEWORK_DIR, "platformio", "ldscripts", "tpl",
+                  "linker.tpl"),
+        mcu[0:11].upper() + "_DEFAULT.ld")
 
 env.Append(
     CPPPATH=[
@@ -111,7 +105,7 @@ elif "STM32L1XX_MD" in extra_flags:
 
 libs = []
 
-libs.append(env.BuildLibrary(
+libs.append(env.BuildFrameworkLibrary(
     join("$BUILD_DIR", "FrameworkCMSISVariant"),
     join(
         FRAMEWORK_DIR, env.BoardConfig().get("build.core"), "cmsis",
@@ -119,7 +113,7 @@ libs.append(env.BuildLibrary(
     )
 ))
 
-libs.append(env.BuildLibrary(
+libs.append(env.BuildFrameworkLibrary(
     join("$BUILD_DIR", "FrameworkSPL"),
     join(FRAMEWORK_DIR, env.BoardConfig().get("build.core"),
          "spl", "variants",
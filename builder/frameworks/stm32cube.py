@@ -22,11 +22,7 @@ The Low-Layer (LL) APIs, a light-weight, optimized, expert oriented set of APIs
 http://www.st.com/en/embedded-software/stm32cube-embedded-software.html?querycriteria=productId=LN1897
 """
 
-from glob import glob
-from os import listdir
-from os.path import basename, isdir, isfile, join
-from shutil import copy
-from string import Template
+from os.path import dirname, isdir, isfile, join
 import sys
 
 from SCons.Script import DefaultEnvironment
@@ -34,6 +30,9 @@ from SCons.Script import DefaultEnvironment
 from platformio import util
 from platformio.builder.tools.piolib import PlatformIOLibBuilder
 
+from stm32tools import bspindex, halconf, ldscripts, mcuindex, pch
+from stm32tools.helpers import get_build_option
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 
@@ -75,83 +74,88 @@ class CustomLibBuilder(PlatformIOLibBuilder):
         return self.path
 
 
-def get_startup_file(mcu):
-    if len(mcu) > 12:
-        mcu = mcu[:-2]
+def resolve_startup_file(mcu):
+    if mcu in STARTUP_FILE_EXCEPTIONS:
+        return STARTUP_FILE_EXCEPTIONS[mcu]
 
-    search_path = join(
-        FRAMEWORK_DIR, FRAMEWORK_CORE, "Drivers", "CMSIS", "Device",
+    return mcuindex.match_part_number(mcu, mcuindex.listdir(join(
+        FRAMEWORK_DIR, mcu[5:7], "Drivers", "CMSIS", "Device",
         "ST", mcu[0:7].upper() + "xx", "Source", "Templates", "gcc"
-    )
+    )), "startup_", (".s", ".S"))
 
-    search_path = join(
-        search_path,
-        "startup_" + mcu[0:9] + "[" + mcu[9] + "|x]" +
-        "[" + mcu[10] + "|x]" + ".[sS]"
-    )
 
-    if mcu in STARTUP_FILE_EXCEPTIONS:
-        return STARTUP_FILE_EXCEPTIONS[mcu]
+def resolve_linker_script(mcu):
+    ldscript = mcu[0:11].upper() + "_FLASH.ld"
+    if ldscript in mcuindex.listdir(
+            join(FRAMEWORK_DIR, "platformio", "ldscripts")):
+        return ldscript
+    return None
+
+
+MCU_INDEX = mcuindex.load_index(
+    env, "framework-stm32cube", dict(
+        startup_file=resolve_startup_file,
+        ldscript=resolve_linker_script
+    ), framework="stm32cube", required=("startup_file", ))
 
-    startup_file = glob(search_path)
+
+def get_startup_file(mcu):
+    startup_file = MCU_INDEX.get(mcu, "startup_file")
 
     if not startup_file:
         sys.stderr.write(
             """Error: There is no default startup file for %s MCU!
             Please add initialization code to your project manually!""" % mcu)
         env.Exit(1)
-    return basename(startup_file[0])
+    return startup_file
 
 
 def get_linker_script(mcu):
-    ldscript = join(FRAMEWORK_DIR, "platformio",
-                    "ldscripts", mcu[0:11].upper() + "_FLASH.ld")
-
-    if isfile(ldscript):
-        return ldscript
+    ldscript = MCU_INDEX.get(mcu, "ldscript")
 
-    default_ldscript = join(FRAMEWORK_DIR, "platformio",
-                            "ldscripts", mcu[0:11].upper() + "_DEFAULT.ld")
+    if ldscript:
+        return join(FRAMEWORK_DIR, "platformio", "ldscripts", ldscript)
 
     print("Warning! Cannot find a linker script for the required board! "
           "Firmware will be linked with a default linker script!")
 
-    if isfile(default_ldscript):
-        return default_ldscript
-
-    ram = env.BoardConfig().get("upload.maximum_ram_size", 0)
-    flash = env.BoardConfig().get("upload.maximum_size", 0)
-    template_file = join(FRAMEWORK_DIR, "platformio",
-                         "ldscripts", "tpl", "linker.tpl")
-    content = ""
-    with open(template_file) as fp:
-        data = Template(fp.read())
-        content = data.substitute(
-            stack=hex(0x20000000 + ram),  # 0x20000000 - start address for RAM
-            ram=str(int(ram/1024)) + "K",
-            flash=str(int(flash/1024)) + "K"
-        )
-
-    with open(default_ldscript, "w") as fp:
-        fp.write(content)
-
-    return default_ldscript
+    return ldscripts.generate_default_ldscript(
+        env, join(FRAMEWORK_DIR, "platformio", "ldscripts", "tpl",
+                  "linker.tpl"),
+        mcu[0:11].upper() + "_DEFAULT.ld")
 
 
 def generate_hal_config_file(mcu):
     config_path = join(FRAMEWORK_DIR, FRAMEWORK_CORE, "Drivers",
                        MCU_FAMILY.upper() + "xx_HAL_Driver", "Inc")
+    template_path = join(config_path, MCU_FAMILY + "xx_hal_conf_template.h")
 
-    if isfile(join(config_path, MCU_FAMILY + "xx_hal_conf.h")):
-        return
-
-    if not isfile(join(config_path, MCU_FAMILY + "xx_hal_conf_template.h")):
+    if not isfile(template_path):
         sys.stderr.write(
             "Error: Cannot find template file to configure framework!\n")
         env.Exit(1)
 
-    copy(join(config_path, MCU_FAMILY + "xx_hal_conf_template.h"),
-         join(config_path, MCU_FAMILY + "xx_hal_conf.h"))
+    # the effective configuration is per build, the framework package
+    # is shared between projects and must stay untouched
+    return halconf.generate_config(
+        env, MCU_FAMILY, template_path,
+        env.subst(join("$BUILD_DIR", "FrameworkHALConfig")))
+
+
+def get_hal_driver_src_filter(config_path):
+    src_filter = "+<*> -<Src/*_template.c> -<Src/Legacy>"
+    if get_build_option(env, "stm32cube.hal_modules", "all") != "enabled":
+        return src_filter
+
+    modules = halconf.parse_enabled_modules(config_path)
+    if not modules:
+        print("Warning! No enabled HAL modules found in %s, "
+              "the whole HAL driver will be built" % config_path)
+        return src_filter
+
+    return halconf.get_src_filter(
+        MCU_FAMILY, modules, "USE_FULL_LL_DRIVER" in env.Flatten(
+            env.get("CPPDEFINES", [])))
 
 
 env.Replace(
@@ -236,15 +240,21 @@ variant = variants_remap[
 # Generate framework specific files
 #
 
-generate_hal_config_file(env.BoardConfig().get("build.mcu"))
+hal_config_file = generate_hal_config_file(env.BoardConfig().get("build.mcu"))
+env.Prepend(CPPPATH=[dirname(hal_config_file)])
 
 #
 # Process BSP components
 #
 
+bsp_dir = join(FRAMEWORK_DIR, FRAMEWORK_CORE, "Drivers", "BSP", variant)
 components_dir = join(
     FRAMEWORK_DIR, FRAMEWORK_CORE, "Drivers", "BSP", "Components")
-for component in listdir(components_dir):
+# only components reachable from the project and the board BSP
+for component in bspindex.get_project_components(
+        env, components_dir,
+        util.load_json(join(FRAMEWORK_DIR, "package.json")).get("version"),
+        [bsp_dir]):
     env.Append(EXTRA_LIB_BUILDERS=[
         CustomLibBuilder(
             env, join(components_dir, component),
@@ -259,19 +269,19 @@ for component in listdir(components_dir):
 
 libs = []
 
-bsp_dir = join(FRAMEWORK_DIR, FRAMEWORK_CORE, "Drivers", "BSP", variant)
 if isdir(bsp_dir):
-    libs.append(env.BuildLibrary(join("$BUILD_DIR", "FrameworkBSP"), bsp_dir))
     env.Append(CPPPATH=[bsp_dir])
+    libs.append(env.BuildFrameworkLibrary(
+        join("$BUILD_DIR", "FrameworkBSP"), bsp_dir))
 
-libs.append(env.BuildLibrary(
+libs.append(env.BuildFrameworkLibrary(
     join("$BUILD_DIR", "FrameworkHALDriver"),
     join(FRAMEWORK_DIR, FRAMEWORK_CORE, "Drivers",
          MCU_FAMILY.upper() + "xx_HAL_Driver"),
-    src_filter="+<*> -<Src/*_template.c> -<Src/Legacy>"
+    src_filter=get_hal_driver_src_filter(hal_config_file)
 ))
 
-libs.append(env.BuildLibrary(
+libs.append(env.BuildFrameworkLibrary(
     join("$BUILD_DIR", "FrameworkCMSISDevice"),
     join(FRAMEWORK_DIR, FRAMEWORK_CORE, "Drivers", "CMSIS", "Device", "ST",
          MCU_FAMILY.upper() + "xx", "Source", "Templates"),
@@ -281,3 +291,9 @@ libs.append(env.BuildLibrary(
 
 
 env.Append(LIBS=libs)
+
+# precompiled HAL header for sources of the project and libraries
+pch.configure(
+    env, join(FRAMEWORK_DIR, FRAMEWORK_CORE, "Drivers",
+              MCU_FAMILY.upper() + "xx_HAL_Driver", "Inc",
+              MCU_FAMILY.lower() + "xx_hal.h"), ["c", "c++"])
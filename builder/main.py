@@ -12,10 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import socket
 import sys
 from platform import system
 from os import makedirs
 from os.path import basename, isdir, join
+from shutil import copyfile
 
 from SCons.Script import (COMMAND_LINE_TARGETS, AlwaysBuild, Builder, Default,
                           DefaultEnvironment)
@@ -24,6 +27,25 @@ from SCons.Script import (COMMAND_LINE_TARGETS, AlwaysBuild, Builder, Default,
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 
+# make shared helpers available to the framework scripts
+sys.path.insert(0, join(platform.get_dir(), "builder"))
+
+from stm32tools import (actioncache, buildtrace, delta, elf, identical, image,
+                        jobserver, libcache, multiflash, objdedup, ocdsession,
+                        openocd, regsnap, stm32boot)
+from stm32tools.helpers import get_cache_dir
+
+buildtrace.install(env)
+elf.generate(env)
+libcache.generate(env)
+if actioncache.is_enabled(env):
+    # also keyed by the preprocessed source, covers object deduplication
+    actioncache.generate(env)
+else:
+    objdedup.generate(env)
+# job slots shared with concurrent builds of the matrix runner
+jobserver.generate(env)
+
 env.Replace(
     AR="arm-none-eabi-ar",
     AS="arm-none-eabi-as",
@@ -38,8 +60,6 @@ env.Replace(
 
     SIZEPROGREGEXP=r"^(?:\.text|\.data|\.rodata|\.text.align|\.ARM.exidx)\s+(\d+).*",
     SIZEDATAREGEXP=r"^(?:\.data|\.bss|\.noinit)\s+(\d+).*",
-    SIZECHECKCMD="$SIZETOOL -A -d $SOURCES",
-    SIZEPRINTCMD='$SIZETOOL -B -d $SOURCES',
 
     PROGSUFFIX=".elf"
 )
@@ -51,25 +71,11 @@ if env.get("PROGNAME", "program") == "program":
 env.Append(
     BUILDERS=dict(
         ElfToBin=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "binary",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.VerboseAction(image.ElfToImages, "Building $TARGET"),
             suffix=".bin"
         ),
         ElfToHex=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "ihex",
-                "-R",
-                ".eeprom",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.VerboseAction(image.ElfToHexImage, "Building $TARGET"),
             suffix=".hex"
         )
     )
@@ -87,8 +93,13 @@ if "nobuild" in COMMAND_LINE_TARGETS:
     target_elf = join("$BUILD_DIR", "${PROGNAME}.elf")
     target_firm = join("$BUILD_DIR", "${PROGNAME}.bin")
 else:
-    target_elf = env.BuildProgram()
+    # dependency finder and framework scripts
+    with buildtrace.span("BuildProgram"):
+        target_elf = env.BuildProgram()
     target_firm = env.ElfToBin(join("$BUILD_DIR", "${PROGNAME}"), target_elf)
+    # ".bin" stays the only target, uploaders get a single source
+    env.SideEffect(image.get_side_images(target_firm[0].get_abspath()),
+                   target_firm)
 
 AlwaysBuild(env.Alias("nobuild", target_firm))
 target_buildprog = env.Alias("buildprog", target_firm, target_firm)
@@ -99,7 +110,7 @@ target_buildprog = env.Alias("buildprog", target_firm, target_firm)
 
 target_size = env.Alias(
     "size", target_elf,
-    env.VerboseAction("$SIZEPRINTCMD", "Calculating size $SOURCE"))
+    env.VerboseAction(elf.PrintSize, "Calculating size $SOURCE"))
 AlwaysBuild(target_size)
 
 #
@@ -112,9 +123,17 @@ upload_source = target_firm
 upload_actions = []
 
 if upload_protocol == "mbed":
+
+    def _upload_to_disk(target, source, env):
+        # only the main image, the ".hex" is built next to it as well
+        copyfile(source[0].get_abspath(), join(
+            env.subst("$UPLOAD_PORT"), basename(source[0].get_abspath())))
+        print("Firmware has been successfully uploaded.\n"
+              "(Some boards may require manual hard reset)")
+
     upload_actions = [
         env.VerboseAction(env.AutodetectUploadPort, "Looking for upload disk..."),
-        env.VerboseAction(env.UploadToDisk, "Uploading $SOURCE")
+        env.VerboseAction(_upload_to_disk, "Uploading $SOURCE")
     ]
 
 elif upload_protocol.startswith("blackmagic"):
@@ -188,18 +207,23 @@ elif upload_protocol in ("serial", "dfu"):
         __configure_upload_port=__configure_upload_port,
         UPLOADER=_upload_tool,
         UPLOADERFLAGS=["${__configure_upload_port(__env__)}"] + _upload_flags,
-        UPLOADCMD='$UPLOADER $UPLOADERFLAGS "$PROJECT_DIR/$SOURCES"'
+        UPLOADCMD='$UPLOADER $UPLOADERFLAGS "$PROJECT_DIR/$SOURCE"'
     )
     upload_actions = [
         env.VerboseAction(env.AutodetectUploadPort, "Looking for upload port..."),
         env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
     ]
+    if upload_protocol == "serial" and stm32boot.is_enabled(env):
+        upload_actions[-1] = env.VerboseAction(
+            stm32boot.SerialUpload, "Uploading $SOURCE")
 
 elif upload_protocol in debug_tools:
+    openocd_dir = platform.get_package_dir("tool-openocd") or ""
+    openocd_server = debug_tools.get(upload_protocol).get("server")
+    openocd_args = ["-s", openocd_dir] + openocd_server.get("arguments", [])
     env.Replace(
         UPLOADER="openocd",
-        UPLOADERFLAGS=["-s", platform.get_package_dir("tool-openocd") or ""] +
-        debug_tools.get(upload_protocol).get("server").get("arguments", []) + [
+        UPLOADERFLAGS=openocd_args + [
             "-c",
             "program {$SOURCE} verify reset %s; shutdown;" %
             env.BoardConfig().get("upload.offset_address", "")
@@ -210,6 +234,46 @@ elif upload_protocol in debug_tools:
         upload_source = target_elf
     upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
 
+    def _connect_session(env):
+        return ocdsession.connect(
+            env, delta.get_probe_id(env, upload_protocol),
+            join(openocd_dir, openocd_server.get("executable", "bin/openocd")),
+            openocd_args)
+
+    def _execute_in_session(env, commands, message):
+        print(message)
+        try:
+            with _connect_session(env) as client:
+                ocdsession.run_commands(client, commands)
+        except (openocd.OpenOCDError, socket.error) as e:
+            sys.stderr.write("Error: %s\n" % e)
+            return 1
+        return None
+
+    if ocdsession.is_enabled(env):
+
+        def _session_upload(target, source, env):
+            return _execute_in_session(env, [
+                "program {%s} verify reset %s" % (
+                    source[0].get_abspath().replace("\\", "/"),
+                    env.BoardConfig().get("upload.offset_address", ""))
+            ], "Programming through OpenOCD session")
+
+        upload_actions = [
+            env.VerboseAction(_session_upload, "Uploading $SOURCE")]
+
+    if delta.is_enabled(env):
+
+        def _delta_upload(target, source, env):
+            return delta.upload(
+                env, source[0].get_abspath(), upload_protocol, openocd_args,
+                _execute_in_session if ocdsession.is_enabled(env) else None)
+
+        # the image and its load address from the segment manifest
+        upload_source = target_firm
+        upload_actions = [
+            env.VerboseAction(_delta_upload, "Uploading $SOURCE")]
+
 # custom upload tool
 elif upload_protocol == "custom":
     upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
@@ -217,8 +281,163 @@ elif upload_protocol == "custom":
 else:
     sys.stderr.write("Warning! Unknown upload protocol %s\n" % upload_protocol)
 
+#
+# Skip upload when the target already has the same firmware
+#
+
+if identical.is_enabled(env) and upload_actions and (
+        upload_protocol.startswith("blackmagic") or
+        upload_protocol in debug_tools):
+
+    def _image_matches(target, source, env):
+        if upload_protocol.startswith("blackmagic"):
+            return identical.blackmagic_image_matches(env, [
+                "target extended-remote %s" % env.subst("$UPLOAD_PORT"),
+                "monitor %s_scan" % (
+                    "jtag" if upload_protocol == "blackmagic-jtag" else
+                    "swdp"),
+                "attach 1"
+            ], source[0].get_abspath())
+        # the delta upload checks the ".bin" at its load address
+        offset = identical.get_image_offset(env, source[0].get_abspath())
+        if ocdsession.is_enabled(env):
+            try:
+                with _connect_session(env) as client:
+                    return ocdsession.image_matches(
+                        client, source[0].get_abspath(), offset)
+            except (openocd.OpenOCDError, socket.error) as e:
+                print("Warning! Cannot check firmware in OpenOCD session: "
+                      "%s" % e)
+                return False
+        return identical.openocd_image_matches(
+            env, openocd_args, source[0].get_abspath(), offset)
+
+    upload_actions = upload_actions[:-1] + [identical.wrap_upload_action(
+        env, upload_actions[-1], _image_matches)]
+
+#
+# Flash several targets at once (board_upload.targets)
+#
+
+upload_targets = multiflash.get_targets(env)
+if upload_targets and upload_actions:
+
+    def _get_target_command(env, target, image_node):
+        if upload_protocol == "mbed":
+            def _copy_to_disk(disk):
+                copyfile(image_node.get_abspath(),
+                         join(disk, basename(image_node.get_abspath())))
+            return _copy_to_disk
+        if upload_protocol == "serial" and stm32boot.is_enabled(env):
+            def _upload_to_port(port):
+                return stm32boot.SerialUpload(
+                    None, [image_node], env.Override({"UPLOAD_PORT": port}))
+            return _upload_to_port
+        if upload_protocol in debug_tools and not upload_protocol.startswith(
+                "blackmagic"):
+            target_env = env.Override({"UPLOADERFLAGS": openocd_args + [
+                "-c", multiflash.get_openocd_serial_command(
+                    upload_protocol, target),
+                "-c", "program {$SOURCE} verify reset %s; shutdown;" %
+                env.BoardConfig().get("upload.offset_address", "")
+            ]})
+        else:
+            target_env = env.Override({"UPLOAD_PORT": target})
+        return [str(arg) for arg in target_env.subst_list(
+            "$UPLOADCMD", source=[image_node])[0]]
+
+    def _upload_targets(target, source, env):
+        image_node = env.File(multiflash.stage_image(
+            source[0].get_abspath(),
+            env.subst(join("$BUILD_DIR", "multiflash"))))
+        report = multiflash.run(
+            [(t, _get_target_command(env, t, image_node))
+             for t in upload_targets],
+            multiflash.get_jobs(env, upload_targets),
+            image_node.get_abspath(),
+            env.subst(join("$BUILD_DIR", "multiflash", "logs")),
+            env.subst(join("$BUILD_DIR", "multiflash-report.json")),
+            env['ENV'])
+        multiflash.print_report(report)
+        return 1 if report['failed'] else None
+
+    upload_actions = [env.VerboseAction(
+        _upload_targets,
+        "Uploading $SOURCE to %d target(s)" % len(upload_targets))]
+    if upload_protocol in debug_tools and not env.BoardConfig().get(
+            "upload").get("offset_address"):
+        # delta flashing switches to ".bin", every target gets the ELF
+        upload_source = target_elf
+
+# uploaders of ".bin" program only the main image
+if upload_actions and upload_source is target_firm and (
+        upload_protocol != "custom"):
+    upload_actions = [env.VerboseAction(
+        image.CheckSplitImages, "Checking images of $SOURCE")] + upload_actions
+
 AlwaysBuild(env.Alias("upload", upload_source, upload_actions))
 
+#
+# Target: Stop the background OpenOCD session of the probe
+#
+
+
+def _stop_openocd_session(target, source, env):
+    probe_id = delta.get_probe_id(env, upload_protocol)
+    ocdsession.stop_session(ocdsession.get_state_path(env, probe_id))
+
+
+AlwaysBuild(env.Alias("stopsession", None, env.VerboseAction(
+    _stop_openocd_session, "Stopping OpenOCD session")))
+
+#
+# Target: Snapshot of peripheral registers (debug.svd_path)
+#
+
+
+def _take_register_snapshot(target, source, env):
+    board = env.BoardConfig()
+    if not board.get("debug.svd_path", ""):
+        sys.stderr.write(
+            "Error: Missed SVD file for %s board\n" % env.subst("$BOARD"))
+        env.Exit(1)
+
+    process = None
+    if not openocd.is_server_running():
+        _, server = openocd.find_server_config(debug_tools, upload_protocol)
+        if not server:
+            sys.stderr.write("Error: Missed OpenOCD debug tool for %s board\n"
+                             % env.subst("$BOARD"))
+            env.Exit(1)
+        openocd_dir = platform.get_package_dir("tool-openocd") or ""
+        process = openocd.start_server(
+            join(openocd_dir, server.get("executable", "bin/openocd")),
+            ["-s", openocd_dir] + server.get("arguments", []))
+
+    snapshot_path = env.subst(join("$BUILD_DIR", "regsnapshot.json"))
+    try:
+        with openocd.TclClient() as client:
+            changes = regsnap.save_snapshot(
+                client,
+                join(platform.get_dir(), "misc", "svd",
+                     board.get("debug.svd_path")),
+                board.get("debug.snapshot_peripherals", "*").split(","),
+                snapshot_path, store_dir=get_cache_dir(env, "svd"))
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    print("Register snapshot: %s" % snapshot_path)
+    if changes:
+        print(json.dumps(changes, indent=2, sort_keys=True))
+    elif changes is not None:
+        print("No changes since the previous snapshot")
+
+
+AlwaysBuild(env.Alias("regsnapshot", None, env.VerboseAction(
+    _take_register_snapshot, "Taking snapshot of peripheral registers")))
+
 #
 # Default targets
 #
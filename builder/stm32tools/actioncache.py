@@ -0,0 +1,530 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Action cache
+
+Caches results of compile and link commands in a local directory and,
+optionally, on an HTTP server shared by developer machines and CI. The
+key is made from the compiler binary, the command line and the content
+of inputs (the preprocessed translation unit for compilation, objects,
+archives and linker scripts for linking). Project, build, package and
+home directories are replaced by placeholders in the command line,
+the preprocessed source and dependency files, so checkouts at other
+locations hit the same entries. Debug information of a restored object
+keeps the paths of the machine which compiled it.
+
+The local directory is shared by concurrent builds and trimmed to
+"board_build.action_cache_size" megabytes (2048 by default), least
+recently used entries go first. Its size is recorded in "size.json", a
+build which stored entries walks the directory only when the record
+exceeds the limit or is older than a day. The HTTP server is asked for
+missed entries with "GET <url>/<key>" and receives new ones with "PUT".
+
+Enable it with "board_build.action_cache = yes" in "platformio.ini" (or
+PLATFORMIO_STM32_ACTION_CACHE=yes), "board_build.action_cache_dir" and
+"board_build.action_cache_url" set the directory and the server,
+"board_build.action_cache_upload = no" makes the server read-only.
+
+Usage:
+    python -m stm32tools.actioncache serve DIRECTORY [PORT]
+"""
+
+import atexit
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import zipfile
+from os.path import (basename, dirname, expanduser, getsize, isfile, join,
+                     splitext)
+
+from stm32tools.helpers import (FILE_MODE, atomic_write,
+                                calculate_file_hash, calculate_hash,
+                                ensure_dir, get_build_flag, get_build_option,
+                                get_cache_dir)
+from stm32tools.objdedup import (COMPILER_SUFFIXES, PREPROCESSOR_OPTIONS,
+                                 get_compiler_id, get_preprocess_command,
+                                 split_args)
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import HTTPError, Request, URLError, urlopen
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# bump when the key or the payload changes
+CACHE_FORMAT = 1
+DEFAULT_SIZE = 2048
+HTTP_TIMEOUT = 10
+KEY_RE = re.compile(r"^[0-9a-f]{40}$")
+SIZE_RECORD = "size.json"
+# the recorded size drifts with concurrent builds, it's counted again
+# after this time (seconds)
+RECOUNT_INTERVAL = 24 * 3600
+
+_stats = dict(hits=0, remote_hits=0, misses=0)
+
+
+def is_enabled(env):
+    return get_build_flag(env, "action_cache")
+
+
+class DirectoryBackend(object):
+
+    def __init__(self, path, max_size=DEFAULT_SIZE * 1024 * 1024):
+        self.path = ensure_dir(path)
+        self.max_size = max_size
+        # bytes stored by this build
+        self.written = 0
+
+    def _get_path(self, key):
+        return join(self.path, key[:2], key)
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as fp:
+                data = fp.read()
+            # the modification time orders entries for eviction
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, key, data):
+        atomic_write(self._get_path(key), data)
+        self.written += len(data)
+
+    def _load_record(self):
+        try:
+            with open(join(self.path, SIZE_RECORD)) as fp:
+                record = json.load(fp)
+            return int(record['size']), float(record['counted'])
+        except (IOError, OSError, KeyError, TypeError, ValueError):
+            return None
+
+    def _save_record(self, size, counted):
+        atomic_write(join(self.path, SIZE_RECORD),
+                     json.dumps(dict(size=size, counted=counted)))
+
+    def evict(self):
+        # nothing to do for a build which didn't store entries
+        if not self.written:
+            return 0
+        written, self.written = self.written, 0
+        record = self._load_record()
+        if record and time.time() - record[1] < RECOUNT_INTERVAL and (
+                record[0] + written <= self.max_size):
+            self._save_record(record[0] + written, record[1])
+            return 0
+
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if root == self.path and name == SIZE_RECORD:
+                    continue
+                path = join(root, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, getsize(path),
+                                    path))
+                except OSError:
+                    pass
+        total = sum(e[1] for e in entries)
+        removed = 0
+        if total > self.max_size:
+            # down to 90% so the next builds don't evict again right away
+            for _, size, path in sorted(entries):
+                if total <= self.max_size * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+        self._save_record(total, time.time())
+        return removed
+
+
+class HTTPBackend(object):
+
+    def __init__(self, url, upload=True, timeout=HTTP_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.upload = upload
+        self.timeout = timeout
+        self.available = True
+
+    def _disable(self, error):
+        # one unreachable server must not slow down every action
+        if self.available:
+            print("Warning! Action cache server %s is not available: %s" %
+                  (self.url, error))
+        self.available = False
+
+    def get(self, key):
+        if not self.available:
+            return None
+        try:
+            response = urlopen("%s/%s" % (self.url, key),
+                               timeout=self.timeout)
+            try:
+                return response.read()
+            finally:
+                response.close()
+        except HTTPError as e:
+            if e.code != 404:
+                self._disable(e)
+        except (URLError, IOError, OSError) as e:
+            self._disable(e)
+        return None
+
+    def put(self, key, data):
+        if not self.available or not self.upload:
+            return
+        request = Request("%s/%s" % (self.url, key), data=data)
+        request.add_header("Content-Type", "application/octet-stream")
+        request.get_method = lambda: "PUT"
+        try:
+            urlopen(request, timeout=self.timeout).close()
+        except (URLError, IOError, OSError) as e:
+            self._disable(e)
+
+
+class PathNormalizer(object):
+
+    # "prefixes" is a list of (placeholder, path), the longest paths are
+    # replaced first
+    def __init__(self, prefixes):
+        # an empty path ("/" as the home directory) would match anywhere
+        prefixes = [(name, (path or "").rstrip("/\\"))
+                    for name, path in prefixes]
+        self.prefixes = sorted([p for p in prefixes if p[1]],
+                               key=lambda item: -len(item[1]))
+
+    def normalize(self, text):
+        for name, path in self.prefixes:
+            text = text.replace(path, "@%s@" % name)
+        return text
+
+    def normalize_bytes(self, data):
+        for name, path in self.prefixes:
+            data = data.replace(path.encode("utf-8"),
+                                ("@%s@" % name).encode("utf-8"))
+        return data
+
+    def restore(self, text):
+        for name, path in self.prefixes:
+            text = text.replace("@%s@" % name, path)
+        return text
+
+
+def pack(files):
+    # "files" is a list of (name, bytes)
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    return stream.getvalue()
+
+
+def unpack(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return [(name, archive.read(name)) for name in archive.namelist()]
+
+
+def _get_option_value(argv, index, option):
+    # "-oFILE" or "-o FILE", returns (value, next index)
+    if argv[index] == option:
+        return (argv[index + 1] if index + 1 < len(argv) else None,
+                index + 2)
+    return argv[index][len(option):], index + 1
+
+
+def parse_command(argv):
+    # returns dict(kind, output, depfile, options, inputs, ...) of compile
+    # or link command, otherwise None
+    if not argv or not basename(argv[0]).endswith(COMPILER_SUFFIXES):
+        return None
+    command = dict(kind="compile" if "-c" in argv else "link", output=None,
+                   depfile=None, options=[], inputs=[], libdirs=[], libs=[])
+    index = 1
+    while index < len(argv):
+        arg = argv[index]
+        if arg in ("-E", "-S", "-") or arg.startswith(("-save-temps",
+                                                      "-Wl,-Map")):
+            return None
+        if arg.startswith("-o"):
+            command['output'], index = _get_option_value(argv, index, "-o")
+        elif arg.startswith(("-MF", "-MT", "-MQ")):
+            value, index = _get_option_value(argv, index, arg[:3])
+            if arg.startswith("-MF"):
+                command['depfile'] = value
+            else:
+                command['options'].extend([arg[:3], value])
+        elif arg in PREPROCESSOR_OPTIONS and command['kind'] == "compile":
+            # in the preprocessed source
+            index += 2
+        elif arg.startswith(PREPROCESSOR_OPTIONS) and (
+                command['kind'] == "compile"):
+            index += 1
+        elif arg.startswith(("-T", "-Wl,-T")):
+            script, index = _get_option_value(
+                argv, index, "-T" if arg.startswith("-T") else "-Wl,-T")
+            command['inputs'].append(script.strip('"'))
+        elif arg.startswith("-L"):
+            libdir, index = _get_option_value(argv, index, "-L")
+            command['libdirs'].append(libdir)
+        else:
+            if arg.startswith("-l"):
+                command['libs'].append(arg[2:])
+            if arg.startswith("-") or command['kind'] == "compile":
+                command['options'].append(arg)
+            else:
+                command['inputs'].append(arg)
+            index += 1
+    if not command['output']:
+        return None
+    if not command['depfile'] and ("-MD" in command['options'] or
+                                   "-MMD" in command['options']):
+        # the dependency file is named after the output
+        command['depfile'] = splitext(command['output'])[0] + ".d"
+    return command
+
+
+def _find_library(name, libdirs):
+    for libdir in libdirs:
+        path = join(libdir, "lib%s.a" % name)
+        if isfile(path):
+            return path
+    return None
+
+
+def _strip_depfile_options(argv):
+    result = []
+    index = 0
+    while index < len(argv):
+        if argv[index] in ("-MF", "-MT", "-MQ"):
+            index += 2
+            continue
+        if not argv[index].startswith(("-MMD", "-MD", "-MF", "-MT", "-MQ",
+                                       "-MP")):
+            result.append(argv[index])
+        index += 1
+    return result
+
+
+def get_key(argv, command, environ, normalizer):
+    # returns None when the inputs can't be read, the tool reports the
+    # error then
+    items = [CACHE_FORMAT, command['kind'],
+             get_compiler_id(argv[0], environ),
+             normalizer.normalize(" ".join(command['options']))]
+    if command['kind'] == "compile":
+        try:
+            process = subprocess.Popen(
+                _strip_depfile_options(get_preprocess_command(argv)),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environ)
+        except OSError:
+            return None
+        output, _ = process.communicate()
+        if process.returncode != 0:
+            return None
+        items.append(normalizer.normalize_bytes(output))
+        return calculate_hash(*items)
+
+    inputs = list(command['inputs'])
+    for name in command['libs']:
+        # libraries of the toolchain are covered by the compiler hash
+        path = _find_library(name, command['libdirs'])
+        if path:
+            inputs.append(path)
+    for path in inputs:
+        if not isfile(path):
+            return None
+        items.extend([normalizer.normalize(path), calculate_file_hash(path)])
+    return calculate_hash(*items)
+
+
+class ActionCache(object):
+
+    def __init__(self, backends, normalizer):
+        # the first backend is local, hits of the others are copied to it
+        self.backends = backends
+        self.normalizer = normalizer
+
+    def restore(self, key, command):
+        for index, backend in enumerate(self.backends):
+            data = backend.get(key)
+            if data is None:
+                continue
+            try:
+                files = dict(unpack(data))
+            except (zipfile.BadZipfile, ValueError):
+                continue
+            if "output" not in files:
+                continue
+            if index:
+                self.backends[0].put(key, data)
+                _stats['remote_hits'] += 1
+            atomic_write(command['output'], files['output'])
+            if command['kind'] == "link":
+                # executable as the linker leaves it
+                os.chmod(command['output'],
+                         FILE_MODE | (FILE_MODE & 0o444) >> 2)
+            if command['depfile'] and "depfile" in files:
+                atomic_write(command['depfile'], self.normalizer.restore(
+                    files['depfile'].decode("utf-8")))
+            _stats['hits'] += 1
+            return True
+        _stats['misses'] += 1
+        return False
+
+    def store(self, key, command):
+        files = []
+        with open(command['output'], "rb") as fp:
+            files.append(("output", fp.read()))
+        if command['depfile']:
+            if not isfile(command['depfile']):
+                return
+            with open(command['depfile']) as fp:
+                files.append(("depfile", self.normalizer.normalize(
+                    fp.read())))
+        data = pack(files)
+        for backend in self.backends:
+            backend.put(key, data)
+
+
+def get_normalizer(env):
+    platform = env.PioPlatform()
+    packages_dir = env.subst("$PROJECT_PACKAGES_DIR")
+    if not packages_dir:
+        packages_dir = dirname(platform.get_package_dir(
+            "toolchain-gccarmnoneeabi") or "")
+    return PathNormalizer([
+        ("BUILD_DIR", env.subst("$BUILD_DIR")),
+        ("PROJECT_DIR", env.subst("$PROJECT_DIR")),
+        ("PACKAGES_DIR", packages_dir),
+        ("PLATFORM_DIR", platform.get_dir()),
+        ("HOME", expanduser("~"))
+    ])
+
+
+def _print_stats():
+    if _stats['hits'] or _stats['misses']:
+        print("Action cache: %d hit(s) (%d remote), %d miss(es)" % (
+            _stats['hits'], _stats['remote_hits'], _stats['misses']))
+
+
+def generate(env):
+    if not is_enabled(env):
+        return env
+    local = DirectoryBackend(
+        env.subst(get_build_option(env, "action_cache_dir", "")) or
+        get_cache_dir(env, "actions"),
+        int(get_build_option(env, "action_cache_size", DEFAULT_SIZE)) *
+        1024 * 1024)
+    backends = [local]
+    url = get_build_option(env, "action_cache_url", "")
+    if url:
+        backends.append(HTTPBackend(
+            url, get_build_flag(env, "action_cache_upload", True)))
+    cache = ActionCache(backends, get_normalizer(env))
+    spawn = env['SPAWN']
+
+    def _spawn(sh, escape, cmd, args, spawn_env):
+        argv = split_args(args)
+        command = parse_command(argv)
+        key = get_key(argv, command, spawn_env,
+                      cache.normalizer) if command else None
+        if not key:
+            return spawn(sh, escape, cmd, args, spawn_env)
+        if cache.restore(key, command):
+            return 0
+        result = spawn(sh, escape, cmd, args, spawn_env)
+        if result == 0 and isfile(command['output']):
+            cache.store(key, command)
+        return result
+
+    env['SPAWN'] = _spawn
+    atexit.register(_print_stats)
+    atexit.register(local.evict)
+    return env
+
+
+class _StoreHandler(BaseHTTPRequestHandler):
+
+    def _get_path(self):
+        key = self.path.strip("/").split("/")[-1]
+        if not KEY_RE.match(key):
+            return None
+        return join(self.server.directory, key[:2], key)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        path = self._get_path()
+        if not path or not isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as fp:
+            data = fp.read()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        path = self._get_path()
+        if not path:
+            self.send_error(400)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        atomic_write(path, self.rfile.read(length))
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def serve(directory, port=0):
+    server = HTTPServer(("127.0.0.1", port), _StoreHandler)
+    server.directory = ensure_dir(directory)
+    return server
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] != "serve":
+        sys.stderr.write(__doc__.split("Usage:")[1])
+        return 1
+    server = serve(argv[2], int(argv[3]) if len(argv) > 3 else 0)
+    print("Serving %s at http://%s:%d" % ((argv[2], ) +
+                                         server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,97 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Board index
+
+All "boards/*.json" manifests compiled into a single compact file. The
+index is rebuilt only when the name, size or modification time of any
+board manifest changes.
+"""
+
+import json
+import os
+from os.path import isdir, isfile, join
+
+from stm32tools.helpers import atomic_write, calculate_hash
+
+# bump when the layout of the index changes
+INDEX_FORMAT = 1
+
+
+def get_signature(boards_dir):
+    items = [INDEX_FORMAT]
+    for name in sorted(os.listdir(boards_dir)):
+        if not name.endswith(".json"):
+            continue
+        stat = os.stat(join(boards_dir, name))
+        items.extend([name, stat.st_size, stat.st_mtime])
+    return calculate_hash(*items)
+
+
+def build_index(boards_dir):
+    boards = {}
+    for name in sorted(os.listdir(boards_dir)):
+        if not name.endswith(".json"):
+            continue
+        with open(join(boards_dir, name)) as fp:
+            boards[name[:-5]] = json.load(fp)
+    return boards
+
+
+def load_index(boards_dir, index_path):
+    if not isdir(boards_dir):
+        return {}
+    signature = get_signature(boards_dir)
+    if isfile(index_path):
+        try:
+            with open(index_path) as fp:
+                data = json.load(fp)
+            if data.get("signature") == signature:
+                return data['boards']
+        except (IOError, ValueError):
+            pass
+
+    boards = build_index(boards_dir)
+    try:
+        atomic_write(index_path, json.dumps(
+            dict(signature=signature, boards=boards),
+            separators=(",", ":"), sort_keys=True))
+    except (IOError, OSError):
+        # read-only installation, the index is used only in memory
+        pass
+    return boards
+
+
+def query_boards(boards, mcu=None, framework=None, upload_protocol=None,
+                 min_flash_size=None, min_ram_size=None):
+    result = []
+    for board_id, manifest in boards.items():
+        build = manifest.get("build", {})
+        upload = manifest.get("upload", {})
+        if mcu and not build.get("mcu", "").lower().startswith(mcu.lower()):
+            continue
+        if framework and framework not in manifest.get("frameworks", []):
+            continue
+        if upload_protocol and upload_protocol not in upload.get(
+                "protocols", [upload.get("protocol")]):
+            continue
+        if min_flash_size and upload.get(
+                "maximum_size", 0) < int(min_flash_size):
+            continue
+        if min_ram_size and upload.get(
+                "maximum_ram_size", 0) < int(min_ram_size):
+            continue
+        result.append(board_id)
+    return sorted(result)
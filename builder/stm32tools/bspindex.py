@@ -0,0 +1,113 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+BSP component index
+
+STM32Cube ships dozens of BSP component drivers (sensors, codecs, LCDs)
+and a project uses one or two of them. The index maps every header of
+"Drivers/BSP/Components" to the components which ship it and lists
+headers which every component includes. It's built once per framework
+package and stored in the platform cache directory. Only components
+reachable from includes of the project, its libraries and the board BSP
+are passed to the library dependency finder.
+
+"board_build.bsp_components = all" restores registration of all
+components, a comma separated list adds components to the detected ones.
+"""
+
+import json
+import os
+from os.path import basename, isdir, isfile, join
+
+from stm32tools.helpers import (atomic_write, calculate_hash,
+                                get_build_option, get_cache_dir)
+from stm32tools.includes import (HEADER_SUFFIXES, get_includes,
+                                 get_project_includes, walk_sources)
+
+# bump when the layout of the index changes
+INDEX_FORMAT = 2
+
+
+def get_signature(components_dir, version):
+    items = [INDEX_FORMAT, components_dir, version]
+    for name in sorted(os.listdir(components_dir)):
+        items.extend([name, os.stat(join(components_dir, name)).st_mtime])
+    return calculate_hash(*items)
+
+
+def build_index(components_dir):
+    headers = {}
+    includes = {}
+    for component in sorted(os.listdir(components_dir)):
+        component_dir = join(components_dir, component)
+        if not isdir(component_dir):
+            continue
+        names = set()
+        for path in walk_sources(component_dir):
+            if path.endswith(HEADER_SUFFIXES):
+                headers.setdefault(basename(path), []).append(component)
+            names.update(get_includes(path))
+        includes[component] = sorted(names)
+    return dict(headers=headers, includes=includes)
+
+
+def load_index(components_dir, version, index_dir):
+    signature = get_signature(components_dir, version)
+    index_path = join(index_dir, signature + ".json")
+    if isfile(index_path):
+        try:
+            with open(index_path) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            pass
+    index = build_index(components_dir)
+    atomic_write(index_path, json.dumps(index, separators=(",", ":"),
+                                        sort_keys=True))
+    return index
+
+
+def resolve_components(index, includes):
+    # components of included headers and everything they include, every
+    # component which ships a header of the same name is registered, the
+    # library dependency finder picks the one which is used
+    components = set()
+    pending = list(includes)
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        for component in index['headers'].get(name, []):
+            if component not in components:
+                components.add(component)
+                pending.extend(index['includes'].get(component, []))
+    return sorted(components)
+
+
+def get_project_components(env, components_dir, version, extra_dirs=None):
+    option = get_build_option(env, "bsp_components", "")
+    if isinstance(option, (list, tuple)):
+        option = ",".join(option)
+    selected = [c.strip() for c in str(option).split(",") if c.strip()]
+    if "all" in selected:
+        return sorted(c for c in os.listdir(components_dir)
+                      if isdir(join(components_dir, c)))
+
+    index = load_index(components_dir, version,
+                       get_cache_dir(env, "bsp-index"))
+    includes = get_project_includes(env, extra_dirs)
+    return sorted(set(resolve_components(index, includes)) | set(
+        c for c in selected if isdir(join(components_dir, c))))
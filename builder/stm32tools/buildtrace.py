@@ -0,0 +1,232 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Build trace
+
+Records start and end of every SCons action (compilation, archiving,
+linking, image conversion, size check, upload) and of the configuration
+steps (dependency finder, framework libraries). Every record has a
+category: the framework library ("FrameworkHALDriver", ...), "lib:<name>"
+for project libraries, "src", "ldscript", "link", "post-link", "upload"
+and "configure".
+
+The records are saved as Chrome trace "$BUILD_DIR/trace.json" (open it in
+"chrome://tracing" or Perfetto, every worker thread of "-j" is a separate
+lane) and a summary is printed at the end of the build: time per
+category, the slowest units and the average number of busy workers.
+
+Enable it with "board_build.trace = yes" in "platformio.ini" (or
+PLATFORMIO_STM32_TRACE=1), "board_build.trace_top" sets the number of
+the slowest units in the summary.
+
+Usage:
+    python -m stm32tools.buildtrace TRACE.json [TOP]
+"""
+
+import atexit
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from os.path import basename, join, relpath, sep, splitext
+
+from stm32tools.helpers import (atomic_write, get_build_flag,
+                                get_build_option)
+
+DEFAULT_TOP = 10
+
+_lock = threading.Lock()
+_events = []
+_threads = {}
+_state = dict(enabled=False, registered=False, started=0.0, build_dir=None,
+              jobs=1, top=0)
+
+
+def is_enabled(env):
+    return get_build_flag(env, "trace")
+
+
+def get_category(path, build_dir):
+    rel = relpath(path, build_dir)
+    if rel.startswith(".."):
+        return "other"
+    parts = rel.split(sep)
+    if len(parts) == 1:
+        if splitext(rel)[1] == ".elf":
+            return "link"
+        if splitext(rel)[1] == ".ld":
+            return "ldscript"
+        return "post-link"
+    if parts[0].startswith("Framework") or parts[0] == "src":
+        return parts[0]
+    if parts[0].startswith("lib"):
+        return "lib:%s" % parts[1] if len(parts) > 2 else "lib"
+    return parts[0]
+
+
+def _get_tid():
+    ident = threading.current_thread().ident
+    if ident not in _threads:
+        _threads[ident] = len(_threads) + 1
+    return _threads[ident]
+
+
+def record(name, category, started, finished, **args):
+    if not _state['enabled']:
+        return
+    with _lock:
+        _events.append(dict(
+            name=name, cat=category, ph="X", pid=1, tid=_get_tid(),
+            ts=int((started - _state['started']) * 1e6),
+            dur=int((finished - started) * 1e6), args=args))
+
+
+@contextmanager
+def span(name, category="configure"):
+    started = time.time()
+    try:
+        yield
+    finally:
+        record(name, category, started, time.time())
+
+
+def _record_action(targets, started, finished):
+    if not targets:
+        return
+    node = targets[0]
+    if node.__class__.__name__ == "Alias":
+        name = str(node)
+        category = "upload" if name.startswith("upload") else name
+        record(name, category, started, finished)
+        return
+    path = node.get_abspath()
+    record(basename(path), get_category(path, _state['build_dir']),
+           started, finished,
+           target=relpath(path, _state['build_dir']).replace(sep, "/"))
+
+
+def _patch_actions():
+    # every command and function action (also inside lists of actions)
+    # is executed through this method
+    from SCons.Action import _ActionAction
+    original = _ActionAction.__call__
+    if getattr(original, "_buildtrace", False):
+        return
+
+    def __call__(self, target, source, env, *args, **kwargs):
+        started = time.time()
+        try:
+            return original(self, target, source, env, *args, **kwargs)
+        finally:
+            _record_action(target, started, time.time())
+
+    __call__._buildtrace = True
+    _ActionAction.__call__ = __call__
+
+
+def get_summary(events, jobs, top=DEFAULT_TOP):
+    configure = [e for e in events if e['cat'] == "configure"]
+    actions = [e for e in events if e['cat'] != "configure"]
+    summary = dict(jobs=jobs, categories=[], units=[], busy=0, wall=0,
+                   configure=max([e['dur'] for e in configure] or [0]) / 1e6)
+    if not actions:
+        return summary
+
+    start = min(e['ts'] for e in actions)
+    end = max(e['ts'] + e['dur'] for e in actions)
+    summary['wall'] = (end - start) / 1e6
+    summary['busy'] = sum(e['dur'] for e in actions) / 1e6
+
+    categories = {}
+    units = {}
+    for event in actions:
+        item = categories.setdefault(event['cat'], [0, 0])
+        item[0] += 1
+        item[1] += event['dur']
+        key = (event['cat'], event['args'].get("target", event['name']))
+        units[key] = units.get(key, 0) + event['dur']
+    summary['categories'] = sorted(
+        [(c, n, d / 1e6) for c, (n, d) in categories.items()],
+        key=lambda item: -item[2])
+    summary['units'] = sorted(
+        [(c, u, d / 1e6) for (c, u), d in units.items()],
+        key=lambda item: -item[2])[:top]
+    return summary
+
+
+def print_summary(summary):
+    busy = summary['busy'] or 1
+    print("Build trace: configuration %.2fs, actions %.2fs wall, %.2fs "
+          "busy, %.2f of %d worker(s) in use on average" % (
+              summary['configure'], summary['wall'], summary['busy'],
+              summary['busy'] / (summary['wall'] or 1), summary['jobs']))
+    print("%-32s %7s %10s %7s" % ("Category", "Actions", "Time", "Share"))
+    for category, count, duration in summary['categories']:
+        print("%-32s %7d %9.2fs %6.1f%%" % (
+            category, count, duration, duration * 100 / busy))
+    print("Slowest units:")
+    for category, unit, duration in summary['units']:
+        print("%9.2fs  %-24s %s" % (duration, category, unit))
+
+
+def save(trace_path):
+    with _lock:
+        events = list(_events)
+        threads = dict(_threads)
+    metadata = [dict(name="thread_name", ph="M", pid=1, tid=tid,
+                     args=dict(name="worker %d" % tid))
+                for tid in sorted(threads.values())]
+    atomic_write(trace_path, json.dumps(dict(
+        traceEvents=metadata + events, displayTimeUnit="ms",
+        otherData=dict(jobs=_state['jobs']))))
+    return events
+
+
+def _finish():
+    events = save(join(_state['build_dir'], "trace.json"))
+    print_summary(get_summary(events, _state['jobs'], _state['top']))
+
+
+def install(env):
+    if not is_enabled(env) or _state['enabled']:
+        return
+    from SCons.Script import GetOption
+    _state.update(
+        enabled=True, started=time.time(),
+        build_dir=env.subst("$BUILD_DIR"), jobs=GetOption("num_jobs") or 1,
+        top=int(get_build_option(env, "trace_top", DEFAULT_TOP)))
+    # the actions are patched and the trace is saved once per process
+    _patch_actions()
+    if not _state['registered']:
+        _state['registered'] = True
+        atexit.register(_finish)
+
+
+def main(argv):
+    if len(argv) < 2:
+        sys.stderr.write(__doc__.split("Usage:")[1])
+        return 1
+    with open(argv[1]) as fp:
+        trace = json.load(fp)
+    events = [e for e in trace['traceEvents'] if e.get("ph") == "X"]
+    print_summary(get_summary(
+        events, trace.get("otherData", {}).get("jobs", 1),
+        int(argv[2]) if len(argv) > 2 else DEFAULT_TOP))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,107 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Arduino core features
+
+Parts of the Arduino core and of "system/Middlewares" are used only
+with some features: USB device with "USBD_USE_*", serial ports with
+"HAL_UART_MODULE_ENABLED" (removed by PIO_FRAMEWORK_ARDUINO_SERIAL_DISABLED).
+The manifest below maps them to the defines which enable them. Sources
+of disabled features are excluded from the core library and their
+include paths are removed, unless a source which is built (the core,
+the variant or the project) includes a header found only there.
+
+"board_build.core_features = all" builds the whole core as before.
+"""
+
+from os.path import basename, isdir, isfile, join, relpath, sep
+
+from stm32tools.helpers import get_build_option
+from stm32tools.includes import (HEADER_SUFFIXES, get_project_includes,
+                                 scan_includes, walk_sources)
+
+USB_DEFINES = ("USBD_USE_CDC", "USBD_USE_HID_COMPOSITE")
+
+# (path relative to the framework package, defines which enable it);
+# a directory covers sources and the include path of the same name
+CORE_FEATURES = (
+    ("cores/arduino/stm32/usb", USB_DEFINES),
+    ("cores/arduino/stm32/usb/cdc", ("USBD_USE_CDC", )),
+    ("cores/arduino/stm32/usb/hid", ("USBD_USE_HID_COMPOSITE", )),
+    ("system/Middlewares/ST/STM32_USB_Device_Library", USB_DEFINES),
+    ("cores/arduino/HardwareSerial.cpp", ("HAL_UART_MODULE_ENABLED", )),
+    ("cores/arduino/stm32/uart.c", ("HAL_UART_MODULE_ENABLED", ))
+)
+
+
+def get_disabled_paths(defines, features=CORE_FEATURES):
+    # a nested path is disabled also when its parent is
+    disabled = [path for path, required in features
+                if not any(d in defines for d in required)]
+    return sorted(set(
+        path for path, _ in features
+        if any(path == d or path.startswith(d + "/") for d in disabled)))
+
+
+def _is_under(path, parent):
+    return path == parent or path.startswith(parent + sep)
+
+
+def get_src_filter(core_dir, disabled_dirs):
+    items = ["+<*>"]
+    for path in disabled_dirs:
+        if _is_under(path, core_dir):
+            rel = relpath(path, core_dir).replace(sep, "/")
+            items.append("-<%s%s>" % (rel, "/" if isdir(path) else ""))
+    return " ".join(items)
+
+
+def _get_headers(path):
+    if not isdir(path):
+        return set()
+    return set(basename(p) for p in walk_sources(path)
+               if p.endswith(HEADER_SUFFIXES))
+
+
+def get_required_includes(env, core_dir, disabled_dirs, extra_dirs=()):
+    # includes of the sources which are still built
+    return scan_includes(
+        [core_dir] + list(extra_dirs),
+        env.subst(join("$BUILD_DIR", "core-includes.json")),
+        exclude=disabled_dirs) | get_project_includes(env)
+
+
+def prune_core(env, framework_dir, core_dir, extra_dirs=()):
+    # returns "src_filter" for the core library, include paths of the
+    # disabled features are removed from CPPPATH
+    if str(get_build_option(env, "core_features", "")).strip() == "all":
+        return None
+    disabled = [join(framework_dir, *p.split("/")) for p in
+                get_disabled_paths(env.Flatten(env.get("CPPDEFINES", [])))]
+    if not disabled:
+        return None
+
+    includes = get_required_includes(env, core_dir, disabled, extra_dirs)
+    cpppath = []
+    for path in env.get("CPPPATH", []):
+        owner = [d for d in disabled if isdir(d) and _is_under(
+            env.subst(path), d)]
+        # a directory stays searchable when a built source needs it
+        if owner and not _get_headers(env.subst(path)) & includes:
+            continue
+        cpppath.append(path)
+    env.Replace(CPPPATH=cpppath)
+    return get_src_filter(core_dir, [
+        d for d in disabled if isdir(d) or isfile(d)])
@@ -0,0 +1,302 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Delta flashing
+
+Keeps a copy of the last image flashed through every probe and programs
+only the flash sectors which differ from it. The sector layout comes from
+the memory map of the MCU family. A missing or corrupted record, another
+MCU or another load address fall back to a full "program". The recorded
+image is compared with the flash of the target before the sectors are
+written, the whole image is programmed when the target was flashed by
+something else in between.
+
+Enable it with "board_upload.delta = yes" in "platformio.ini", the probe
+is identified by "upload_port" (the probe serial number) if it's set.
+"""
+
+import json
+import os
+import re
+from os.path import isfile, join
+
+from stm32tools.helpers import (TRUE_VALUES, atomic_copy, atomic_write,
+                                ensure_dir)
+from stm32tools.image import crc32
+
+FLASH_START = 0x08000000
+ERASED_BYTE = b"\xff"
+
+KB = 1024
+
+# layouts of flash sectors, the last item is repeated up to the end of a
+# bank; (MCU prefix, bank size, [(count, sector size), ...])
+SECTOR_LAYOUTS = (
+    ("stm32f2", 1024 * KB, [(4, 16 * KB), (1, 64 * KB), (0, 128 * KB)]),
+    ("stm32f4", 1024 * KB, [(4, 16 * KB), (1, 64 * KB), (0, 128 * KB)]),
+    ("stm32f72", 0, [(4, 16 * KB), (1, 64 * KB), (0, 128 * KB)]),
+    ("stm32f73", 0, [(4, 16 * KB), (1, 64 * KB), (0, 128 * KB)]),
+    ("stm32f7", 0, [(4, 32 * KB), (1, 128 * KB), (0, 256 * KB)]),
+    ("stm32h7a", 0, [(0, 8 * KB)]),
+    ("stm32h7b", 0, [(0, 8 * KB)]),
+    ("stm32h7", 0, [(0, 128 * KB)]),
+    ("stm32f07", 0, [(0, 2 * KB)]),
+    ("stm32f09", 0, [(0, 2 * KB)]),
+    ("stm32f0", 0, [(0, 1 * KB)]),
+    ("stm32f105", 0, [(0, 2 * KB)]),
+    ("stm32f107", 0, [(0, 2 * KB)]),
+    ("stm32f1", 0, None),  # depends on the density, see below
+    ("stm32f3", 0, [(0, 2 * KB)]),
+    ("stm32l0", 0, [(0, 128)]),
+    ("stm32l1", 0, [(0, 256)]),
+    ("stm32l4r", 0, [(0, 4 * KB)]),
+    ("stm32l4s", 0, [(0, 4 * KB)]),
+    ("stm32l4", 0, [(0, 2 * KB)]),
+    ("stm32g0", 0, [(0, 2 * KB)]),
+    ("stm32g4", 0, [(0, 2 * KB)]),
+    ("stm32wb", 0, [(0, 4 * KB)]),
+    ("stm32wl", 0, [(0, 2 * KB)])
+)
+
+
+def is_enabled(env):
+    return str(env.BoardConfig().get(
+        "upload.delta", "no")).strip().lower() in TRUE_VALUES
+
+
+def get_sector_layout(mcu, flash_size):
+    mcu = mcu.lower()
+    for prefix, bank_size, layout in SECTOR_LAYOUTS:
+        if not mcu.startswith(prefix):
+            continue
+        if layout is None:
+            # high and XL-density STM32F1 have 2 KB pages
+            layout = [(0, 2 * KB if flash_size >= 256 * KB else 1 * KB)]
+        return bank_size, layout
+    return None, None
+
+
+def get_sectors(mcu, flash_size, flash_start=FLASH_START):
+    # returns list of (address, size) which covers "flash_size" bytes
+    bank_size, layout = get_sector_layout(mcu, flash_size)
+    if not layout:
+        return None
+    bank_size = bank_size or flash_size
+    sectors = []
+    for bank_start in range(0, flash_size, bank_size):
+        offset = bank_start
+        bank_end = min(bank_start + bank_size, flash_size)
+        for count, size in layout:
+            index = 0
+            while offset < bank_end and (not count or index < count):
+                sectors.append((flash_start + offset, size))
+                offset += size
+                index += 1
+    return sectors
+
+
+def pad_to_sector(image, address, sectors):
+    # the last sector of the previous image was erased before writing,
+    # its tail holds erased bytes
+    end = address + len(image)
+    for start, size in sectors:
+        if start < end <= start + size:
+            return image + ERASED_BYTE * (start + size - end)
+    return image
+
+
+def get_dirty_sectors(old, new, address, sectors):
+    # "old" and "new" are images programmed at "address", returns the
+    # sectors of the new image which differ from the old one
+    old = pad_to_sector(old, address, sectors)
+    result = []
+    end = address + len(new)
+    for start, size in sectors:
+        if start + size <= address or start >= end:
+            continue
+        begin = max(start, address) - address
+        finish = min(start + size, end) - address
+        if finish > len(old) or old[begin:finish] != new[begin:finish]:
+            result.append((start, size))
+    return result
+
+
+def merge_sectors(sectors):
+    ranges = []
+    for start, size in sorted(sectors):
+        if ranges and ranges[-1][0] + ranges[-1][1] == start:
+            ranges[-1][1] += size
+        else:
+            ranges.append([start, size])
+    return [(start, size) for start, size in ranges]
+
+
+def plan_update(old, new, address, sectors):
+    # returns list of (address, data) which must be written, data ends
+    # with the image, the rest of erased sector stays erased
+    result = []
+    for start, size in merge_sectors(
+            get_dirty_sectors(old, new, address, sectors)):
+        begin = max(start, address) - address
+        result.append((max(start, address),
+                       new[begin:min(start + size - address, len(new))]))
+    return result
+
+
+def get_probe_id(env, protocol):
+    serial = env.subst("$UPLOAD_PORT") or "default"
+    return re.sub(r"[^\w.-]", "_", "%s-%s" % (protocol, serial))
+
+
+def _get_state_paths(env, probe_id):
+    state_dir = ensure_dir(env.subst(join("$BUILD_DIR", "flash-state")))
+    return join(state_dir, probe_id + ".json"), join(state_dir,
+                                                     probe_id + ".bin")
+
+
+def load_state(env, probe_id, mcu, address):
+    # returns the last flashed image or None if the record is unusable
+    json_path, bin_path = _get_state_paths(env, probe_id)
+    if not isfile(json_path) or not isfile(bin_path):
+        return None
+    try:
+        with open(json_path) as fp:
+            state = json.load(fp)
+    except ValueError:
+        return None
+    with open(bin_path, "rb") as fp:
+        image = fp.read()
+    if (state.get("mcu") != mcu or state.get("address") != address or
+            state.get("length") != len(image) or
+            state.get("crc32") != crc32(image)):
+        return None
+    return image
+
+
+def invalidate_state(env, probe_id):
+    json_path, _ = _get_state_paths(env, probe_id)
+    if isfile(json_path):
+        os.remove(json_path)
+
+
+def save_state(env, probe_id, mcu, address, image_path):
+    json_path, bin_path = _get_state_paths(env, probe_id)
+    atomic_copy(image_path, bin_path)
+    with open(bin_path, "rb") as fp:
+        image = fp.read()
+    # the record is written last, it marks the image as complete
+    atomic_write(json_path, json.dumps(dict(
+        mcu=mcu, address=address, length=len(image), crc32=crc32(image))))
+
+
+def _get_write_commands(path, address):
+    # "write_image erase" erases only sectors covered by the image
+    return ["flash write_image erase {%s} 0x%08x bin" % (path, address),
+            "verify_image {%s} 0x%08x bin" % (path, address)]
+
+
+def get_openocd_commands(updates, chunk_paths, base_path, image_path,
+                         address):
+    # the changed sectors are written only if the target still holds the
+    # recorded image ("base_path"), otherwise the whole image
+    writes = []
+    for (chunk_address, _), path in zip(updates, chunk_paths):
+        writes.extend(_get_write_commands(path, chunk_address))
+    return [
+        "init", "reset init",
+        "if {[catch {verify_image_checksum {%s} 0x%08x bin}]} {"
+        "echo {Target differs from the recorded image, programming the "
+        "whole image}; %s} else {%s}" % (
+            base_path, address,
+            "; ".join(_get_write_commands(image_path, address)),
+            "; ".join(writes)),
+        "reset run", "shutdown"
+    ]
+
+
+def get_image_address(image_path):
+    # the load address of the main image from the segment manifest
+    manifest_path = os.path.splitext(image_path)[0] + ".segments.json"
+    with open(manifest_path) as fp:
+        manifest = json.load(fp)
+    for item in manifest['images']:
+        if item['file'] == os.path.basename(image_path):
+            return item['address']
+    return FLASH_START
+
+
+def _execute_openocd(env, openocd_args, commands, message):
+    args = [env.subst("$UPLOADER")] + list(openocd_args)
+    for command in commands:
+        args.extend(["-c", command])
+    return env.Execute(env.VerboseAction([args], message))
+
+
+def upload(env, image_path, protocol, openocd_args, execute=None):
+    # "execute" is function(env, commands, message) which runs OpenOCD
+    # commands and returns non-zero status on failure, a standalone
+    # OpenOCD with "openocd_args" by default
+    if not execute:
+        def execute(env, commands, message):
+            return _execute_openocd(env, openocd_args, commands, message)
+
+    board = env.BoardConfig()
+    address = get_image_address(image_path)
+    mcu = board.get("build.mcu", "")
+    probe_id = get_probe_id(env, protocol)
+    flash_size = int(board.get("upload.maximum_size", 0)) + (
+        address - FLASH_START)
+    sectors = get_sectors(mcu, flash_size)
+    with open(image_path, "rb") as fp:
+        image = fp.read()
+
+    old = load_state(env, probe_id, mcu, address) if sectors else None
+    invalidate_state(env, probe_id)
+    if old is None:
+        if not sectors:
+            print("Warning! Unknown flash layout of %s, delta flashing "
+                  "is not available" % mcu)
+        if execute(env, [
+                "program {%s} verify reset 0x%08x" % (image_path, address),
+                "shutdown"
+        ], "Programming the whole image"):
+            return 1
+        save_state(env, probe_id, mcu, address, image_path)
+        return None
+
+    updates = plan_update(old, image, address, sectors)
+    if not updates:
+        print("Flash is up to date, verifying the target")
+    else:
+        print("Programming %d byte(s) in %d range(s) out of %d bytes" % (
+            sum(len(data) for _, data in updates), len(updates), len(image)))
+
+    # the erased tail of the last sector is a part of the recorded state
+    base_path = atomic_write(
+        "%s.base" % image_path, pad_to_sector(old, address, sectors))
+    chunk_paths = []
+    for chunk_address, data in updates:
+        chunk_paths.append(atomic_write(
+            "%s.0x%08x.chunk" % (image_path, chunk_address), data))
+    try:
+        if execute(env, get_openocd_commands(updates, chunk_paths,
+                                             base_path, image_path, address),
+                   "Programming changed sectors"):
+            return 1
+    finally:
+        for path in [base_path] + chunk_paths:
+            os.remove(path)
+    save_state(env, probe_id, mcu, address, image_path)
+    return None
@@ -0,0 +1,379 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+ELF reader
+
+Memory-mapped reader of ELF section and program headers, used to
+calculate the memory usage of the firmware without spawning
+"arm-none-eabi-size". Section sizes are matched against the same
+"SIZEPROGREGEXP"/"SIZEDATAREGEXP" patterns, so the numbers are identical
+to the "size -A" based check, and the result is also stored as JSON with
+a per memory region breakdown.
+
+Usage:
+    python -m stm32tools.elf FIRMWARE.elf [--json]
+"""
+
+import json
+import mmap
+import re
+import struct
+import sys
+from os.path import getsize, join
+
+from stm32tools.helpers import atomic_write
+
+SHT_NOBITS = 8
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+PT_LOAD = 1
+SHN_XINDEX = 0xFFFF
+
+ELF_MAGIC = b"\x7fELF"
+
+# e_shoff, e_phoff, e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx
+_HEADER_LAYOUT = {
+    1: ("I", 24),  # ELF32: word size, offset of e_entry
+    2: ("Q", 24)   # ELF64
+}
+
+# memory regions of STM32 devices, flash and RAM are taken from the board
+DEFAULT_REGIONS = (
+    ("ITCM", 0x00000000, 0x00010000),
+    ("CCMRAM", 0x10000000, 0x00010000),
+    ("BKPSRAM", 0x40024000, 0x00001000)
+)
+
+
+class ELFError(Exception):
+    pass
+
+
+class Section(object):
+
+    __slots__ = ("name", "type", "flags", "address", "load_address",
+                 "offset", "size")
+
+    def __init__(self, name, type_, flags, address, offset, size):
+        self.name = name
+        self.type = type_
+        self.flags = flags
+        self.address = address
+        self.load_address = address
+        self.offset = offset
+        self.size = size
+
+    @property
+    def is_alloc(self):
+        return bool(self.flags & SHF_ALLOC)
+
+    @property
+    def is_writable(self):
+        return bool(self.flags & SHF_WRITE)
+
+    @property
+    def is_nobits(self):
+        return self.type == SHT_NOBITS
+
+
+class Segment(object):
+
+    __slots__ = ("type", "offset", "address", "load_address", "file_size",
+                 "memory_size")
+
+    def __init__(self, type_, offset, address, load_address, file_size,
+                 memory_size):
+        self.type = type_
+        self.offset = offset
+        self.address = address
+        self.load_address = load_address
+        self.file_size = file_size
+        self.memory_size = memory_size
+
+
+class ELFFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.sections = []
+        self.segments = []
+        if getsize(path) < 52:
+            raise ELFError("%s is not an ELF file" % path)
+        with open(path, "rb") as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self._parse(data)
+            finally:
+                data.close()
+
+    def _parse(self, data):
+        if data[0:4] != ELF_MAGIC:
+            raise ELFError("%s is not an ELF file" % self.path)
+        elf_class = ord(data[4:5])
+        if elf_class not in _HEADER_LAYOUT:
+            raise ELFError("Unknown ELF class %d" % elf_class)
+        self.endian = "<" if ord(data[5:6]) == 1 else ">"
+        word, offset = _HEADER_LAYOUT[elf_class]
+        (self.entry, phoff, shoff, _, _, phentsize, phnum, shentsize, shnum,
+         shstrndx) = struct.unpack_from(
+             self.endian + "%c%c%cIHHHHHH" % (word, word, word), data, offset)
+
+        if elf_class == 1:
+            section_struct = struct.Struct(self.endian + "IIIIIIIIII")
+            segment_struct = struct.Struct(self.endian + "IIIIIIII")
+        else:
+            section_struct = struct.Struct(self.endian + "IIQQQQIIQQ")
+            segment_struct = struct.Struct(self.endian + "IIQQQQQQ")
+
+        headers = []
+        if shoff:
+            first = section_struct.unpack_from(data, shoff)
+            # extended numbering for more than 0xff00 sections
+            shnum = shnum or first[5]
+            if shstrndx == SHN_XINDEX:
+                shstrndx = first[6]
+            headers = [section_struct.unpack_from(data, shoff + i * shentsize)
+                       for i in range(shnum)]
+
+        strtab = headers[shstrndx] if shstrndx < len(headers) else None
+        for header in headers[1:]:
+            self.sections.append(Section(
+                self._get_string(data, strtab, header[0]), header[1],
+                header[2], header[3], header[4], header[5]))
+
+        for i in range(phnum):
+            header = segment_struct.unpack_from(data, phoff + i * phentsize)
+            if elf_class == 1:
+                type_, offset, vaddr, paddr, filesz, memsz = header[0:6]
+            else:
+                type_, offset, vaddr, paddr, filesz, memsz = (
+                    header[0], header[2], header[3], header[4], header[5],
+                    header[6])
+            self.segments.append(
+                Segment(type_, offset, vaddr, paddr, filesz, memsz))
+
+        # load address (LMA) of sections which are copied at startup
+        for section in self.sections:
+            if not section.is_alloc or section.is_nobits:
+                continue
+            for segment in self.segments:
+                if segment.type == PT_LOAD and segment.offset <= \
+                        section.offset < segment.offset + segment.file_size:
+                    section.load_address = segment.load_address + (
+                        section.offset - segment.offset)
+                    break
+
+    @staticmethod
+    def _get_string(data, strtab, offset):
+        if strtab is None:
+            return ""
+        start = strtab[4] + offset
+        end = data.find(b"\0", start)
+        return data[start:end].decode("utf-8", "replace")
+
+    def get_load_chunks(self, exclude=None):
+        # contents of loadable sections at their load addresses, adjacent
+        # sections are merged; returns sorted list of (address, bytes)
+        sections = sorted(
+            (s for s in self.sections
+             if s.is_alloc and not s.is_nobits and s.size and
+             s.name not in (exclude or ())),
+            key=lambda s: s.load_address)
+        chunks = []
+        with open(self.path, "rb") as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for section in sections:
+                    content = data[section.offset:section.offset +
+                                   section.size]
+                    if chunks and chunks[-1][0] + len(
+                            chunks[-1][1]) == section.load_address:
+                        chunks[-1][1].extend(content)
+                    else:
+                        chunks.append(
+                            (section.load_address, bytearray(content)))
+            finally:
+                data.close()
+        return [(address, bytes(content)) for address, content in chunks]
+
+    def get_berkeley_sizes(self):
+        # the same numbers as "size -B"
+        text = data = bss = 0
+        for section in self.sections:
+            if not section.is_alloc:
+                continue
+            if section.is_nobits:
+                bss += section.size
+            elif section.is_writable:
+                data += section.size
+            else:
+                text += section.size
+        return text, data, bss
+
+
+def _sum_sections(sections, pattern):
+    if not pattern:
+        return -1
+    regexp = re.compile(pattern)
+    return sum(s.size for s in sections
+               if regexp.match("%s %d %d" % (s.name, s.size, s.address)))
+
+
+def get_regions(flash_start, flash_size, ram_size):
+    regions = [("FLASH", flash_start, flash_size),
+               ("RAM", 0x20000000, ram_size)]
+    return regions + [r for r in DEFAULT_REGIONS if not any(
+        r[1] < start + size and start < r[1] + r[2]
+        for _, start, size in regions)]
+
+
+def _find_region(regions, address):
+    for name, start, size in regions:
+        if start <= address < start + (size or 0x10000000):
+            return name
+    return None
+
+
+def get_memory_usage(elf, prog_pattern, data_pattern, regions):
+    usage = dict(
+        program_size=_sum_sections(elf.sections, prog_pattern),
+        data_size=_sum_sections(elf.sections, data_pattern),
+        berkeley=dict(zip(("text", "data", "bss"),
+                          elf.get_berkeley_sizes())),
+        regions=[])
+
+    breakdown = dict(
+        (name, dict(name=name, origin="0x%08x" % start, length=size, used=0,
+                    sections={})) for name, start, size in regions)
+    other = dict(name="OTHER", origin=None, length=0, used=0, sections={})
+    for section in elf.sections:
+        if not section.is_alloc or not section.size:
+            continue
+        addresses = [section.address]
+        if not section.is_nobits and section.load_address != section.address:
+            # initialized data occupies RAM and its image is kept in flash
+            addresses.append(section.load_address)
+        for address in addresses:
+            item = breakdown.get(_find_region(regions, address), other)
+            item['used'] += section.size
+            item['sections'][section.name] = (
+                item['sections'].get(section.name, 0) + section.size)
+
+    for name, _, _ in regions:
+        if breakdown[name]['used']:
+            usage['regions'].append(breakdown[name])
+    if other['used']:
+        usage['regions'].append(other)
+    for item in usage['regions']:
+        item['percent'] = round(100.0 * item['used'] / item['length'],
+                                2) if item['length'] else None
+    return usage
+
+
+def format_available_bytes(value, total):
+    # the same format as the PlatformIO Core size check
+    percent_raw = float(value) / float(total)
+    blocks_per_progress = 10
+    used_blocks = min(int(round(blocks_per_progress * percent_raw)),
+                      blocks_per_progress)
+    return "[{:{}}] {: 6.1%} (used {:d} bytes from {:d} bytes)".format(
+        "=" * used_blocks, blocks_per_progress, percent_raw, value, total)
+
+
+def format_berkeley(usage, path):
+    sizes = usage['berkeley']
+    total = sizes['text'] + sizes['data'] + sizes['bss']
+    return "\n".join([
+        "   text\t   data\t    bss\t    dec\t    hex\tfilename",
+        "%7d\t%7d\t%7d\t%7d\t%7x\t%s" % (sizes['text'], sizes['data'],
+                                        sizes['bss'], total, total, path)
+    ])
+
+
+def _get_usage(env, path):
+    board = env.BoardConfig()
+    usage = get_memory_usage(
+        ELFFile(path), env.get("SIZEPROGREGEXP"), env.get("SIZEDATAREGEXP"),
+        get_regions(int(str(board.get("upload.offset_address",
+                                      "0x08000000")), 0),
+                    int(board.get("upload.maximum_size", 0)),
+                    int(board.get("upload.maximum_ram_size", 0))))
+    usage['maximum_size'] = int(board.get("upload.maximum_size", 0))
+    usage['maximum_ram_size'] = int(board.get("upload.maximum_ram_size", 0))
+    atomic_write(env.subst(join("$BUILD_DIR", "size.json")),
+                 json.dumps(usage, indent=2, sort_keys=True))
+    return usage
+
+
+def CheckUploadSize(_, target, source, env):
+    # replaces PlatformIO Core check which spawns "$SIZECHECKCMD"
+    from SCons.Script import ARGUMENTS
+    program_max_size = int(env.BoardConfig().get("upload.maximum_size", 0))
+    data_max_size = int(env.BoardConfig().get("upload.maximum_ram_size", 0))
+    if not env.get("BOARD") or program_max_size == 0:
+        return
+
+    usage = _get_usage(env, source[0].abspath)
+    program_size = usage['program_size']
+    data_size = usage['data_size']
+
+    if data_max_size and data_size > -1:
+        print("RAM:   %s" % format_available_bytes(data_size, data_max_size))
+    if program_size > -1:
+        print("Flash: %s" % format_available_bytes(
+            program_size, program_max_size))
+    if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+        print(json.dumps(usage['regions'], indent=2, sort_keys=True))
+
+    if program_size > program_max_size:
+        sys.stderr.write("Error: The program size (%d bytes) is greater "
+                         "than maximum allowed (%s bytes)\n" % (
+                             program_size, program_max_size))
+        env.Exit(1)
+
+
+def PrintSize(target, source, env):
+    usage = _get_usage(env, source[0].abspath)
+    print(format_berkeley(usage, source[0].path))
+    for item in usage['regions']:
+        print("%-8s %8d bytes%s" % (
+            item['name'], item['used'], " (%.1f%%)" % item['percent']
+            if item['percent'] is not None else ""))
+
+
+def generate(env):
+    env.AddMethod(CheckUploadSize)
+    return env
+
+
+def main(argv):
+    if len(argv) < 2:
+        sys.stderr.write(__doc__.split("Usage:")[1])
+        return 1
+    elf = ELFFile(argv[1])
+    usage = get_memory_usage(
+        elf,
+        r"^(?:\.text|\.data|\.rodata|\.text.align|\.ARM.exidx)\s+(\d+).*",
+        r"^(?:\.data|\.bss|\.noinit)\s+(\d+).*",
+        get_regions(0x08000000, 0, 0))
+    if "--json" in argv:
+        print(json.dumps(usage, indent=2, sort_keys=True))
+    else:
+        print(format_berkeley(usage, argv[1]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
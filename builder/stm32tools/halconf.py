@@ -0,0 +1,196 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+STM32Cube HAL configuration
+
+Helpers which generate the effective "<family>xx_hal_conf.h" for a build
+and turn the set of enabled "HAL_<MODULE>_MODULE_ENABLED" switches into a
+source filter for the HAL driver library.
+
+The effective configuration is written into the build directory, it is
+either the project "<family>xx_hal_conf.h" or the framework template
+merged with the "#define"/"#undef" lines of an optional project
+"<family>xx_hal_conf_override.h".
+"""
+
+import re
+from collections import OrderedDict
+from os.path import isfile, join
+
+from stm32tools.helpers import update_file
+
+# modules which are always required by HAL_Init() and the clock setup
+BASE_MODULES = ("cortex", "rcc", "gpio")
+
+# HAL modules which call into other HAL modules
+MODULE_DEPENDENCIES = {
+    "rcc": ("gpio", ),
+    "adc": ("dma", ),
+    "cec": (),
+    "cryp": ("dma", ),
+    "dac": ("dma", ),
+    "dcmi": ("dma", ),
+    "dfsdm": ("dma", ),
+    "hash": ("dma", ),
+    "i2c": ("dma", ),
+    "i2s": ("dma", ),
+    "irda": ("dma", ),
+    "jpeg": ("dma", "mdma"),
+    "mmc": ("dma", ),
+    "qspi": ("dma", ),
+    "sai": ("dma", ),
+    "sd": ("dma", ),
+    "smartcard": ("dma", ),
+    "spdifrx": ("dma", ),
+    "spi": ("dma", ),
+    "swpmi": ("dma", ),
+    "uart": ("dma", ),
+    "usart": ("dma", ),
+    "nand": ("dma", ),
+    "nor": ("dma", ),
+    "sram": ("dma", ),
+    "sdram": ("dma", ),
+    "pccard": (),
+    "tim": ("dma", ),
+    "lptim": (),
+    "pcd": (),
+    "hcd": ()
+}
+
+# extra driver files which are not named after the module
+MODULE_EXTRA_FILES = {
+    "flash": ("hal_flash_ramfunc", ),
+    "sd": ("ll_sdmmc", ),
+    "mmc": ("ll_sdmmc", ),
+    "nand": ("ll_fmc", "ll_fsmc"),
+    "nor": ("ll_fmc", "ll_fsmc"),
+    "pccard": ("ll_fmc", "ll_fsmc"),
+    "sram": ("ll_fmc", "ll_fsmc"),
+    "sdram": ("ll_fmc", "ll_fsmc"),
+    "pcd": ("ll_usb", ),
+    "hcd": ("ll_usb", )
+}
+
+COMMENTS_RE = re.compile(r"/\*.*?\*/|//[^\n]*", re.DOTALL)
+MODULE_ENABLED_RE = re.compile(
+    r"^\s*#\s*define\s+HAL_(\w+?)_MODULE_ENABLED\b", re.MULTILINE)
+OVERRIDE_RE = re.compile(r"^\s*#\s*(define|undef)\s+(\w+)\b")
+# active or commented out "#define NAME" line of the template
+TEMPLATE_DEFINE_RE = re.compile(
+    r"^\s*(?:/\*\s*|//\s*)?#\s*define\s+(\w+)\b")
+GUARD_RE = re.compile(r"^\s*#\s*define\s+__\w+_HAL_CONF_H\b")
+
+
+def get_config_name(mcu_family):
+    return "%sxx_hal_conf.h" % mcu_family.lower()
+
+
+def get_override_name(mcu_family):
+    return "%sxx_hal_conf_override.h" % mcu_family.lower()
+
+
+def find_project_config(env, mcu_family, config_name=None):
+    config_name = config_name or get_config_name(mcu_family)
+    for search_dir in ("$PROJECT_INCLUDE_DIR", "$PROJECT_SRC_DIR"):
+        config_path = join(env.subst(search_dir), config_name)
+        if isfile(config_path):
+            return config_path
+    return None
+
+
+def parse_enabled_modules(config_path):
+    with open(config_path) as fp:
+        content = COMMENTS_RE.sub("", fp.read())
+    return set(m.lower() for m in MODULE_ENABLED_RE.findall(content))
+
+
+def parse_overrides(content):
+    # returns list of (name, line), "line" is None for "#undef NAME"
+    result = []
+    for line in COMMENTS_RE.sub("", content).splitlines():
+        match = OVERRIDE_RE.match(line)
+        if match:
+            result.append((match.group(2), line.strip()
+                           if match.group(1) == "define" else None))
+    return result
+
+
+def merge_config(template, overrides):
+    overrides = OrderedDict(parse_overrides(overrides))
+    lines = []
+    for line in template.splitlines():
+        match = TEMPLATE_DEFINE_RE.match(line)
+        name = match.group(1) if match else None
+        if name in overrides:
+            line = overrides.pop(name) or "/* #undef %s */" % name
+        lines.append(line)
+    # defines which are not known to the template go right after
+    # the include guard, before the first use
+    extra = [line for line in overrides.values() if line]
+    for i, line in enumerate(lines):
+        if GUARD_RE.match(line):
+            lines[i + 1:i + 1] = extra
+            break
+    else:
+        lines = extra + lines
+    return "\n".join(lines) + "\n"
+
+
+def generate_config(env, mcu_family, template_path, output_dir):
+    # returns path to the effective configuration inside "output_dir",
+    # the file is rewritten only when its content changes
+    config_path = find_project_config(env, mcu_family)
+    if config_path:
+        with open(config_path) as fp:
+            content = fp.read()
+    else:
+        with open(template_path) as fp:
+            content = fp.read()
+        override_path = find_project_config(
+            env, mcu_family, get_override_name(mcu_family))
+        if override_path:
+            with open(override_path) as fp:
+                content = merge_config(content, fp.read())
+
+    output_path = join(output_dir, get_config_name(mcu_family))
+    update_file(output_path, content)
+    return output_path
+
+
+def resolve_modules(modules):
+    result = set(BASE_MODULES)
+    queue = list(modules) + list(BASE_MODULES)
+    while queue:
+        module = queue.pop()
+        result.add(module)
+        for dependency in MODULE_DEPENDENCIES.get(module, ()):
+            if dependency not in result:
+                queue.append(dependency)
+    return result
+
+
+def get_src_filter(mcu_family, modules, full_ll_driver=False):
+    prefix = "Src/%sxx_" % mcu_family.lower()
+    patterns = ["-<*>", "+<%shal.c>" % prefix]
+    for module in sorted(resolve_modules(modules)):
+        patterns.append("+<%shal_%s.c>" % (prefix, module))
+        patterns.append("+<%shal_%s_ex.c>" % (prefix, module))
+        for name in MODULE_EXTRA_FILES.get(module, ()):
+            patterns.append("+<%s%s.c>" % (prefix, name))
+    if full_ll_driver:
+        patterns.append("+<%sll_*.c>" % prefix)
+    # keep the same exclusions as the full build
+    patterns.extend(["-<Src/*_template.c>", "-<Src/Legacy>"])
+    return " ".join(patterns)
@@ -0,0 +1,149 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import shutil
+import tempfile
+from os.path import dirname, isdir, join
+
+TRUE_VALUES = ("1", "y", "yes", "true", "on", "enable", "enabled")
+
+# files created through "mkstemp" are private, cache files are shared
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+
+def get_build_option(env, name, default=None):
+    # "board_build.<name>" in "platformio.ini" has priority over
+    # "PLATFORMIO_STM32_<NAME>" environment variable (useful for CI)
+    value = env.BoardConfig().get("build.%s" % name, None)
+    if value is None:
+        value = os.environ.get(
+            "PLATFORMIO_STM32_%s" % name.upper().replace(".", "_"))
+    return default if value is None else value
+
+
+def get_build_flag(env, name, default=False):
+    value = get_build_option(env, name, None)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in TRUE_VALUES
+
+
+def get_platform_cache_dir(platform_name, cache_dir=None):
+    # "cache_dir" is "board_build.cache_dir" of the project environment,
+    # "platform.py" (debug tools) reads it from the project configuration
+    cache_dir = cache_dir or os.environ.get("PLATFORMIO_STM32_CACHE_DIR")
+    if not cache_dir:
+        from platformio.project.helpers import get_project_cache_dir
+        cache_dir = join(get_project_cache_dir(), platform_name)
+    return cache_dir
+
+
+def get_cache_dir(env, *names):
+    cache_dir = get_build_option(env, "cache_dir", "")
+    if cache_dir:
+        cache_dir = env.subst(cache_dir)
+    else:
+        cache_dir = get_platform_cache_dir(env.PioPlatform().name)
+    cache_dir = join(cache_dir, *names)
+    ensure_dir(cache_dir)
+    return cache_dir
+
+
+def ensure_dir(path):
+    if not isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # created by a concurrent build
+            if not isdir(path):
+                raise
+    return path
+
+
+def calculate_hash(*items):
+    sha = hashlib.sha1()
+    for item in items:
+        if not isinstance(item, bytes):
+            item = str(item).encode("utf-8")
+        sha.update(item)
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def calculate_file_hash(path, sha=None):
+    sha = sha or hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(65536), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _replace(src, dst):
+    try:
+        os.replace(src, dst)
+    except AttributeError:  # Python 2
+        if os.name == "nt" and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def atomic_write(path, data):
+    # concurrent readers never see a partially written file
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    ensure_dir(dirname(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        os.chmod(tmp_path, FILE_MODE)
+        _replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def atomic_copy(src, dst):
+    ensure_dir(dirname(dst))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname(dst), prefix=".tmp-")
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.chmod(tmp_path, FILE_MODE)
+        _replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return dst
+
+
+def update_file(path, data):
+    # keep timestamp of unchanged files, SCons and IDEs rely on it
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    if os.path.isfile(path):
+        with open(path, "rb") as fp:
+            if fp.read() == data:
+                return False
+    atomic_write(path, data)
+    return True
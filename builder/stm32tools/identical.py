@@ -0,0 +1,122 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Skip identical uploads
+
+Asks the target for a checksum of the programmed flash and compares it
+with the local image before uploading. OpenOCD calculates CRC on the
+target with "verify_image_checksum", BlackMagic probe answers the GDB
+"compare-sections" CRC requests. When the firmware is already on the
+target, it is only reset and flash is neither erased nor programmed.
+
+A raw ".bin" image is checked at "board_upload.offset_address" or at
+the load address from its segment manifest.
+
+Enable it with "board_upload.skip_identical = yes" in "platformio.ini",
+debug tools use it when the board manifest has "debug.skip_identical".
+"""
+
+import re
+import socket
+import subprocess
+
+from stm32tools import delta
+from stm32tools.helpers import TRUE_VALUES
+from stm32tools.openocd import OpenOCDError
+
+# the OpenOCD procedure used by debug tools, "$PROG_PATH" is substituted
+# by PlatformIO when the debug server is started
+OPENOCD_LOAD_PROC = (
+    "proc pio_load_if_changed {} {"
+    " if {[catch {verify_image_checksum {$PROG_PATH}}]} {"
+    " echo {Loading firmware...}; flash write_image erase {$PROG_PATH}"
+    " } else { echo {Firmware is up to date, skipping load} }"
+    " }")
+
+
+def is_enabled(env):
+    return str(env.BoardConfig().get(
+        "upload.skip_identical", "no")).strip().lower() in TRUE_VALUES
+
+
+def get_image_offset(env, image_path):
+    # OpenOCD reads a raw image at 0x0 unless the address is given
+    offset = env.BoardConfig().get("upload.offset_address", "")
+    if offset or not image_path.endswith(".bin"):
+        return offset
+    try:
+        return "0x%08x" % delta.get_image_address(image_path)
+    except (IOError, OSError, KeyError, ValueError):
+        return "0x%08x" % delta.FLASH_START
+
+
+def _run(env, args):
+    try:
+        process = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            env=env['ENV'])
+    except OSError:
+        return -1, ""
+    output = process.communicate()[0]
+    return process.returncode, output.decode("utf-8", "replace")
+
+
+def openocd_image_matches(env, openocd_args, image_path, offset=None):
+    # the target is reset and started when the image matches
+    check = "verify_image_checksum {%s}" % image_path
+    if offset:
+        check += " %s" % offset
+    args = [env.subst("$UPLOADER")] + list(openocd_args)
+    for command in ("init", "reset init", check, "reset run", "shutdown"):
+        args.extend(["-c", command])
+    returncode, _ = _run(env, args)
+    return returncode == 0
+
+
+def parse_compare_sections(output):
+    # "Section .text, range 0x8000000 -- 0x8001000: matched."
+    results = re.findall(r"^Section .+: (matched|MIS-MATCHED)", output,
+                         re.MULTILINE)
+    return bool(results) and all(r == "matched" for r in results)
+
+
+def blackmagic_image_matches(env, gdb_args, elf_path):
+    # exit status of batch GDB isn't reliable in old versions, the
+    # result is parsed from "compare-sections" output
+    args = [env.subst("$GDB"), "-nx", "--batch"]
+    for command in list(gdb_args) + ["compare-sections", "kill"]:
+        args.extend(["-ex", command])
+    args.append(elf_path)
+    returncode, output = _run(env, args)
+    return parse_compare_sections(output)
+
+
+def wrap_upload_action(env, upload_action, matches):
+    # "matches" is function(target, source, env) which returns True when
+    # the image is already on the target
+    def _upload_if_changed(target, source, env):
+        try:
+            identical = matches(target, source, env)
+        except (OpenOCDError, socket.error, EnvironmentError) as e:
+            # the upload reports a missing or busy probe itself
+            print("Warning! Cannot check firmware on the target: %s" % e)
+            identical = False
+        if identical:
+            print("Firmware on the target is identical, skipping upload")
+            return None
+        return upload_action(target, source, env)
+
+    return env.VerboseAction(_upload_if_changed,
+                             "Checking firmware on the target")
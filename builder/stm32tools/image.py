@@ -0,0 +1,235 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Firmware images
+
+Converts the firmware ELF into ".bin", ".hex" and a segment manifest in
+a single pass without spawning "objcopy". Loadable data which is farther
+than "board_build.image_max_padding" bytes (64 KiB by default) from the
+main image (option bytes, backup SRAM, the second flash bank, etc.) is
+written into a separate "<name>_0x<address>.bin" file instead of being
+padded into the main one. Uploaders of ".bin" program the main image
+only, the upload fails when separate images exist; such firmware is
+uploaded from the ELF by a debug tool (without "offset_address").
+
+The manifest lists every load segment with its address, length and
+CRC32 together with the file and offset where it is stored.
+
+Usage:
+    python -m stm32tools.image FIRMWARE.elf [OUTPUT_DIR]
+"""
+
+import json
+import sys
+import zlib
+from os.path import basename, join, splitext
+
+from stm32tools.elf import ELFFile
+from stm32tools.helpers import atomic_write, get_build_option
+
+DEFAULT_MAX_PADDING = 0x10000
+# the same gap fill as "objcopy -O binary"
+PADDING_BYTE = b"\x00"
+# sections which "objcopy -O ihex -R .eeprom" drops from the HEX file
+HEX_EXCLUDED_SECTIONS = (".eeprom", )
+
+
+def crc32(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+def group_chunks(chunks, max_padding):
+    # chunks separated by more than "max_padding" bytes go to separate
+    # images, returns list of lists of (address, data)
+    groups = []
+    for address, data in chunks:
+        if groups:
+            last_address, last_data = groups[-1][-1]
+            if address - (last_address + len(last_data)) <= max_padding:
+                groups[-1].append((address, data))
+                continue
+        groups.append([(address, data)])
+    return groups
+
+
+def get_main_group(groups, address=None):
+    # the group which contains the application start address, otherwise
+    # the largest one
+    for group in groups:
+        end = group[-1][0] + len(group[-1][1])
+        if address is not None and group[0][0] <= address < end:
+            return group
+    return max(groups, key=lambda g: sum(len(d) for _, d in g))
+
+
+def build_binary(group):
+    start = group[0][0]
+    content = bytearray()
+    for address, data in group:
+        content.extend(PADDING_BYTE * (address - start - len(content)))
+        content.extend(data)
+    return bytes(content)
+
+
+def _hex_record(record_type, address, data=b""):
+    items = bytearray([len(data), (address >> 8) & 0xFF, address & 0xFF,
+                       record_type]) + bytearray(data)
+    checksum = (-sum(items)) & 0xFF
+    return ":%s%02X" % ("".join("%02X" % b for b in items), checksum)
+
+
+def build_ihex(chunks, entry=None, record_size=16):
+    lines = []
+    upper = None
+    for address, data in chunks:
+        offset = 0
+        while offset < len(data):
+            current = address + offset
+            if current >> 16 != upper:
+                upper = current >> 16
+                lines.append(_hex_record(
+                    0x04, 0, bytearray([upper >> 8, upper & 0xFF])))
+            # a record never crosses 64 KiB boundary
+            size = min(record_size, len(data) - offset,
+                       0x10000 - (current & 0xFFFF))
+            lines.append(_hex_record(
+                0x00, current & 0xFFFF, data[offset:offset + size]))
+            offset += size
+    if entry:
+        lines.append(_hex_record(0x05, 0, bytearray(
+            [(entry >> 24) & 0xFF, (entry >> 16) & 0xFF,
+             (entry >> 8) & 0xFF, entry & 0xFF])))
+    lines.append(_hex_record(0x01, 0))
+    # CRLF line endings as "objcopy -O ihex"
+    return "\r\n".join(lines) + "\r\n"
+
+
+def get_extra_image_path(bin_path, address):
+    base, suffix = splitext(bin_path)
+    return "%s_0x%08x%s" % (base, address, suffix)
+
+
+def convert(elf_path, bin_path=None, hex_path=None, manifest_path=None,
+            max_padding=DEFAULT_MAX_PADDING, main_address=None):
+    # returns the manifest, "bin_path" receives the main image and the
+    # rest of images are stored next to it
+    elf = ELFFile(elf_path)
+    manifest = dict(entry=elf.entry, images=[], segments=[])
+
+    if bin_path or manifest_path:
+        chunks = elf.get_load_chunks()
+        groups = group_chunks(chunks, max_padding) if chunks else []
+        main_group = get_main_group(groups, main_address) if groups else None
+        for group in groups:
+            image_path = bin_path or splitext(elf_path)[0] + ".bin"
+            if group is not main_group:
+                image_path = get_extra_image_path(image_path, group[0][0])
+            content = build_binary(group)
+            if bin_path:
+                atomic_write(image_path, content)
+            manifest['images'].append(dict(
+                file=basename(image_path), address=group[0][0],
+                length=len(content), crc32=crc32(content),
+                padding=len(content) - sum(len(d) for _, d in group)))
+            for address, data in group:
+                manifest['segments'].append(dict(
+                    address=address, length=len(data), crc32=crc32(data),
+                    file=basename(image_path),
+                    offset=address - group[0][0]))
+
+    if hex_path:
+        atomic_write(hex_path, build_ihex(
+            elf.get_load_chunks(HEX_EXCLUDED_SECTIONS), elf.entry))
+
+    if manifest_path:
+        atomic_write(manifest_path,
+                     json.dumps(manifest, indent=2, sort_keys=True))
+    return manifest
+
+
+def _get_main_address(env):
+    return int(str(env.BoardConfig().get(
+        "upload.offset_address", "0x08000000")), 0)
+
+
+def _get_max_padding(env):
+    return int(str(get_build_option(
+        env, "image_max_padding", DEFAULT_MAX_PADDING)), 0)
+
+
+def get_side_images(bin_path):
+    # ".hex" and the manifest are produced together with ".bin"
+    base = splitext(bin_path)[0]
+    return [base + ".hex", base + ".segments.json"]
+
+
+def ElfToImages(target, source, env):
+    bin_path = target[0].get_abspath()
+    base = splitext(bin_path)[0]
+    manifest = convert(
+        source[0].get_abspath(), bin_path, base + ".hex",
+        base + ".segments.json", _get_max_padding(env),
+        _get_main_address(env))
+    for image in manifest['images']:
+        if image['file'] != basename(bin_path):
+            print("Warning! Loadable data at 0x%08x is too far from the "
+                  "main image, it is stored in %s" % (
+                      image['address'], image['file']))
+
+
+def get_extra_images(manifest_path, bin_name):
+    # images which are stored next to the main one
+    try:
+        with open(manifest_path) as fp:
+            manifest = json.load(fp)
+    except (IOError, ValueError):
+        return []
+    return [item for item in manifest.get("images", [])
+            if item['file'] != bin_name]
+
+
+def CheckSplitImages(target, source, env):
+    bin_path = source[0].get_abspath()
+    extra = get_extra_images(splitext(bin_path)[0] + ".segments.json",
+                             basename(bin_path))
+    if not extra:
+        return None
+    sys.stderr.write(
+        "Error: The upload protocol programs only %s, loadable data is "
+        "also stored in %s. Upload the ELF with a debug tool or increase "
+        "\"board_build.image_max_padding\"\n" % (
+            basename(bin_path), ", ".join(i['file'] for i in extra)))
+    return 1
+
+
+def ElfToHexImage(target, source, env):
+    convert(source[0].get_abspath(), hex_path=target[0].get_abspath())
+
+
+def main(argv):
+    if len(argv) < 2:
+        sys.stderr.write(__doc__.split("Usage:")[1])
+        return 1
+    output_dir = argv[2] if len(argv) > 2 else None
+    base = splitext(argv[1])[0]
+    if output_dir:
+        base = join(output_dir, basename(base))
+    print(json.dumps(convert(argv[1], base + ".bin", base + ".hex",
+                             base + ".segments.json"), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,105 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Include scanner
+
+Collects names of headers included by sources of a project, its tests
+and libraries. Every "#include" line counts, also inside conditional
+blocks, so the result is a superset of what the compiler reads. The
+includes of every file are cached by its modification time and size in
+the build directory.
+"""
+
+import json
+import os
+import re
+from os.path import basename, expanduser, isdir, isfile, join
+
+from stm32tools.helpers import atomic_write
+
+INCLUDE_RE = re.compile(r"^\s*#\s*include\s*[<\"]([^>\"]+)[>\"]",
+                        re.MULTILINE)
+HEADER_SUFFIXES = (".h", ".hh", ".hpp", ".hxx")
+SOURCE_SUFFIXES = (".c", ".cc", ".cpp", ".cxx", ".s", ".S", ".ino",
+                   ".pde") + HEADER_SUFFIXES
+
+
+def get_includes(path):
+    # header names without directories, "../lsm6ds0/lsm6ds0.h" is found
+    # by the owner of "lsm6ds0.h"
+    try:
+        with open(path, "rb") as fp:
+            content = fp.read().decode("utf-8", "replace")
+    except (IOError, OSError):
+        return []
+    return sorted(set(basename(name) for name in INCLUDE_RE.findall(content)))
+
+
+def walk_sources(path):
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(SOURCE_SUFFIXES):
+                yield join(root, name)
+
+
+def _is_excluded(path, exclude):
+    return any(path == p or path.startswith(p + os.sep) for p in exclude)
+
+
+def scan_includes(dirs, cache_path, exclude=None):
+    # a no-op build reads only the directory trees
+    cache = {}
+    if isfile(cache_path):
+        try:
+            with open(cache_path) as fp:
+                cache = json.load(fp)
+        except (IOError, ValueError):
+            cache = {}
+    files = {}
+    result = set()
+    for path in [p for d in dirs if isdir(d) for p in walk_sources(d)]:
+        if exclude and _is_excluded(path, exclude):
+            continue
+        stat = os.stat(path)
+        state = "%d:%d" % (stat.st_mtime, stat.st_size)
+        item = cache.get(path)
+        if not item or item[0] != state:
+            item = [state, get_includes(path)]
+        files[path] = item
+        result.update(item[1])
+    if files != cache:
+        atomic_write(cache_path, json.dumps(files, separators=(",", ":")))
+    return result
+
+
+def get_project_dirs(env):
+    # sources and tests of the project, its libraries ("lib_dir",
+    # "lib_extra_dirs") and libraries installed from "lib_deps"; the
+    # global storage and storages of framework packages are left to the
+    # library dependency finder
+    dirs = [env.subst(d) for d in (
+        "$PROJECT_SRC_DIR", "$PROJECT_INCLUDE_DIR", "$PROJECT_TEST_DIR",
+        "$PROJECT_LIB_DIR", join("$PROJECT_LIBDEPS_DIR", "$PIOENV"))]
+    for path in env.GetProjectOption("lib_extra_dirs", []):
+        path = join(env.subst("$PROJECT_DIR"),
+                    expanduser(env.subst(path.strip())))
+        if path not in dirs:
+            dirs.append(path)
+    return dirs
+
+
+def get_project_includes(env, extra_dirs=None):
+    return scan_includes(get_project_dirs(env) + list(extra_dirs or []),
+                         env.subst(join("$BUILD_DIR", "includes.json")))
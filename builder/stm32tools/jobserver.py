@@ -0,0 +1,113 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shared job slots
+
+A pool of tokens served over a localhost TCP socket which limits the
+number of tools (compiler, archiver, linker) running at the same time in
+several concurrent builds. A client connects, gets one byte when a token
+is free and returns the token by closing the connection, so a crashed
+build never leaks it.
+
+Builds started with PLATFORMIO_STM32_JOBSERVER=host:port take a token for
+every spawned command (see "stm32tools.matrix").
+"""
+
+import os
+import socket
+import threading
+from contextlib import contextmanager
+
+ENV_NAME = "PLATFORMIO_STM32_JOBSERVER"
+TOKEN = b"+"
+
+
+class JobServer(object):
+
+    def __init__(self, tokens, host="127.0.0.1"):
+        self.tokens = tokens
+        self._slots = threading.Semaphore(tokens)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind((host, 0))
+        self._socket.listen(128)
+        self.address = "%s:%d" % self._socket.getsockname()[:2]
+        self._thread = None
+
+    def _serve_client(self, conn):
+        with self._slots:
+            try:
+                conn.sendall(TOKEN)
+                # blocks until the client closes the connection
+                while conn.recv(64):
+                    pass
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._socket.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._serve_client,
+                                      args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._socket.close()
+
+
+@contextmanager
+def acquire(address):
+    # without a reachable server the command runs right away
+    sock = None
+    try:
+        host, port = address.rsplit(":", 1)
+        sock = socket.create_connection((host, int(port)))
+        if sock.recv(1) != TOKEN:
+            sock.close()
+            sock = None
+    except (ValueError, socket.error):
+        if sock:
+            sock.close()
+        sock = None
+    try:
+        yield
+    finally:
+        if sock:
+            sock.close()
+
+
+def generate(env):
+    address = os.environ.get(ENV_NAME)
+    if not address:
+        return env
+    spawn = env['SPAWN']
+
+    def _spawn(sh, escape, cmd, args, spawn_env):
+        with acquire(address):
+            return spawn(sh, escape, cmd, args, spawn_env)
+
+    env['SPAWN'] = _spawn
+    return env
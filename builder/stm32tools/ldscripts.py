@@ -0,0 +1,164 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Linker scripts
+
+Linker scripts generated from the framework templates are stored in a
+content-addressed cache (template hash, RAM and flash sizes) instead of
+the shared framework package, a "<MCU>_DEFAULT.ld" shipped with the
+framework is used as is. Scripts are written atomically and never
+rewritten, so parallel builds can share one package installation.
+
+Scripts which require the C preprocessor get only the macros they
+reference, the result is cached by the script content, these macros and
+the contents of files pulled in by "#include" and "INCLUDE".
+"""
+
+import re
+from os.path import dirname, isfile, join
+from string import Template
+
+from stm32tools.helpers import (atomic_copy, atomic_write, calculate_hash,
+                                get_cache_dir)
+
+COMMENTS_RE = re.compile(r"/\*.*?\*/|//[^\n]*", re.DOTALL)
+IDENTIFIER_RE = re.compile(r"[A-Za-z_]\w*")
+# "#include" of the preprocessor, "INCLUDE" of the linker
+INCLUDE_RE = re.compile(
+    r"^\s*#\s*include\s*[<\"]([^>\"]+)[>\"]|\bINCLUDE\s+\"?([^\s\";]+)",
+    re.MULTILINE)
+
+
+def generate_default_ldscript(env, template_file, name):
+    # a script shipped with the framework next to the "tpl" folder wins
+    packaged = join(dirname(dirname(template_file)), name)
+    if isfile(packaged):
+        return packaged
+
+    ram = env.BoardConfig().get("upload.maximum_ram_size", 0)
+    flash = env.BoardConfig().get("upload.maximum_size", 0)
+    with open(template_file) as fp:
+        template = fp.read()
+
+    key = calculate_hash(template, ram, flash)
+    ldscript = join(get_cache_dir(env, "ldscripts", key[:2], key), name)
+    if isfile(ldscript):
+        return ldscript
+
+    content = Template(template).substitute(
+        stack=hex(0x20000000 + ram),  # 0x20000000 - start address for RAM
+        ram=str(int(ram / 1024)) + "K",
+        flash=str(int(flash / 1024)) + "K"
+    )
+    atomic_write(ldscript, content)
+    return ldscript
+
+
+def get_referenced_names(content):
+    return set(IDENTIFIER_RE.findall(COMMENTS_RE.sub(" ", content)))
+
+
+def _get_define_name(item):
+    if isinstance(item, (list, tuple)):
+        item = item[0]
+    return str(item).split("=", 1)[0].strip()
+
+
+def get_preprocessor_flags(env, content, defines=None):
+    # "defines" are passed unconditionally, the rest of CPPDEFINES only
+    # if referenced by the script
+    names = get_referenced_names(content)
+    cpp_defines = env.get("CPPDEFINES", [])
+    if not isinstance(cpp_defines, (list, tuple)):
+        cpp_defines = [cpp_defines]
+    used = [item for item in cpp_defines if _get_define_name(item) in names]
+    flags = env.Override(
+        {"CPPDEFINES": used + list(defines or [])}).subst("$_CPPDEFFLAGS")
+    if "#include" in content:
+        flags += " " + env.subst("$_CPPINCFLAGS")
+    return flags
+
+
+def _get_search_dirs(env, name):
+    result = []
+    for item in env.Flatten(env.get(name, [])):
+        path = getattr(item, "abspath", None) or env.subst(str(item))
+        if path:
+            result.append(path)
+    return result
+
+
+def get_included_files(env, path, found=None):
+    # files included by the script, recursively; "#include" is looked up
+    # in CPPPATH, "INCLUDE" in LIBPATH, both next to the including file
+    # first
+    found = [] if found is None else found
+    if not isfile(path):
+        return found
+    with open(path) as fp:
+        content = COMMENTS_RE.sub(" ", fp.read())
+    for match in INCLUDE_RE.finditer(content):
+        name = match.group(1) or match.group(2)
+        for search_dir in [dirname(path)] + _get_search_dirs(
+                env, "CPPPATH" if match.group(1) else "LIBPATH"):
+            included = join(search_dir, name)
+            if isfile(included):
+                if included not in found:
+                    found.append(included)
+                    get_included_files(env, included, found)
+                break
+    return found
+
+
+def _get_preprocessor(env):
+    return env.subst("$GDB").replace("-gdb", "-cpp")
+
+
+def preprocess_ldscript(env, target, source, defines=None):
+    source = env.subst(source)
+    content = ""
+    if isfile(source):
+        with open(source) as fp:
+            content = fp.read()
+    flags = get_preprocessor_flags(env, content, defines)
+    platform = env.PioPlatform()
+    toolchain = "%s@%s" % (
+        "toolchain-gccarmnoneeabi",
+        platform.get_package_version("toolchain-gccarmnoneeabi"))
+
+    def _preprocess(target, source, env):
+        items = [toolchain, flags]
+        for path in [source[0].abspath] + get_included_files(
+                env, source[0].abspath):
+            with open(path) as fp:
+                items.append(fp.read())
+        key = calculate_hash(*items)
+        cached = join(get_cache_dir(env, "ldscripts", key[:2], key),
+                      "preproc.ld")
+        if not isfile(cached):
+            if env.Execute(env.Action('"%s" -E -P %s "%s" -o "%s"' % (
+                    _get_preprocessor(env), flags, source[0].abspath,
+                    target[0].abspath), None)):
+                return 1
+            atomic_copy(target[0].abspath, cached)
+        else:
+            atomic_copy(cached, target[0].abspath)
+        return None
+
+    # the flags are a source, unrelated defines don't trigger a relink
+    return env.Command(
+        target, [source, env.Value(toolchain + " " + flags)] +
+        get_included_files(env, source),
+        env.VerboseAction(_preprocess, "Generating LD script $TARGET"))
@@ -0,0 +1,372 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Framework library cache
+
+Persistent, content-addressed store of prebuilt framework archives and
+objects. Entries are keyed by the framework package version, the MCU and
+the fully expanded compiler flags, so projects and CI jobs which target
+the same MCU link the stored archive instead of rebuilding it.
+
+Enable it with "board_build.framework_cache = yes" in "platformio.ini"
+(or PLATFORMIO_STM32_FRAMEWORK_CACHE=yes), the store location can be
+changed with "board_build.cache_dir".
+
+A build which misses an entry claims it while the library is compiled,
+concurrent builds of the same library (e.g. "stm32tools.matrix") wait
+for the entry instead of compiling it once more.
+
+Flags of the environment change after framework scripts (debug flags,
+"build_unflags"), so cached libraries are looked up and built when the
+program is created: archives are returned as nodes in the build
+directory, objects are added to the sources of the program.
+"""
+
+import atexit
+import json
+import os
+import socket
+import time
+from os.path import (basename, dirname, getmtime, isdir, isfile, join,
+                     realpath, relpath)
+
+from stm32tools import buildtrace, unity
+from stm32tools.helpers import (FILE_MODE, atomic_copy, atomic_write,
+                                calculate_hash, ensure_dir, get_build_flag,
+                                get_cache_dir)
+
+# bump when the layout of cache entries or the key changes
+CACHE_FORMAT = 1
+
+HEADER_SUFFIXES = (".h", ".hh", ".hpp", ".hxx", ".inc")
+MANIFEST_NAME = "manifest.json"
+CLAIM_NAME = "claim.json"
+# a claim older than this is left by a build which hangs
+CLAIM_TIMEOUT = 1800
+
+_claims = set()
+# cached libraries which are built when the program is created
+_pending = []
+
+
+def is_enabled(env):
+    return get_build_flag(env, "framework_cache")
+
+
+def _get_package_dirs(env):
+    platform = env.PioPlatform()
+    result = []
+    for name in platform.packages:
+        pkg_dir = platform.get_package_dir(name)
+        if pkg_dir and isdir(pkg_dir):
+            result.append(
+                (realpath(pkg_dir), "%s@%s" % (
+                    name, platform.get_package_version(name))))
+    # the most specific package first
+    return sorted(result, key=lambda item: len(item[0]), reverse=True)
+
+
+def _normalize_path(path, package_dirs):
+    path = realpath(path)
+    for pkg_dir, pkg_id in package_dirs:
+        if path == pkg_dir or path.startswith(pkg_dir + os.sep):
+            return "<%s>/%s" % (pkg_id, relpath(path, pkg_dir).replace(
+                os.sep, "/"))
+    return None
+
+
+def _get_tree_digest(path, suffixes=None):
+    items = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if suffixes and not name.lower().endswith(suffixes):
+                continue
+            file_path = join(root, name)
+            with open(file_path, "rb") as fp:
+                items.extend([relpath(file_path, path), fp.read()])
+    return calculate_hash(*items)
+
+
+def get_include_paths(env):
+    result = []
+    for item in env.Flatten(env.get("CPPPATH", [])):
+        path = getattr(item, "abspath", None) or env.subst(str(item))
+        if path:
+            result.append(path)
+    return result
+
+
+def get_cache_key(env, src_dir, src_filter=None):
+    package_dirs = _get_package_dirs(env)
+    src_dir = env.subst(src_dir)
+    items = [
+        CACHE_FORMAT,
+        env.BoardConfig().get("build.mcu", ""),
+        # sources outside of the packages are identified by their contents
+        (_normalize_path(src_dir, package_dirs) or
+         _get_tree_digest(src_dir)),
+        src_filter or "",
+        env.subst("$CCFLAGS $CFLAGS $CXXFLAGS $ASFLAGS"),
+        env.subst("$_CPPDEFFLAGS")
+    ]
+    for pkg_dir, pkg_id in package_dirs:
+        if pkg_id.startswith("toolchain-"):
+            items.append(pkg_id)
+    if unity.is_enabled(env):
+        items.extend(unity.get_signature(env))
+
+    for path in get_include_paths(env):
+        normalized = _normalize_path(path, package_dirs)
+        if normalized:
+            items.append(normalized)
+        elif isdir(path):
+            # project specific directories (configuration headers, etc.)
+            items.append(_get_tree_digest(path, HEADER_SUFFIXES))
+        else:
+            items.append(path)
+
+    return calculate_hash(*items)
+
+
+def _get_entry_dir(env, key):
+    return join(get_cache_dir(env, "frameworks", key[:2]), key)
+
+
+def _load_manifest(entry_dir):
+    manifest_path = join(entry_dir, MANIFEST_NAME)
+    if not isfile(manifest_path):
+        return None
+    try:
+        with open(manifest_path) as fp:
+            manifest = json.load(fp)
+    except ValueError:
+        return None
+    if not all(isfile(join(entry_dir, f)) for f in manifest['files']):
+        return None
+    return manifest
+
+
+def _release_claim(entry_dir):
+    claim_path = join(entry_dir, CLAIM_NAME)
+    if claim_path in _claims:
+        _claims.discard(claim_path)
+        if isfile(claim_path):
+            os.remove(claim_path)
+
+
+def _release_claims():
+    # libraries which weren't compiled (failed or interrupted build)
+    for claim_path in list(_claims):
+        _release_claim(dirname(claim_path))
+
+
+atexit.register(_release_claims)
+
+
+def _claim_entry(entry_dir):
+    claim_path = join(ensure_dir(entry_dir), CLAIM_NAME)
+    try:
+        fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                     FILE_MODE)
+    except OSError:
+        return False
+    with os.fdopen(fd, "w") as fp:
+        json.dump(dict(pid=os.getpid(), host=socket.gethostname()), fp)
+    _claims.add(claim_path)
+    return True
+
+
+def _is_claim_alive(claim_path):
+    try:
+        with open(claim_path) as fp:
+            claim = json.load(fp)
+        if time.time() - getmtime(claim_path) > CLAIM_TIMEOUT:
+            return False
+    except (IOError, OSError, ValueError):
+        # released or just being written
+        return isfile(claim_path)
+    if claim.get("host") != socket.gethostname() or os.name == "nt":
+        return True
+    try:
+        os.kill(claim['pid'], 0)
+    except OSError:
+        return False
+    return True
+
+
+def _acquire_entry(entry_dir):
+    # returns the manifest of a complete entry, otherwise None and the
+    # entry is claimed by this build when possible
+    manifest = _load_manifest(entry_dir)
+    if manifest or _claim_entry(entry_dir):
+        return manifest
+    claim_path = join(entry_dir, CLAIM_NAME)
+    print("Waiting for %s compiled by another build" % entry_dir)
+    while _is_claim_alive(claim_path):
+        time.sleep(0.5)
+        manifest = _load_manifest(entry_dir)
+        if manifest:
+            return manifest
+    manifest = _load_manifest(entry_dir)
+    if not manifest:
+        # the other build failed, compile it here
+        if isfile(claim_path) and not _is_claim_alive(claim_path):
+            try:
+                os.remove(claim_path)
+            except OSError:
+                pass
+        _claim_entry(entry_dir)
+    return manifest
+
+
+def _store_entry(entry_dir, files, kind):
+    # "files" is a list of tuples (path, name inside entry)
+    for path, name in files:
+        atomic_copy(path, join(entry_dir, name))
+    # the manifest is written last, it marks the entry as complete
+    atomic_write(
+        join(entry_dir, MANIFEST_NAME),
+        json.dumps(dict(kind=kind, files=[name for _, name in files])))
+    _release_claim(entry_dir)
+
+
+def _add_store_command(env, variant_dir, source, action):
+    # the entry is missing, so it's stored also when the library is up to
+    # date (a build of another project or a cleaned cache); the claim is
+    # released by the action
+    stamp = env.Command(join(variant_dir, "framework-cache.stamp"), source,
+                        action)
+    env.AlwaysBuild(stamp)
+    env.Depends("$BUILD_DIR/$PROGNAME$PROGSUFFIX", stamp)
+    return stamp
+
+
+def get_library_path(env, variant_dir):
+    # the archive of "BuildLibrary"
+    return env.subst(join(dirname(variant_dir), "${LIBPREFIX}%s${LIBSUFFIX}" %
+                          basename(variant_dir)))
+
+
+def _copy_entry_file(target, source, env):
+    atomic_copy(source[0].get_abspath(), target[0].get_abspath())
+
+
+def _build_framework_library(env, variant_dir, src_dir, src_filter=None):
+    env.ProcessUnFlags(env.get("BUILD_UNFLAGS"))
+    lib_path = get_library_path(env, variant_dir)
+    entry_dir = _get_entry_dir(env, get_cache_key(env, src_dir, src_filter))
+    manifest = _acquire_entry(entry_dir)
+    if manifest:
+        return env.Command(
+            lib_path, join(entry_dir, manifest['files'][0]),
+            env.VerboseAction(_copy_entry_file, "Using cached $SOURCE"))
+
+    lib = env.StaticLibrary(
+        lib_path, env.CollectBuildFiles(variant_dir, src_dir, src_filter))
+
+    def _store_library(target, source, env):
+        _store_entry(entry_dir, [(source[0].abspath,
+                                  basename(source[0].abspath))], "library")
+        with open(target[0].abspath, "w") as fp:
+            fp.write(entry_dir)
+
+    _add_store_command(env, variant_dir, lib, env.VerboseAction(
+        _store_library, "Caching $SOURCE"))
+    return lib
+
+
+def _build_framework_sources(env, variant_dir, src_dir, src_filter=None):
+    env.ProcessUnFlags(env.get("BUILD_UNFLAGS"))
+    entry_dir = _get_entry_dir(env, get_cache_key(env, src_dir, src_filter))
+    manifest = _acquire_entry(entry_dir)
+    if manifest:
+        return [env.File(join(entry_dir, f)) for f in manifest['files']]
+
+    objects = unity.build_objects(env, variant_dir, src_dir, src_filter)
+
+    def _store_objects(target, source, env):
+        root = env.Dir(variant_dir).abspath
+        _store_entry(entry_dir, [
+            (node.abspath, relpath(node.abspath, root).replace(os.sep, "/"))
+            for node in source
+        ], "objects")
+        with open(target[0].abspath, "w") as fp:
+            fp.write(entry_dir)
+
+    _add_store_command(env, variant_dir, objects, env.VerboseAction(
+        _store_objects, "Caching objects of $TARGET"))
+    return objects
+
+
+def build_pending():
+    # called when the program is created, returns objects to link
+    objects = []
+    while _pending:
+        build, env, variant_dir, src_dir, src_filter = _pending.pop(0)
+        with buildtrace.span(basename(env.subst(variant_dir))):
+            nodes = build(env, variant_dir, src_dir, src_filter)
+        if build is _build_framework_sources:
+            objects.extend(nodes)
+    return objects
+
+
+def BuildFrameworkLibrary(env, variant_dir, src_dir, src_filter=None):
+    if not is_enabled(env):
+        with buildtrace.span(basename(env.subst(variant_dir))):
+            return env.BuildLibrary(variant_dir, src_dir, src_filter)
+    _pending.append((_build_framework_library, env, variant_dir, src_dir,
+                     src_filter))
+    return env.File(get_library_path(env, variant_dir))
+
+
+def BuildFrameworkSources(env, variant_dir, src_dir, src_filter=None):
+    if not is_enabled(env):
+        with buildtrace.span(basename(env.subst(variant_dir))):
+            if not unity.is_enabled(env):
+                return env.BuildSources(variant_dir, src_dir, src_filter)
+            from SCons.Script import DefaultEnvironment
+            objects = unity.build_objects(env, variant_dir, src_dir,
+                                          src_filter)
+            DefaultEnvironment().Append(PIOBUILDFILES=objects)
+            return objects
+    # the objects are added to the program
+    _pending.append((_build_framework_sources, env, variant_dir, src_dir,
+                     src_filter))
+    return []
+
+
+def _wrap_program_emitter(env):
+    builder = env['BUILDERS']['Program']
+    if getattr(builder, "_framework_cache", False):
+        return
+    emitter = builder.emitter
+
+    def _emitter(target, source, env):
+        source = list(source) + build_pending()
+        if emitter:
+            return emitter(target, source, env)
+        return target, source
+
+    builder.emitter = _emitter
+    builder._framework_cache = True
+
+
+def generate(env):
+    env.AddMethod(BuildFrameworkLibrary)
+    env.AddMethod(BuildFrameworkSources)
+    if is_enabled(env):
+        _wrap_program_emitter(env)
+    return env
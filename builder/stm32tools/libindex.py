@@ -0,0 +1,173 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Framework library index
+
+Maps header names to libraries bundled with the Arduino framework and
+lists headers included by every library. The index is built once per
+framework package (version, location and library folders) and kept in
+the platform cache directory. Instead of scanning all library folders
+on every build, the libraries reachable from includes of the project
+are looked up in the index and only they are given to the library
+dependency finder.
+
+"board_build.framework_lib_index = no" passes the whole library folders
+to the library dependency finder as before.
+"""
+
+import json
+import os
+import re
+import sys
+from os.path import basename, isdir, isfile, join, splitext
+
+from stm32tools.helpers import (atomic_write, calculate_hash,
+                                get_build_flag, get_cache_dir)
+from stm32tools.includes import (HEADER_SUFFIXES, get_includes,
+                                 get_project_includes, walk_sources)
+
+# bump when the layout of the index changes
+INDEX_FORMAT = 1
+URL_RE = re.compile(r"^([a-z][a-z0-9+.-]*://|git@|file:)", re.IGNORECASE)
+
+
+def is_enabled(env):
+    return get_build_flag(env, "framework_lib_index", True)
+
+
+def _list_libraries(lib_dirs):
+    for lib_dir in lib_dirs:
+        if not isdir(lib_dir):
+            continue
+        for name in sorted(os.listdir(lib_dir)):
+            if isdir(join(lib_dir, name)) and not name.startswith("__"):
+                yield join(lib_dir, name)
+
+
+def get_signature(lib_dirs, version):
+    items = [INDEX_FORMAT, version]
+    for path in _list_libraries(lib_dirs):
+        items.extend([path, os.stat(path).st_mtime])
+    return calculate_hash(*items)
+
+
+def _get_public_dir(path):
+    # "src" of 1.5 libraries, the root folder of the legacy ones
+    return join(path, "src") if isdir(join(path, "src")) else path
+
+
+def build_index(lib_dirs):
+    libraries = []
+    headers = {}
+    for path in _list_libraries(lib_dirs):
+        names = set()
+        for source in walk_sources(path):
+            names.update(get_includes(source))
+        libraries.append(dict(path=path, includes=sorted(names)))
+        for source in walk_sources(_get_public_dir(path)):
+            if source.endswith(HEADER_SUFFIXES):
+                headers.setdefault(basename(source), []).append(path)
+    return dict(libraries=libraries, headers=headers)
+
+
+def load_index(lib_dirs, version, index_dir):
+    signature = get_signature(lib_dirs, version)
+    index_path = join(index_dir, signature + ".json")
+    if isfile(index_path):
+        try:
+            with open(index_path) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            pass
+    index = build_index(lib_dirs)
+    atomic_write(index_path, json.dumps(index, separators=(",", ":"),
+                                        sort_keys=True))
+    return index
+
+
+def _choose_library(header, paths):
+    # a library named after the header wins, otherwise the first one in
+    # order of the library folders
+    for path in paths:
+        if basename(path) == splitext(header)[0]:
+            return path
+    return paths[0]
+
+
+def resolve_libraries(index, includes):
+    # libraries of included headers and of their own includes
+    includes_by_path = dict(
+        (lib['path'], lib['includes']) for lib in index['libraries'])
+    result = []
+    pending = list(includes)
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen or name not in index['headers']:
+            continue
+        seen.add(name)
+        path = _choose_library(name, index['headers'][name])
+        if path not in result:
+            result.append(path)
+            pending.extend(includes_by_path.get(path, []))
+    return sorted(result)
+
+
+def parse_lib_dep(spec):
+    # the bare name of a "lib_deps" item the same way as the library
+    # dependency finder reads it: "SPI@1.0", "owner/Name", "Name=URL"
+    # and URL (the repository or archive name), None for library IDs
+    spec = spec.strip()
+    if spec.isdigit() or spec.lower().startswith("id="):
+        return None
+    if "=" in spec and not URL_RE.match(spec):
+        spec = spec.split("=", 1)[0].strip()
+    elif URL_RE.match(spec):
+        spec = spec.split("#", 1)[0].rstrip("/")
+        spec = re.sub(r"\.(git|zip|tar\.gz|tgz)$", "",
+                      spec.rsplit("/", 1)[-1].rsplit(":", 1)[-1])
+    return spec.split("@", 1)[0].strip().rsplit("/", 1)[-1].strip() or None
+
+
+def get_required_libraries(env, lib_dirs):
+    # bundled libraries which "lib_deps" asks for by name
+    names = set(
+        name.lower() for name in (
+            parse_lib_dep(d) for d in env.GetProjectOption("lib_deps", []))
+        if name)
+    return [p for p in _list_libraries(lib_dirs)
+            if basename(p).lower() in names]
+
+
+def configure_libraries(env, lib_dirs, version, extra_dirs=None):
+    if not is_enabled(env):
+        env.Append(LIBSOURCE_DIRS=lib_dirs)
+        return
+    from platformio import exception
+    from platformio.builder.tools.piolib import LibBuilderFactory
+    index = load_index(lib_dirs, version, get_cache_dir(env, "lib-index"))
+    paths = resolve_libraries(index, get_project_includes(env, extra_dirs))
+    for path in get_required_libraries(env, lib_dirs):
+        if path not in paths:
+            paths.append(path)
+    builders = []
+    for path in paths:
+        # the same as "GetLibBuilders" does for library storages
+        try:
+            builders.append(LibBuilderFactory.new(env, path))
+        except exception.InvalidJSONFile:
+            sys.stderr.write(
+                "Skip library with broken manifest: %s\n" % path)
+    env.Append(EXTRA_LIB_BUILDERS=builders)
@@ -0,0 +1,169 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Build matrix
+
+Builds all (or selected) environments of a project at the same time.
+Every build runs with as many SCons jobs as the machine has CPUs, but the
+tools they spawn share one pool of job slots (see "stm32tools.jobserver"),
+so idle cores of one environment (configuration, linking) are used by the
+others. The framework cache is enabled for all builds and a framework
+library which is the same in several environments (the same package,
+MCU and flags) is compiled by one of them only, the rest wait for it and
+link the cached copy.
+
+The status, firmware size and wall time of every environment are
+printed at the end and saved into "<build_dir>/matrix-report.json", the
+output of every build goes to "<build_dir>/matrix/<env>.log".
+
+Usage:
+    python -m stm32tools.matrix [-d PROJECT_DIR] [-e ENV ...] [-j JOBS]
+        [--builds BUILDS] [-- EXTRA "platformio run" ARGUMENTS]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from os.path import getmtime, isfile, join
+
+from stm32tools.helpers import atomic_write, ensure_dir
+from stm32tools.jobserver import ENV_NAME, JobServer
+
+
+def _get_config(project_dir):
+    # "default_envs", "extends", "workspace_dir" and "${...}" are handled
+    # the same way as by "platformio run"
+    from platformio.project.config import ProjectConfig
+    return ProjectConfig.get_instance(join(project_dir, "platformio.ini"))
+
+
+def get_project_envs(project_dir):
+    config = _get_config(project_dir)
+    return config.default_envs() or config.envs()
+
+
+def get_build_dir(project_dir):
+    from platformio import fs
+    # relative directories are resolved against the project directory
+    with fs.cd(project_dir):
+        return _get_config(project_dir).get_optional_dir("build")
+
+
+def _get_log_path(log_dir, env_name):
+    return join(log_dir, re.sub(r"[^\w.-]", "_", env_name) + ".log")
+
+
+def _load_size(build_dir, result):
+    # written by the size check of every build, a failed build may leave
+    # the one of the previous build
+    size_path = join(build_dir, result['env'], "size.json")
+    if not isfile(size_path) or (
+            result['returncode'] and getmtime(size_path) < result['started']):
+        return None
+    with open(size_path) as fp:
+        usage = json.load(fp)
+    return dict(program=usage.get("program_size"),
+                data=usage.get("data_size"))
+
+
+def build_env(project_dir, env_name, jobs, log_dir, environ, extra_args):
+    started = time.time()
+    args = [sys.executable, "-m", "platformio", "run", "-d", project_dir,
+            "-e", env_name, "-j", str(jobs)] + list(extra_args)
+    with open(_get_log_path(log_dir, env_name), "w") as log:
+        returncode = subprocess.call(args, stdout=log,
+                                     stderr=subprocess.STDOUT, env=environ)
+    return dict(env=env_name, returncode=returncode,
+                status="success" if returncode == 0 else "failed",
+                started=started, duration=round(time.time() - started, 3),
+                log=_get_log_path(log_dir, env_name))
+
+
+def run(project_dir, env_names, jobs, builds, extra_args=()):
+    build_dir = get_build_dir(project_dir)
+    log_dir = ensure_dir(join(build_dir, "matrix"))
+    server = JobServer(jobs).start()
+    environ = dict(os.environ)
+    environ[ENV_NAME] = server.address
+    environ.setdefault("PLATFORMIO_STM32_FRAMEWORK_CACHE", "yes")
+
+    started = time.time()
+    pool = ThreadPool(max(1, min(builds, len(env_names))))
+    try:
+        results = pool.map(lambda name: build_env(
+            project_dir, name, jobs, log_dir, environ, extra_args), env_names)
+    finally:
+        pool.close()
+        pool.join()
+        server.close()
+
+    for result in results:
+        result['size'] = _load_size(build_dir, result)
+    report = dict(jobs=jobs, duration=round(time.time() - started, 3),
+                  failed=len([r for r in results if r['returncode']]),
+                  envs=results)
+    atomic_write(join(build_dir, "matrix-report.json"),
+                 json.dumps(report, indent=2, sort_keys=True))
+    return report
+
+
+def print_report(report):
+    print("%-32s %-8s %10s %10s %9s" % ("Environment", "Status", "Flash",
+                                        "RAM", "Time"))
+    for result in report['envs']:
+        size = result['size'] or {}
+        print("%-32s %-8s %10s %10s %8.1fs" % (
+            result['env'], result['status'].upper(),
+            size.get("program", "-"), size.get("data", "-"),
+            result['duration']))
+    print("%d environment(s), %d failed in %.1fs with %d job slots" % (
+        len(report['envs']), report['failed'], report['duration'],
+        report['jobs']))
+
+
+def main(argv):
+    extra_args = []
+    if "--" in argv:
+        extra_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    parser = argparse.ArgumentParser(
+        prog="python -m stm32tools.matrix",
+        usage=__doc__.split("Usage:")[1].strip())
+    parser.add_argument("-d", "--project-dir", default=os.getcwd())
+    parser.add_argument("-e", "--environment", action="append", default=[])
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--builds", type=int, default=0)
+    args = parser.parse_args(argv[1:])
+
+    env_names = args.environment or get_project_envs(args.project_dir)
+    if not env_names:
+        sys.stderr.write("Error: No environments in %s\n" % join(
+            args.project_dir, "platformio.ini"))
+        return 1
+    report = run(args.project_dir, env_names, args.jobs,
+                 args.builds or args.jobs, extra_args)
+    print_report(report)
+    return 1 if report['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,143 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+MCU index
+
+Maps every MCU used by the platform boards to the framework specific
+files (startup file, variant directory, linker script). The index is
+built once per framework package version and board list and reused by
+the next builds, MCUs which cannot be resolved are reported when the
+index is built. MCUs of custom boards are resolved on their first use
+and added to the index.
+"""
+
+import json
+import os
+from os.path import isdir, isfile, join
+
+from stm32tools import boardindex
+from stm32tools.helpers import atomic_write, calculate_hash, get_cache_dir
+
+# bump when the resolving rules change
+INDEX_FORMAT = 3
+
+_LISTDIR_CACHE = {}
+
+
+def listdir(path):
+    if path not in _LISTDIR_CACHE:
+        _LISTDIR_CACHE[path] = sorted(os.listdir(path)) if isdir(path) else []
+    return _LISTDIR_CACHE[path]
+
+
+def normalize_mcu(mcu):
+    # "stm32f103c8t6" -> "stm32f103c8"
+    mcu = mcu.lower()
+    return mcu[:-2] if len(mcu) > 12 else mcu
+
+
+def match_part_number(mcu, names, prefix="", suffixes=("", )):
+    # "stm32f407vg" matches "stm32f407vg", "stm32f407vx", "stm32f407xg"
+    # and "stm32f407xx", the most specific name wins
+    mcu = normalize_mcu(mcu)
+    candidates = []
+    for name in names:
+        for suffix in suffixes:
+            if not name.startswith(prefix + mcu[0:9]) or not name.endswith(
+                    suffix) or len(name) != len(prefix) + 11 + len(suffix):
+                continue
+            part = name[len(prefix) + 9:len(prefix) + 11]
+            if all(c in (m, "x") for c, m in zip(part, mcu[9:11])):
+                candidates.append((part.count("x"), name))
+    return sorted(candidates)[0][1] if candidates else None
+
+
+def get_board_mcus(env, framework=None):
+    platform = env.PioPlatform()
+    boards = boardindex.load_index(
+        join(platform.get_dir(), "boards"), join(get_cache_dir(env),
+                                                 "boards.json"))
+    return sorted(set(
+        normalize_mcu(manifest['build']['mcu'])
+        for manifest in boards.values()
+        if manifest.get("build", {}).get("mcu") and (
+            not framework or framework in manifest.get("frameworks", []))))
+
+
+def get_boards_signature(env):
+    # names, sizes and modification times of the board manifests, the
+    # manifests are parsed only when the index is built
+    boards_dir = join(env.PioPlatform().get_dir(), "boards")
+    return boardindex.get_signature(boards_dir) if isdir(boards_dir) else ""
+
+
+class McuIndex(object):
+
+    def __init__(self, path, resolvers, data=None):
+        self.path = path
+        self.resolvers = resolvers
+        self.data = data or {}
+
+    def get(self, mcu, key):
+        mcu = normalize_mcu(mcu)
+        if mcu not in self.data:
+            # custom board, resolve it on the fly
+            self.data[mcu] = dict(
+                (name, resolver(mcu))
+                for name, resolver in self.resolvers.items())
+            self.save()
+        return self.data[mcu].get(key)
+
+    def get_unresolved(self, keys=None):
+        result = {}
+        for mcu, items in sorted(self.data.items()):
+            for key, value in items.items():
+                if value is None and (keys is None or key in keys):
+                    result.setdefault(key, []).append(mcu)
+        return result
+
+    def save(self):
+        # concurrent builds may drop custom MCUs of each other, they are
+        # resolved once more then
+        atomic_write(self.path, json.dumps(self.data, sort_keys=True))
+
+
+def load_index(env, package, resolvers, framework=None, required=None):
+    # "resolvers" maps an index key to a function which resolves it
+    # for MCU, keys from "required" are reported if cannot be resolved
+    platform = env.PioPlatform()
+    index_path = join(
+        get_cache_dir(env, "mcu-index"), "%s-%s-%s.json" % (
+            package, platform.get_package_version(package),
+            calculate_hash(INDEX_FORMAT, platform.version,
+                           sorted(resolvers), framework,
+                           get_boards_signature(env))[:10]))
+
+    if isfile(index_path):
+        try:
+            with open(index_path) as fp:
+                return McuIndex(index_path, resolvers, json.load(fp))
+        except ValueError:
+            pass
+
+    index = McuIndex(index_path, resolvers, dict(
+        (mcu, dict((name, resolver(mcu))
+                   for name, resolver in resolvers.items()))
+        for mcu in get_board_mcus(env, framework)))
+    for key, items in index.get_unresolved(required).items():
+        print("Warning! %s: cannot resolve %s for %s" % (
+            package, key, ", ".join(items)))
+    index.save()
+    return index
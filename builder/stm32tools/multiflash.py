@@ -0,0 +1,188 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Parallel flashing
+
+Flashes the same image to several targets at once, e.g. on production
+stations. The image is staged once, every target gets its own upload
+command (probe serial number for OpenOCD, port for BlackMagic, serial
+and DFU uploaders) and the commands run in a bounded pool of workers.
+Results, timing and output of every target are aggregated into a JSON
+report.
+
+Enable it with "board_upload.targets = SERIAL1, SERIAL2, ..." in
+"platformio.ini" (or PLATFORMIO_STM32_UPLOAD_TARGETS), the number of
+concurrent uploads is set with "board_upload.parallel_jobs". Every
+target is programmed with the whole image, delta flashing, identical
+image checks and OpenOCD sessions apply to single target uploads only.
+DFU uploaders find the device by its USB VID:PID which all targets
+share, so they run one at a time. Output of every upload goes to the
+log of its target.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from os.path import basename, isfile, join, splitext
+
+from stm32tools.helpers import atomic_copy, atomic_write, ensure_dir
+from stm32tools.image import crc32
+
+# OpenOCD commands which select the probe by its serial number
+OPENOCD_SERIAL_COMMANDS = {
+    "stlink": "hla_serial %s",
+    "cmsis-dap": "cmsis_dap_serial %s",
+    "jlink": "jlink serial %s"
+}
+# uploaders which select the device by USB VID:PID
+SERIALIZED_PROTOCOLS = ("dfu", )
+
+
+def get_targets(env):
+    value = env.BoardConfig().get("upload.targets", "") or os.environ.get(
+        "PLATFORMIO_STM32_UPLOAD_TARGETS", "")
+    if isinstance(value, (list, tuple)):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [v.strip() for v in re.split(r"[,\s]+", value) if v.strip()]
+
+
+def get_jobs(env, targets):
+    if env.subst("$UPLOAD_PROTOCOL") in SERIALIZED_PROTOCOLS:
+        return 1
+    return max(1, int(env.BoardConfig().get(
+        "upload.parallel_jobs", len(targets))))
+
+
+def get_openocd_serial_command(protocol, serial):
+    return OPENOCD_SERIAL_COMMANDS.get(
+        protocol, "adapter serial %s") % serial
+
+
+def stage_image(image_path, stage_dir):
+    # uploads read a private copy, the build may change the original; the
+    # segment manifest holds the load address of ".bin"
+    manifest_path = splitext(image_path)[0] + ".segments.json"
+    if isfile(manifest_path):
+        atomic_copy(manifest_path, join(ensure_dir(stage_dir),
+                                        basename(manifest_path)))
+    return atomic_copy(image_path, join(ensure_dir(stage_dir),
+                                        basename(image_path)))
+
+
+def _get_log_path(log_dir, target):
+    return join(log_dir, re.sub(r"[^\w.-]", "_", target) + ".log")
+
+
+class ThreadOutput(object):
+
+    # "sys.stdout" and "sys.stderr" while targets are flashed, function
+    # commands of a worker thread write into the log of its target
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def _get_stream(self):
+        return getattr(self.local, "log", None) or self.stream
+
+    def write(self, data):
+        self._get_stream().write(data)
+
+    def flush(self):
+        self._get_stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _set_thread_log(log):
+    for stream in (sys.stdout, sys.stderr):
+        if isinstance(stream, ThreadOutput):
+            stream.local.log = log
+
+
+def flash_target(target, command, log_dir, environ=None):
+    # "command" is a list of arguments, a shell command or a
+    # function(target) which returns the exit code
+    started = time.time()
+    log_path = _get_log_path(log_dir, target)
+    try:
+        with open(log_path, "w") as log:
+            if callable(command):
+                _set_thread_log(log)
+                try:
+                    returncode = command(target)
+                finally:
+                    _set_thread_log(None)
+            else:
+                shell = not isinstance(command, (list, tuple))
+                log.write((command if shell else " ".join(command)) + "\n")
+                log.flush()
+                returncode = subprocess.call(
+                    command, shell=shell, stdout=log,
+                    stderr=subprocess.STDOUT, env=environ)
+        error = None
+    except Exception as e:  # pylint: disable=broad-except
+        returncode, error = -1, str(e)
+    return dict(target=target, returncode=returncode or 0,
+                status="success" if not returncode and not error else
+                "failed", error=error, log=log_path,
+                duration=round(time.time() - started, 3))
+
+
+def flash_targets(commands, jobs, log_dir, environ=None):
+    # "commands" is a list of (target, command), results keep the order
+    ensure_dir(log_dir)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = ThreadOutput(stdout), ThreadOutput(stderr)
+    pool = ThreadPool(max(1, min(jobs, len(commands))))
+    try:
+        return pool.map(
+            lambda item: flash_target(item[0], item[1], log_dir, environ),
+            commands)
+    finally:
+        pool.close()
+        pool.join()
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def run(commands, jobs, image_path, log_dir, report_path, environ=None):
+    # flashes all targets and writes the report, returns it
+    started = time.time()
+    results = flash_targets(commands, jobs, log_dir, environ)
+    with open(image_path, "rb") as fp:
+        image_crc32 = crc32(fp.read())
+    report = dict(
+        image=image_path, crc32="0x%08x" % image_crc32, jobs=jobs,
+        duration=round(time.time() - started, 3),
+        succeeded=len([r for r in results if r['status'] == "success"]),
+        failed=len([r for r in results if r['status'] != "success"]),
+        targets=results)
+    atomic_write(report_path, json.dumps(report, indent=2, sort_keys=True))
+    return report
+
+
+def print_report(report):
+    for result in report['targets']:
+        print("%-24s %-8s %7.2fs  %s" % (
+            result['target'], result['status'].upper(), result['duration'],
+            result['error'] or result['log']))
+    print("%d succeeded, %d failed in %.2fs" % (
+        report['succeeded'], report['failed'], report['duration']))
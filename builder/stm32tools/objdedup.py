@@ -0,0 +1,196 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Object deduplication
+
+Boards of the same MCU compile framework sources with the same flags
+except a few defines (ARDUINO_<BOARD>, BOARD_NAME, ...) which most files
+never read. Every compilation is keyed by the preprocessed translation
+unit together with the compiler and the command line without defines,
+include paths and output file. An object compiled by another environment
+of the project with the same key is copied instead of compiling it again,
+so only files whose preprocessed output differs are compiled.
+
+Enable it with "board_build.object_dedup = yes" in "platformio.ini" (or
+PLATFORMIO_STM32_OBJECT_DEDUP=yes), objects are kept in the platform
+cache directory ("board_build.cache_dir") which is trimmed to
+"board_build.object_dedup_size" megabytes (1024 by default) the same way
+as the local directory of "stm32tools.actioncache".
+"""
+
+import atexit
+import os
+import shlex
+import subprocess
+from os.path import basename, dirname, isfile, join, splitext
+
+from stm32tools.helpers import (atomic_write, calculate_file_hash,
+                                calculate_hash, get_build_flag,
+                                get_build_option, get_cache_dir)
+
+DEFAULT_SIZE = 1024
+SOURCE_SUFFIXES = (".c", ".cc", ".cpp", ".cxx", ".S")
+COMPILER_SUFFIXES = ("gcc", "g++", "cc", "c++")
+OPTIONS_WITH_VALUE = ("-o", "-I", "-D", "-U", "-include", "-imacros",
+                      "-isystem", "-iquote", "-idirafter", "-MF", "-MT",
+                      "-MQ", "-x")
+# options whose effect is in the preprocessed output
+PREPROCESSOR_OPTIONS = ("-I", "-D", "-U", "-include", "-imacros",
+                        "-isystem", "-iquote", "-idirafter")
+
+_compilers = {}
+_stats = dict(reused=0, compiled=0)
+
+
+def is_enabled(env):
+    return get_build_flag(env, "object_dedup")
+
+
+def split_args(args):
+    # SCons quotes arguments for the shell which runs the command
+    if os.name == "nt":
+        return [a[1:-1] if len(a) > 1 and a[0] == a[-1] == '"' else a
+                for a in args]
+    return shlex.split(" ".join(args))
+
+
+def parse_compile_command(argv):
+    # returns dict(output, source, options) of a "compiler -c" command
+    # which can be deduplicated, otherwise None
+    if not argv or not basename(argv[0]).endswith(COMPILER_SUFFIXES):
+        return None
+    if "-c" not in argv:
+        return None
+    output = None
+    sources = []
+    options = []
+    index = 1
+    while index < len(argv):
+        arg = argv[index]
+        if arg.startswith("-M") or arg in ("-E", "-S", "-"):
+            # dependency files and other outputs aren't deduplicated
+            return None
+        if arg in OPTIONS_WITH_VALUE and index + 1 < len(argv):
+            if arg == "-o":
+                output = argv[index + 1]
+            elif arg not in PREPROCESSOR_OPTIONS:
+                options.extend(argv[index:index + 2])
+            index += 2
+            continue
+        if arg.startswith("-o"):
+            output = arg[2:]
+        elif not arg.startswith("-"):
+            sources.append(arg)
+        elif not arg.startswith(PREPROCESSOR_OPTIONS):
+            options.append(arg)
+        index += 1
+    if not output or len(sources) != 1 or not sources[0].endswith(
+            SOURCE_SUFFIXES):
+        return None
+    return dict(output=output, source=sources[0], options=options)
+
+
+def get_preprocess_command(argv):
+    # the same command with "-E" to stdout instead of "-c -o OUTPUT"
+    result = []
+    index = 0
+    while index < len(argv):
+        if argv[index] == "-o":
+            index += 2
+            continue
+        if argv[index].startswith("-o"):
+            index += 1
+            continue
+        result.append("-E" if argv[index] == "-c" else argv[index])
+        index += 1
+    return result
+
+
+def _find_program(name, environ):
+    if dirname(name):
+        return name
+    for path in environ.get("PATH", "").split(os.pathsep):
+        for suffix in ("", ".exe"):
+            candidate = join(path, name + suffix)
+            if isfile(candidate):
+                return candidate
+    return name
+
+
+def get_compiler_id(name, environ):
+    # a toolchain update changes the compiler binary
+    if name not in _compilers:
+        path = _find_program(name, environ)
+        _compilers[name] = calculate_file_hash(path) if isfile(
+            path) else name
+    return _compilers[name]
+
+
+def get_key(argv, command, environ):
+    # returns None when the file can't be preprocessed, the compiler
+    # reports the error then
+    try:
+        process = subprocess.Popen(
+            get_preprocess_command(argv), stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, env=environ)
+    except OSError:
+        return None
+    output, _ = process.communicate()
+    if process.returncode != 0:
+        return None
+    return calculate_hash(
+        get_compiler_id(argv[0], environ), splitext(command['source'])[1],
+        *(command['options'] + [output]))
+
+
+def _print_stats():
+    if _stats['reused']:
+        print("Object deduplication: %d object(s) reused, %d compiled" % (
+            _stats['reused'], _stats['compiled']))
+
+
+def generate(env):
+    if not is_enabled(env):
+        return env
+    # "actioncache" reads commands with the functions of this module
+    from stm32tools.actioncache import DirectoryBackend
+    cache = DirectoryBackend(
+        get_cache_dir(env, "objects"),
+        int(get_build_option(env, "object_dedup_size", DEFAULT_SIZE)) *
+        1024 * 1024)
+    spawn = env['SPAWN']
+
+    def _spawn(sh, escape, cmd, args, spawn_env):
+        argv = split_args(args)
+        command = parse_compile_command(argv)
+        key = get_key(argv, command, spawn_env) if command else None
+        if not key:
+            return spawn(sh, escape, cmd, args, spawn_env)
+        data = cache.get(key)
+        if data is not None:
+            atomic_write(command['output'], data)
+            _stats['reused'] += 1
+            return 0
+        result = spawn(sh, escape, cmd, args, spawn_env)
+        if result == 0 and isfile(command['output']):
+            with open(command['output'], "rb") as fp:
+                cache.put(key, fp.read())
+            _stats['compiled'] += 1
+        return result
+
+    env['SPAWN'] = _spawn
+    atexit.register(_print_stats)
+    atexit.register(cache.evict)
+    return env
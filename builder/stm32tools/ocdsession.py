@@ -0,0 +1,348 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Persistent OpenOCD sessions
+
+One background OpenOCD server per probe is started on the first upload
+and reused by the next ones, the firmware is programmed over the TCL RPC
+port and debug sessions attach to the same GDB server. The server runs
+under a small supervisor which shuts it down after an idle timeout, the
+session state (ports, supervisor PID, last use) is kept in the platform
+cache directory. The session isn't idle while a client (GDB, an upload)
+is connected to it. The supervisor stops the server when it is
+terminated or when the state is taken over by another session.
+
+Enable it with "board_upload.openocd_session = yes" in "platformio.ini",
+"board_upload.openocd_idle_timeout" sets the idle timeout in seconds.
+
+Usage:
+    python -m stm32tools.ocdsession serve STATE.json IDLE_TIMEOUT -- \\
+        OPENOCD [ARGUMENTS ...]
+"""
+
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+from os.path import dirname, getmtime, isdir, isfile, join
+
+from stm32tools.helpers import (TRUE_VALUES, atomic_write, calculate_hash,
+                                ensure_dir, get_cache_dir)
+from stm32tools.openocd import (OpenOCDError, TclClient, get_server_args,
+                                wait_for_server)
+
+DEFAULT_IDLE_TIMEOUT = 600
+# every probe gets a pair of ports (TCL, GDB) in this range
+PORT_BASE = 51000
+PORT_SLOTS = 2000
+PROGRAM_TIMEOUT = 300
+
+
+def is_enabled(env):
+    return str(env.BoardConfig().get(
+        "upload.openocd_session", "no")).strip().lower() in TRUE_VALUES
+
+
+def get_idle_timeout(env):
+    return int(env.BoardConfig().get(
+        "upload.openocd_idle_timeout", DEFAULT_IDLE_TIMEOUT))
+
+
+def get_ports(probe_id, attempt=0):
+    # deterministic, so a debug tool knows the GDB port of the session
+    slot = (int(calculate_hash(probe_id)[:8], 16) + attempt) % PORT_SLOTS
+    return PORT_BASE + slot * 2, PORT_BASE + slot * 2 + 1
+
+
+def _is_port_free(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("localhost", port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def get_sessions_dir(cache_dir):
+    # "cache_dir" of get_cache_dir() or get_platform_cache_dir()
+    return join(cache_dir, "openocd-sessions")
+
+
+def get_state_path(env, probe_id):
+    return join(ensure_dir(get_sessions_dir(get_cache_dir(env))),
+                probe_id + ".json")
+
+
+def load_state(state_path):
+    if not isfile(state_path):
+        return None
+    try:
+        with open(state_path) as fp:
+            return json.load(fp)
+    except ValueError:
+        return None
+
+
+def find_gdb_port(sessions_dir, protocol):
+    # GDB port of the last used session of a probe of the protocol, the
+    # probe and the ports of a session are known only from its state
+    result = None
+    names = os.listdir(sessions_dir) if isdir(sessions_dir) else []
+    for name in names:
+        if not (name.startswith(protocol + "-") and name.endswith(".json")):
+            continue
+        state_path = join(sessions_dir, name)
+        state = load_state(state_path)
+        if not state or "gdb_port" not in state:
+            continue
+        mtime = getmtime(state_path)
+        if not result or mtime > result[0]:
+            result = (mtime, state['gdb_port'])
+    return result[1] if result else get_ports("%s-default" % protocol)[1]
+
+
+def touch_state(state_path):
+    # the modification time of the state is the last use of the session
+    os.utime(state_path, None)
+
+
+def is_healthy(state, host="localhost"):
+    try:
+        with TclClient(host, state['tcl_port'], timeout=2) as client:
+            client.checked_command("version")
+        return True
+    except (socket.error, OpenOCDError):
+        return False
+
+
+def stop_session(state_path, state=None, host="localhost"):
+    state = state or load_state(state_path)
+    if state:
+        try:
+            with TclClient(host, state['tcl_port'], timeout=2) as client:
+                client.command("shutdown")
+        except (socket.error, OpenOCDError):
+            # the server hangs, stop its supervisor (with the server, it
+            # leads the process group)
+            try:
+                if hasattr(os, "killpg"):
+                    os.killpg(state['pid'], signal.SIGTERM)
+                else:
+                    os.kill(state['pid'], signal.SIGTERM)
+            except OSError:
+                pass
+    if isfile(state_path):
+        os.remove(state_path)
+
+
+def start_session(state_path, probe_id, executable, arguments,
+                  idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=15):
+    attempt = 0
+    tcl_port, gdb_port = get_ports(probe_id)
+    while not (_is_port_free(tcl_port) and _is_port_free(gdb_port)):
+        attempt += 1
+        if attempt > 10:
+            raise OpenOCDError("Cannot find free ports for OpenOCD session")
+        tcl_port, gdb_port = get_ports(probe_id, attempt)
+
+    args = [sys.executable, "-m", "stm32tools.ocdsession", "serve",
+            state_path, str(idle_timeout), "--"] + get_server_args(
+                executable, arguments, tcl_port, gdb_port)
+    environ = dict(os.environ)
+    environ['PYTHONPATH'] = os.pathsep.join(
+        [dirname(dirname(os.path.abspath(__file__)))] +
+        [p for p in [environ.get("PYTHONPATH")] if p])
+    log = open(state_path[:-5] + ".log", "w")
+    kwargs = dict(env=environ, stdout=log, stderr=subprocess.STDOUT)
+    if os.name == "nt":
+        kwargs['creationflags'] = 0x00000008  # DETACHED_PROCESS
+    else:
+        kwargs['preexec_fn'] = os.setsid
+    try:
+        process = subprocess.Popen(args, **kwargs)
+    finally:
+        log.close()
+
+    state = dict(pid=process.pid, probe=probe_id, tcl_port=tcl_port,
+                 gdb_port=gdb_port, arguments=calculate_hash(*arguments),
+                 started=int(time.time()))
+    atomic_write(state_path, json.dumps(state))
+    try:
+        wait_for_server("localhost", tcl_port, timeout, process)
+    except OpenOCDError:
+        stop_session(state_path, state)
+        raise
+    return state
+
+
+def ensure_session(state_path, probe_id, executable, arguments,
+                   idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    # the running session is reused when it was started with the same
+    # arguments and still responds
+    state = load_state(state_path)
+    if state and state.get("arguments") == calculate_hash(
+            *arguments) and is_healthy(state):
+        touch_state(state_path)
+        return state
+    if state:
+        stop_session(state_path, state)
+    return start_session(state_path, probe_id, executable, arguments,
+                         idle_timeout)
+
+
+def program(client, image_path, offset=None, verify=True, reset=True):
+    command = "program {%s}" % image_path.replace(os.sep, "/")
+    if verify:
+        command += " verify"
+    if reset:
+        command += " reset"
+    if offset:
+        command += " %s" % offset
+    return client.checked_command(command)
+
+
+def image_matches(client, image_path, offset=None):
+    command = "verify_image_checksum {%s}" % image_path.replace(os.sep, "/")
+    if offset:
+        command += " %s" % offset
+    try:
+        client.checked_command("reset init")
+        client.checked_command(command)
+    except OpenOCDError:
+        return False
+    client.checked_command("reset run")
+    return True
+
+
+def connect(env, probe_id, executable, arguments):
+    # returns a client of the running (or just started) session
+    state_path = get_state_path(env, probe_id)
+    state = ensure_session(state_path, probe_id, executable, arguments,
+                           get_idle_timeout(env))
+    print("Using OpenOCD session at TCL port %d (GDB port %d)" % (
+        state['tcl_port'], state['gdb_port']))
+    return TclClient(port=state['tcl_port'], timeout=PROGRAM_TIMEOUT)
+
+
+def run_commands(client, commands):
+    # the same commands as for a standalone OpenOCD, the session is
+    # already initialized and keeps running
+    for command in commands:
+        if command not in ("init", "shutdown"):
+            client.checked_command(command)
+
+
+def get_arg_port(args, name):
+    # "-c", "tcl_port 51000" of get_server_args()
+    for arg in args:
+        match = re.match(r"^%s\s+(\d+)$" % name, arg.strip())
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def _get_tcp_lines():
+    if isfile("/proc/net/tcp"):
+        lines = []
+        for name in ("/proc/net/tcp", "/proc/net/tcp6"):
+            if isfile(name):
+                with open(name) as fp:
+                    lines.extend(fp.readlines()[1:])
+        return lines
+    try:
+        output = subprocess.check_output(["netstat", "-an"])
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    return output.decode("utf-8", "replace").splitlines()
+
+
+def has_clients(port):
+    # established TCP connections to a local port, OpenOCD doesn't tell
+    # whether GDB is attached
+    procfs = isfile("/proc/net/tcp")
+    for line in _get_tcp_lines():
+        items = line.split()
+        if procfs:
+            # "sl local_address rem_address st ...", state 01 is
+            # ESTABLISHED
+            if len(items) > 3 and items[3] == "01" and any(
+                    int(a.rsplit(":", 1)[1], 16) == port
+                    for a in items[1:3]):
+                return True
+        elif "ESTABLISHED" in items and any(
+                re.search(r"[:.]%d$" % port, a) for a in items):
+            return True
+    return False
+
+
+def _terminate(signum, frame):
+    # the "finally" block of serve() stops the server
+    raise SystemExit(1)
+
+
+def serve(state_path, idle_timeout, args):
+    # the ports are taken from the arguments, the state may already
+    # belong to the next session
+    tcl_port = get_arg_port(args, "tcl_port")
+    client_ports = [p for p in (tcl_port, get_arg_port(args, "gdb_port"))
+                    if p]
+    signal.signal(signal.SIGTERM, _terminate)
+    process = subprocess.Popen(args)
+    try:
+        while process.poll() is None:
+            time.sleep(1)
+            state = load_state(state_path)
+            if state is None or state.get("pid") != os.getpid():
+                # the session was replaced or stopped
+                break
+            if time.time() - getmtime(state_path) > idle_timeout:
+                if not any(has_clients(p) for p in client_ports):
+                    break
+                touch_state(state_path)
+    finally:
+        if process.poll() is None:
+            try:
+                with TclClient(port=tcl_port, timeout=2) as client:
+                    client.command("shutdown")
+                for _ in range(50):
+                    if process.poll() is not None:
+                        break
+                    time.sleep(0.1)
+            except (socket.error, OpenOCDError):
+                pass
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+        state = load_state(state_path)
+        if state and state.get("pid") == os.getpid():
+            os.remove(state_path)
+    return process.returncode
+
+
+def main(argv):
+    if len(argv) < 6 or argv[1] != "serve" or argv[4] != "--":
+        sys.stderr.write(__doc__.split("Usage:")[1])
+        return 1
+    return serve(argv[2], int(argv[3]), argv[5:])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,159 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+OpenOCD
+
+Client for the OpenOCD TCL RPC server and a helper which starts an OpenOCD
+server with the arguments from the board "debug.tools" configuration.
+"""
+
+import socket
+import subprocess
+import time
+
+DEFAULT_TCL_PORT = 6666
+COMMAND_TERMINATOR = b"\x1a"
+
+
+class OpenOCDError(Exception):
+    pass
+
+
+class TclClient(object):
+
+    def __init__(self, host="localhost", port=DEFAULT_TCL_PORT, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self._buffer = b""
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        if not self._sock:
+            self._sock = socket.create_connection(
+                (self.host, self.port), self.timeout)
+        return self
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+        self._buffer = b""
+
+    def command(self, cmd):
+        self.connect()
+        self._sock.sendall(cmd.encode("utf-8") + COMMAND_TERMINATOR)
+        while COMMAND_TERMINATOR not in self._buffer:
+            data = self._sock.recv(65536)
+            if not data:
+                self.close()
+                raise OpenOCDError("Connection closed by OpenOCD")
+            self._buffer += data
+        response, self._buffer = self._buffer.split(COMMAND_TERMINATOR, 1)
+        return response.decode("utf-8", "replace")
+
+    def checked_command(self, cmd):
+        # run a command through "catch" and raise an error if it fails
+        response = self.command(
+            "if {[catch {%s} _r]} {set _r \"error: $_r\"} "
+            "else {set _r}" % cmd)
+        if response.startswith("error: "):
+            raise OpenOCDError("%s: %s" % (cmd, response[7:]))
+        return response
+
+    def read_memory(self, address, count, width=32):
+        try:
+            response = self.checked_command(
+                "read_memory 0x%x %d %d" % (address, width, count))
+            return [int(v, 0) for v in response.split()]
+        except OpenOCDError:
+            # OpenOCD < 0.11 doesn't have "read_memory" command
+            pass
+        response = self.checked_command(
+            "mem2array _pio_mem %d 0x%x %d; array get _pio_mem" % (
+                width, address, count))
+        items = response.split()
+        values = dict(
+            (int(items[i]), int(items[i + 1], 0))
+            for i in range(0, len(items) - 1, 2))
+        if len(values) != count:
+            raise OpenOCDError(
+                "Could not read %d words at 0x%08x" % (count, address))
+        return [values[i] for i in range(count)]
+
+
+def find_server_config(debug_tools, preferred=None):
+    # the requested tool, then default tools, then any OpenOCD based one
+    candidates = [preferred] + sorted(
+        name for name, tool in debug_tools.items()
+        if tool.get("default")) + sorted(debug_tools)
+    for name in candidates:
+        server = debug_tools.get(name, {}).get("server", {})
+        if server.get("package") == "tool-openocd":
+            return name, server
+    return None, None
+
+
+def is_server_running(host="localhost", port=DEFAULT_TCL_PORT):
+    try:
+        with TclClient(host, port, timeout=1) as client:
+            client.command("version")
+        return True
+    except (socket.error, OpenOCDError):
+        return False
+
+
+def get_server_args(executable, arguments, tcl_port=DEFAULT_TCL_PORT,
+                    gdb_port="disabled", telnet_port="disabled"):
+    return [executable] + list(arguments) + [
+        "-c", "gdb_port %s" % gdb_port,
+        "-c", "telnet_port %s" % telnet_port,
+        "-c", "tcl_port %d" % tcl_port,
+        "-c", "init"
+    ]
+
+
+def start_server(executable, arguments, tcl_port=DEFAULT_TCL_PORT,
+                 gdb_port="disabled", telnet_port="disabled", timeout=10,
+                 **popen_kwargs):
+    process = subprocess.Popen(
+        get_server_args(executable, arguments, tcl_port, gdb_port,
+                        telnet_port), **popen_kwargs)
+    wait_for_server("localhost", tcl_port, timeout, process)
+    return process
+
+
+def wait_for_server(host, port, timeout=10, process=None):
+    end_time = time.time() + timeout
+    while True:
+        if process is not None and process.poll() is not None:
+            raise OpenOCDError(
+                "OpenOCD exited with code %d" % process.returncode)
+        try:
+            with TclClient(host, port, timeout=1) as client:
+                client.command("version")
+            return True
+        except (socket.error, OpenOCDError):
+            if time.time() > end_time:
+                raise OpenOCDError(
+                    "OpenOCD TCL server is not available at %s:%d" % (
+                        host, port))
+            time.sleep(0.1)
@@ -0,0 +1,201 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Precompiled framework headers
+
+Sources of Arduino and STM32Cube projects start with the umbrella header
+of the framework ("Arduino.h", "stm32f4xx_hal.h") which pulls in the
+whole HAL. With "board_build.pch = yes" the header is compiled once per
+set of flags into "$BUILD_DIR/pch/<flags hash>/<header>.gch" and given
+with "-include" to sources of the project and its libraries whose first
+directive includes it, so GCC loads the compiled state instead of
+parsing the header again. Sources of the project (with
+"src_build_flags") and libraries with their own flags get a header
+compiled with their flags. Framework libraries are built as before.
+
+The precompiled header is rebuilt when the flags, the header or any
+header it includes changes. When flags of a source make it unusable GCC
+reads the header itself, "-Winvalid-pch" reports it.
+
+"board_build.pch_header" replaces the umbrella header of the framework.
+"""
+
+import re
+from os.path import basename, dirname, isabs, isfile, join, sep, splitext
+
+from stm32tools.helpers import (calculate_hash, ensure_dir, get_build_flag,
+                                get_build_option, update_file)
+from stm32tools.includes import INCLUDE_RE
+
+# language: compiler, its flags and sources which use the header
+LANGUAGES = {
+    "c": ("$CC", "$CFLAGS", (".c", )),
+    "c++": ("$CXX", "$CXXFLAGS", (".cc", ".cpp", ".cxx"))
+}
+OBJECT_BUILDERS = ("StaticObject", "SharedObject")
+
+COMMENT_RE = re.compile(r"/\*.*?\*/|//[^\n]*", re.DOTALL)
+LINEMARKER_RE = re.compile(r"^#\s*(line\s+)?\d+")
+
+_first_includes = {}
+# precompiled headers by their stub, stubs by objects which use them
+_pch_nodes = {}
+_object_stubs = {}
+
+
+def is_enabled(env):
+    return get_build_flag(env, "pch")
+
+
+def get_first_include(path):
+    # "-include" is the same as the first directive only, a source which
+    # defines macros before the header must read it itself
+    if path in _first_includes:
+        return _first_includes[path]
+    result = None
+    try:
+        with open(path, "rb") as fp:
+            content = fp.read().decode("utf-8", "replace")
+    except (IOError, OSError):
+        content = ""
+    for line in COMMENT_RE.sub("", content).splitlines():
+        line = line.strip()
+        if not line or LINEMARKER_RE.match(line):
+            continue
+        match = INCLUDE_RE.match(line)
+        result = basename(match.group(1)) if match else None
+        break
+    _first_includes[path] = result
+    return result
+
+
+def _get_language(env, source):
+    suffix = splitext(str(source[0]))[1]
+    for lang in env.get("PCH_LANGUAGES", []):
+        if suffix in LANGUAGES[lang][2]:
+            return lang
+    return None
+
+
+def uses_pch(env, target, source):
+    header = env.get("PCH_HEADER")
+    if not header or not target or not source:
+        return False
+    if not _get_language(env, source):
+        return False
+    # objects of framework libraries are not touched
+    build_dir = env.subst("$BUILD_DIR") + sep
+    path = target[0].get_abspath()
+    if not path.startswith(build_dir) or path[len(build_dir):].startswith(
+            "Framework"):
+        return False
+    return get_first_include(
+        source[0].srcnode().get_abspath()) == basename(header)
+
+
+def _get_command(lang):
+    compiler, flags, _ = LANGUAGES[lang]
+    return "%s -x %s-header -o $TARGET -c %s $CCFLAGS $_CCCOMCOM $SOURCE" % (
+        compiler, lang, flags)
+
+
+def get_stub_path(env, lang):
+    # the header is compiled with the flags of the environment which
+    # compiles the source, GCC ignores a header with other flags
+    key = calculate_hash(lang, env.subst(_get_command(lang)))[:8]
+    return env.subst(join("$BUILD_DIR", "pch", key,
+                          basename(env['PCH_HEADER'])))
+
+
+def _add_pch(env, lang):
+    stub = get_stub_path(env, lang)
+    if stub not in _pch_nodes:
+        from SCons.Tool import CScanner
+        header = env['PCH_HEADER']
+        ensure_dir(dirname(stub))
+        update_file(stub, "#include \"%s\"\n" % header.replace("\\", "/"))
+        # GCC picks the file of the language from "<header>.gch" directory
+        nodes = env.Command(
+            join(stub + ".gch", lang), stub,
+            env.VerboseAction(_get_command(lang), "Precompiling %s (%s)" % (
+                basename(header), lang)),
+            source_scanner=CScanner)
+        env.Depends(nodes, header)
+        _pch_nodes[stub] = nodes
+    return _pch_nodes[stub]
+
+
+def _get_pch_flags(target, source, env, for_signature):
+    # the stub chosen when the object was created
+    stub = _object_stubs.get(target[0].get_abspath()) if target else None
+    if not stub:
+        return []
+    return ["-Winvalid-pch", "-include", stub]
+
+
+def _wrap_emitter(emitter):
+
+    def _emitter(target, source, env):
+        if emitter:
+            target, source = emitter(target, source, env)
+        if uses_pch(env, target, source):
+            lang = _get_language(env, source)
+            env.Depends(target, _add_pch(env, lang))
+            _object_stubs[target[0].get_abspath()] = get_stub_path(env, lang)
+        return target, source
+
+    return _emitter
+
+
+def _wrap_builders(env):
+    for name in OBJECT_BUILDERS:
+        builder = env['BUILDERS'].get(name)
+        if not builder or getattr(builder, "_pch_emitter", False):
+            continue
+        for lang in LANGUAGES.values():
+            for suffix in lang[2]:
+                if suffix in builder.emitter:
+                    builder.emitter[suffix] = _wrap_emitter(
+                        builder.emitter[suffix])
+        builder._pch_emitter = True
+
+
+def find_header(env, name):
+    if isabs(name):
+        return name if isfile(name) else None
+    for path in env.get("CPPPATH", []):
+        path = join(env.subst(path), name)
+        if isfile(path):
+            return path
+    return None
+
+
+def configure(env, header, languages):
+    if not is_enabled(env):
+        return
+    name = get_build_option(env, "pch_header")
+    if name:
+        header = find_header(env, name)
+        if not header:
+            print("Warning! Could not find \"%s\" to precompile" % name)
+            return
+
+    env.Replace(
+        PCH_HEADER=header,
+        PCH_LANGUAGES=list(languages),
+        _PCH_FLAGS=_get_pch_flags
+    )
+    env.Append(CCFLAGS=["$_PCH_FLAGS"])
+    _wrap_builders(env)
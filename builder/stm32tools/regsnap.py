@@ -0,0 +1,208 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Peripheral register snapshot
+
+Reads the registers of the selected peripherals over the OpenOCD TCL
+port. Registers are grouped into contiguous address ranges which are
+fetched with a single bulk memory read each, then decoded with the
+field layout from the SVD store.
+
+Usage:
+    python -m stm32tools.regsnap [--host HOST] [--port PORT]
+        [--output SNAPSHOT.json] [--diff PREVIOUS.json]
+        DEVICE.svd PERIPHERAL [PERIPHERAL ...]
+
+PERIPHERAL accepts shell-style patterns, e.g. "TIM*" or "DMA2".
+"""
+
+import argparse
+import fnmatch
+import json
+import sys
+import time
+from os.path import isfile
+
+from stm32tools.helpers import atomic_copy, atomic_write
+from stm32tools.openocd import DEFAULT_TCL_PORT, TclClient
+from stm32tools.svd import open_store
+
+# bytes of unused address space which are read to merge two ranges
+DEFAULT_MAX_GAP = 16
+
+# reading these registers has side effects (FIFO pop, flag clearing)
+SIDE_EFFECT_REGISTERS = ("DR", "RDR", "RXDR", "FIFO", "RXFIFO", "JDR*",
+                         "DOUTR", "RXCRC*", "PXFIFO", "DIN")
+
+
+def select_peripherals(store, patterns):
+    result = []
+    names = store.get_peripheral_names()
+    for pattern in patterns:
+        matched = fnmatch.filter(names, pattern.strip())
+        if not matched:
+            raise ValueError("Unknown peripheral %s" % pattern)
+        result.extend(name for name in matched if name not in result)
+    return result
+
+
+def is_readable(register):
+    if register['access'] == "write-only":
+        return False
+    return not any(
+        fnmatch.fnmatch(register['name'], pattern)
+        for pattern in SIDE_EFFECT_REGISTERS)
+
+
+def plan_reads(registers, max_gap=DEFAULT_MAX_GAP, skipped=None):
+    # registers and skipped are lists of (address, size in bytes),
+    # returns list of ranges (start, words) aligned to 32 bits; a gap
+    # is read only when it doesn't contain any of skipped registers
+    ranges = []
+    for address, size in sorted(registers):
+        start = address & ~0x3
+        end = (address + size + 3) & ~0x3
+        if ranges and start - ranges[-1][1] <= max_gap and not any(
+                ranges[-1][1] < s_address + s_size and s_address < start
+                for s_address, s_size in skipped or []):
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return [(start, (end - start) // 4) for start, end in ranges]
+
+
+def extract_value(memory, address, size):
+    # "memory" maps word-aligned addresses to 32-bit values
+    value = 0
+    for i in range(size):
+        byte_address = address + i
+        word = memory[byte_address & ~0x3]
+        value |= ((word >> ((byte_address & 0x3) * 8)) & 0xFF) << (i * 8)
+    return value
+
+
+def decode_register(register, value):
+    fields = {}
+    for field in register['fields']:
+        field_value = (value >> field['bit_offset']) & (
+            (1 << field['bit_width']) - 1)
+        enum = [v['name'] for v in field.get("values", [])
+                if v['value'] == field_value]
+        fields[field['name']] = (
+            "%d (%s)" % (field_value, enum[0]) if enum else field_value)
+    return fields
+
+
+def take_snapshot(client, store, peripherals, max_gap=DEFAULT_MAX_GAP):
+    targets = []
+    skipped = []
+    for name in peripherals:
+        peripheral = store.get_peripheral(name)
+        for register in peripheral['registers']:
+            address = peripheral['base_address'] + register['offset']
+            if is_readable(register):
+                targets.append((name, register, address))
+            else:
+                skipped.append((address, register['size'] // 8))
+
+    memory = {}
+    reads = plan_reads(
+        [(address, register['size'] // 8) for _, register, address in
+         targets], max_gap, skipped)
+    for start, words in reads:
+        for i, value in enumerate(client.read_memory(start, words)):
+            memory[start + i * 4] = value
+
+    result = dict(device=store.device, timestamp=int(time.time()),
+                  reads=len(reads), peripherals={})
+    for name, register, address in targets:
+        value = extract_value(memory, address, register['size'] // 8)
+        data = result['peripherals'].setdefault(
+            name, dict(base_address="0x%08x" % store.get_peripheral(
+                name)['base_address'], registers={}))
+        data['registers'][register['name']] = dict(
+            address="0x%08x" % address,
+            value="0x%0*x" % (register['size'] // 4, value),
+            fields=decode_register(register, value))
+    return result
+
+
+def diff_snapshots(previous, current):
+    changes = []
+    for name, peripheral in sorted(current['peripherals'].items()):
+        old_registers = previous.get("peripherals", {}).get(
+            name, {}).get("registers", {})
+        for reg_name, register in sorted(peripheral['registers'].items()):
+            old = old_registers.get(reg_name)
+            if old is None or old['value'] == register['value']:
+                continue
+            changes.append(dict(
+                register="%s.%s" % (name, reg_name),
+                old=old['value'],
+                new=register['value'],
+                fields=dict(
+                    (field, [old['fields'].get(field), value])
+                    for field, value in sorted(register['fields'].items())
+                    if old['fields'].get(field) != value)))
+    return changes
+
+
+def save_snapshot(client, svd_path, patterns, output_path,
+                  max_gap=DEFAULT_MAX_GAP, store_dir=None):
+    # returns changes against the previous snapshot from "output_path"
+    store = open_store(svd_path, store_dir)
+    snapshot = take_snapshot(
+        client, store, select_peripherals(store, patterns), max_gap)
+    changes = None
+    if isfile(output_path):
+        with open(output_path) as fp:
+            changes = diff_snapshots(json.load(fp), snapshot)
+        atomic_copy(output_path, output_path[:-5] + ".prev.json")
+    atomic_write(output_path, json.dumps(snapshot, indent=2, sort_keys=True))
+    return changes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="regsnap", description="Peripheral register snapshot")
+    parser.add_argument("svd")
+    parser.add_argument("peripherals", nargs="+")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=DEFAULT_TCL_PORT)
+    parser.add_argument("--max-gap", type=int, default=DEFAULT_MAX_GAP)
+    parser.add_argument("--output", "-o")
+    parser.add_argument("--diff", "-d")
+    args = parser.parse_args(argv)
+
+    store = open_store(args.svd)
+    with TclClient(args.host, args.port) as client:
+        snapshot = take_snapshot(
+            client, store, select_peripherals(store, args.peripherals),
+            args.max_gap)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(snapshot, fp, indent=2, sort_keys=True)
+    if args.diff:
+        with open(args.diff) as fp:
+            print(json.dumps(diff_snapshots(json.load(fp), snapshot),
+                             indent=2, sort_keys=True))
+    elif not args.output:
+        print(json.dumps(snapshot, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
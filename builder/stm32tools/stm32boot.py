@@ -0,0 +1,383 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+STM32 system bootloader over UART (AN3155)
+
+Uploads firmware through the ROM bootloader without external tools. Only
+flash pages covered by the image are erased, 256 byte Write Memory blocks
+which hold only erased bytes (0xFF) are skipped and the result is
+verified with the Get Checksum command (CRC of the flash calculated by
+the target) if the bootloader supports it, otherwise by reading the
+flash back.
+
+Enable it with "board_upload.native_serial = yes" in "platformio.ini",
+"upload_speed" sets the baud rate (115200 by default). The target has to
+be started in the bootloader mode (BOOT0) before the upload. The
+bootloader measures the baud rate once, on the first 0x7F after reset,
+so the target has to be reset before the next attempt at another rate.
+
+Usage:
+    python -m stm32tools.stm32boot PORT FIRMWARE.bin [ADDRESS [BAUDRATE]]
+"""
+
+import struct
+import sys
+import time
+
+from stm32tools.delta import FLASH_START, get_image_address, get_sectors
+from stm32tools.helpers import TRUE_VALUES
+
+ACK = 0x79
+NACK = 0x1F
+SYNC = 0x7F
+
+CMD_GET = 0x00
+CMD_GET_ID = 0x02
+CMD_READ_MEMORY = 0x11
+CMD_GO = 0x21
+CMD_WRITE_MEMORY = 0x31
+CMD_ERASE = 0x43
+CMD_EXTENDED_ERASE = 0x44
+CMD_GET_CHECKSUM = 0xA1
+
+DEFAULT_BAUDRATE = 115200
+SYNC_TIMEOUT = 0.5
+BLOCK_SIZE = 256
+ERASE_BATCH = 64
+ERASED_BYTE = 0xFF
+
+# CRC unit of STM32: 32-bit words, no reflection, no final XOR
+CRC_POLYNOMIAL = 0x04C11DB7
+CRC_INITIAL = 0xFFFFFFFF
+
+ACK_TIMEOUT = 1
+ERASE_TIMEOUT = 60
+
+
+class BootloaderError(Exception):
+    pass
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ CRC_POLYNOMIAL if crc & 0x80000000 else
+                   crc << 1) & 0xFFFFFFFF
+        table.append(crc)
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+def crc32_stm32(data, crc=CRC_INITIAL):
+    # "data" is fed to the CRC unit as little-endian 32-bit words, the
+    # most significant byte of a word goes first
+    data = bytearray(data)
+    for offset in range(0, len(data) - len(data) % 4, 4):
+        for byte in (data[offset + 3], data[offset + 2], data[offset + 1],
+                     data[offset]):
+            crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+def _xor(data):
+    result = 0
+    for byte in bytearray(data):
+        result ^= byte
+    return result
+
+
+def _with_checksum(data):
+    data = bytearray(data)
+    return bytes(data + bytearray([_xor(data)]))
+
+
+def _command_frame(command):
+    return bytes(bytearray([command, command ^ 0xFF]))
+
+
+def _address_frame(address):
+    return _with_checksum(struct.pack(">I", address))
+
+
+def _data_frame(data):
+    return _with_checksum(bytearray([len(data) - 1]) + bytearray(data))
+
+
+def pad_image(image):
+    # Write Memory takes whole words
+    return image + bytes(bytearray([ERASED_BYTE])) * (-len(image) % 4)
+
+
+def get_blocks(image, address, block_size=BLOCK_SIZE):
+    # returns list of (address, data), the erased flash already holds the
+    # blocks which consist of 0xFF only
+    blocks = []
+    erased = bytes(bytearray([ERASED_BYTE])) * block_size
+    for offset in range(0, len(image), block_size):
+        data = image[offset:offset + block_size]
+        if data != erased[:len(data)]:
+            blocks.append((address + offset, data))
+    return blocks
+
+
+def get_erase_pages(sectors, address, length):
+    # numbers of flash pages (sectors) which overlap the image
+    if not sectors:
+        return None
+    return [index for index, (start, size) in enumerate(sectors)
+            if start < address + length and address < start + size]
+
+
+class Bootloader(object):
+
+    # "port" is a pySerial like object: "read", "write", "timeout",
+    # "baudrate" and "reset_input_buffer"
+    def __init__(self, port):
+        self.port = port
+        self.version = None
+        self.commands = []
+
+    def _read(self, size, timeout=ACK_TIMEOUT):
+        self.port.timeout = timeout
+        data = bytearray(self.port.read(size))
+        if len(data) != size:
+            raise BootloaderError(
+                "Timed out waiting for the bootloader (%d of %d bytes)" %
+                (len(data), size))
+        return data
+
+    def _wait_ack(self, what, timeout=ACK_TIMEOUT):
+        reply = self._read(1, timeout)[0]
+        if reply == NACK:
+            raise BootloaderError("%s was rejected by the bootloader" % what)
+        if reply != ACK:
+            raise BootloaderError(
+                "Unexpected reply 0x%02x to %s" % (reply, what))
+
+    def _command(self, command):
+        if self.commands and command not in self.commands:
+            raise BootloaderError(
+                "Command 0x%02x is not supported by the bootloader" % command)
+        self.port.write(_command_frame(command))
+        self._wait_ack("command 0x%02x" % command)
+
+    def synchronize(self, baudrate=DEFAULT_BAUDRATE):
+        # the bootloader measures the baud rate on the first 0x7F and
+        # keeps it until reset, NACK means it's already synchronized
+        self.port.baudrate = baudrate
+        time.sleep(0.01)
+        self.port.reset_input_buffer()
+        self.port.write(bytes(bytearray([SYNC])))
+        self.port.timeout = SYNC_TIMEOUT
+        reply = bytearray(self.port.read(1))
+        if reply and reply[0] in (ACK, NACK):
+            return baudrate
+        raise BootloaderError(
+            "No answer from the bootloader at %d baud, is the target in "
+            "the bootloader mode? Reset it before the next attempt" %
+            baudrate)
+
+    def get(self):
+        self._command(CMD_GET)
+        size = self._read(1)[0] + 1
+        data = self._read(size)
+        self._wait_ack("Get")
+        self.version = data[0]
+        self.commands = list(data[1:])
+        return self.version, self.commands
+
+    def get_id(self):
+        self._command(CMD_GET_ID)
+        size = self._read(1)[0] + 1
+        data = self._read(size)
+        self._wait_ack("Get ID")
+        result = 0
+        for byte in data:
+            result = result << 8 | byte
+        return result
+
+    def erase(self, pages=None):
+        # "pages" is None for the mass erase
+        if CMD_EXTENDED_ERASE in self.commands:
+            if pages is None:
+                self._command(CMD_EXTENDED_ERASE)
+                self.port.write(_with_checksum(b"\xff\xff"))
+                return self._wait_ack("Mass erase", ERASE_TIMEOUT)
+            for index in range(0, len(pages), ERASE_BATCH):
+                batch = pages[index:index + ERASE_BATCH]
+                self._command(CMD_EXTENDED_ERASE)
+                self.port.write(_with_checksum(struct.pack(
+                    ">%dH" % (len(batch) + 1), len(batch) - 1, *batch)))
+                self._wait_ack("Erase", ERASE_TIMEOUT)
+            return None
+        if pages is not None and (len(pages) > 256 or max(pages) > 255):
+            # out of reach of the Erase command
+            pages = None
+        self._command(CMD_ERASE)
+        if pages is None:
+            self.port.write(b"\xff\x00")
+            return self._wait_ack("Mass erase", ERASE_TIMEOUT)
+        self.port.write(_with_checksum(bytearray([len(pages) - 1] + pages)))
+        return self._wait_ack("Erase", ERASE_TIMEOUT)
+
+    def write_memory(self, address, data):
+        self._command(CMD_WRITE_MEMORY)
+        self.port.write(_address_frame(address))
+        self._wait_ack("Write Memory address")
+        self.port.write(_data_frame(data))
+        self._wait_ack("Write Memory at 0x%08x" % address)
+
+    def read_memory(self, address, size):
+        self._command(CMD_READ_MEMORY)
+        self.port.write(_address_frame(address))
+        self._wait_ack("Read Memory address")
+        self.port.write(_command_frame(size - 1))
+        self._wait_ack("Read Memory size")
+        return bytes(self._read(size))
+
+    def get_checksum(self, address, size):
+        # CRC of "size" bytes (whole words) calculated by the target
+        self._command(CMD_GET_CHECKSUM)
+        self.port.write(_address_frame(address))
+        self._wait_ack("Get Checksum address")
+        for value, what in ((size, "size"), (CRC_POLYNOMIAL, "polynomial"),
+                            (CRC_INITIAL, "initial value")):
+            self.port.write(_with_checksum(struct.pack(">I", value)))
+            self._wait_ack("Get Checksum %s" % what)
+        self._wait_ack("Get Checksum", ERASE_TIMEOUT)
+        data = self._read(5)
+        if _xor(data[:4]) != data[4]:
+            raise BootloaderError("Corrupted checksum from the bootloader")
+        return struct.unpack(">I", bytes(data[:4]))[0]
+
+    def go(self, address):
+        self._command(CMD_GO)
+        self.port.write(_address_frame(address))
+        self._wait_ack("Go")
+
+
+def verify(bootloader, image, address):
+    if CMD_GET_CHECKSUM in bootloader.commands:
+        return bootloader.get_checksum(address, len(image)) == crc32_stm32(
+            image)
+    for offset in range(0, len(image), BLOCK_SIZE):
+        data = image[offset:offset + BLOCK_SIZE]
+        if bootloader.read_memory(address + offset, len(data)) != data:
+            return False
+    return True
+
+
+def flash(bootloader, image, address, sectors=None, run=True):
+    # "bootloader" is synchronized, "sectors" is the flash layout as
+    # list of (address, size), otherwise the whole flash is erased
+    image = pad_image(image)
+    version, _ = bootloader.get()
+    print("Bootloader v%d.%d, chip ID 0x%03x" % (
+        version >> 4, version & 0x0F, bootloader.get_id()))
+
+    pages = get_erase_pages(sectors, address, len(image))
+    print("Erasing %s" % ("the whole flash" if pages is None else
+                          "%d page(s)" % len(pages)))
+    bootloader.erase(pages)
+
+    blocks = get_blocks(image, address)
+    started = time.time()
+    for index, (block_address, data) in enumerate(blocks):
+        bootloader.write_memory(block_address, data)
+        if index % 64 == 63 or index + 1 == len(blocks):
+            sys.stdout.write("\rWriting %d%%" % (
+                (index + 1) * 100 // len(blocks)))
+            sys.stdout.flush()
+    print("\nWrote %d bytes (%d blocks of %d skipped) in %.2fs" % (
+        sum(len(d) for _, d in blocks),
+        (len(image) + BLOCK_SIZE - 1) // BLOCK_SIZE - len(blocks),
+        (len(image) + BLOCK_SIZE - 1) // BLOCK_SIZE, time.time() - started))
+
+    print("Verifying %s" % ("CRC" if CMD_GET_CHECKSUM in bootloader.commands
+                            else "by reading back"))
+    if not verify(bootloader, image, address):
+        raise BootloaderError("Verification failed")
+    if run:
+        bootloader.go(address)
+
+
+def open_port(port_name, timeout=ACK_TIMEOUT):
+    try:
+        import serial
+    except ImportError:
+        raise BootloaderError("pySerial is required for the serial upload")
+    # the bootloader uses 8 data bits with even parity
+    return serial.Serial(port_name, DEFAULT_BAUDRATE,
+                         parity=serial.PARITY_EVEN, timeout=timeout)
+
+
+def get_baudrate(speed=None):
+    return int(speed or 0) or DEFAULT_BAUDRATE
+
+
+def upload(port_name, image_path, address=FLASH_START,
+           baudrate=DEFAULT_BAUDRATE, sectors=None):
+    with open(image_path, "rb") as fp:
+        image = fp.read()
+    port = open_port(port_name)
+    try:
+        bootloader = Bootloader(port)
+        print("Connected at %d baud" % bootloader.synchronize(baudrate))
+        flash(bootloader, image, address, sectors)
+    finally:
+        port.close()
+
+
+def is_enabled(env):
+    return str(env.BoardConfig().get(
+        "upload.native_serial", "no")).strip().lower() in TRUE_VALUES
+
+
+def SerialUpload(target, source, env):
+    board = env.BoardConfig()
+    image_path = source[0].get_abspath()
+    # "serial.SerialException" is "IOError" too (busy or missing port)
+    try:
+        address = get_image_address(image_path)
+        upload(env.subst("$UPLOAD_PORT"), image_path, address,
+               get_baudrate(env.subst("$UPLOAD_SPEED")),
+               get_sectors(board.get("build.mcu", ""), int(board.get(
+                   "upload.maximum_size", 0)) + address - FLASH_START))
+    except (BootloaderError, EnvironmentError, ValueError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    return None
+
+
+def main(argv):
+    if len(argv) < 3:
+        sys.stderr.write(__doc__.split("Usage:")[1])
+        return 1
+    address = int(argv[3], 0) if len(argv) > 3 else FLASH_START
+    try:
+        upload(argv[1], argv[2], address,
+               get_baudrate(argv[4] if len(argv) > 4 else None))
+    except (BootloaderError, EnvironmentError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
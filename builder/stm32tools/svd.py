@@ -0,0 +1,336 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+SVD store
+
+Compact, build-once database of CMSIS-SVD device descriptions. Every
+peripheral is compressed separately and located through an index, so a
+single peripheral (or register) layout is fetched without parsing the
+rest of the device. Only the parsed layout is stored, tools which
+require the raw SVD file read the original one.
+
+Builds and debug sessions keep stores in the platform cache directory
+("svd"), command line tools in a directory of the system temporary
+directory. A store is named after the size and modification time of its
+SVD file, an updated SVD file gets a new store. Fields
+which can't be located (no "bitOffset", "lsb"/"msb" or "bitRange") are
+skipped.
+
+Usage:
+    python -m stm32tools.svd build misc/svd [-o OUTPUT_DIR]
+    python -m stm32tools.svd show STM32F401xE.svd GPIOA [REGISTER]
+"""
+
+import json
+import os
+import re
+import struct
+import sys
+import tempfile
+import zlib
+from os.path import (basename, dirname, getmtime, getsize, isdir, isfile,
+                     join, splitext)
+from xml.etree import ElementTree
+
+from stm32tools.helpers import atomic_write, calculate_hash, ensure_dir
+
+STORE_MAGIC = b"SVDB\x02"
+STORE_SUFFIX = ".svdb"
+HEADER_STRUCT = struct.Struct("<I")
+# stores of command line tools
+DEFAULT_STORE_DIR = join(tempfile.gettempdir(), "stm32tools-svd")
+
+
+class SVDError(Exception):
+    pass
+
+
+def parse_int(value, default=None):
+    if value is None:
+        return default
+    value = value.strip().lower()
+    if value.startswith("#"):
+        return int(value[1:].replace("x", "0"), 2)
+    if value.startswith("0b"):
+        return int(value[2:].replace("x", "0"), 2)
+    if value.startswith("0x"):
+        return int(value, 16)
+    # decimal values may have leading zeros
+    return int(value, 10)
+
+
+def _text(element, tag, default=None):
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return default
+    return " ".join(child.text.split())
+
+
+def _parse_field(element, defaults):
+    bit_offset = parse_int(_text(element, "bitOffset"))
+    bit_width = parse_int(_text(element, "bitWidth"))
+    if bit_offset is None:
+        lsb = parse_int(_text(element, "lsb"))
+        msb = parse_int(_text(element, "msb"))
+        bit_range = _text(element, "bitRange")
+        bounds = re.findall(r"\d+", bit_range or "")
+        if lsb is None and len(bounds) > 1:
+            msb, lsb = int(bounds[0]), int(bounds[1])
+        if lsb is None or msb is None:
+            return None
+        bit_offset, bit_width = lsb, msb - lsb + 1
+    field = dict(
+        name=_text(element, "name"),
+        description=_text(element, "description", ""),
+        bit_offset=bit_offset,
+        bit_width=bit_width if bit_width is not None else 1,
+        access=_text(element, "access", defaults['access']))
+    values = []
+    for enum in element.iter("enumeratedValue"):
+        value = _text(enum, "value")
+        if value is None or "x" in value.lower().lstrip("0x"):
+            continue
+        values.append(dict(name=_text(enum, "name"),
+                           description=_text(enum, "description", ""),
+                           value=parse_int(value)))
+    if values:
+        field['values'] = values
+    return field
+
+
+def _parse_register(element, defaults):
+    register = dict(
+        name=_text(element, "name"),
+        description=_text(element, "description", ""),
+        offset=parse_int(_text(element, "addressOffset"), 0),
+        size=parse_int(_text(element, "size"), defaults['size']),
+        access=_text(element, "access", defaults['access']),
+        reset_value=parse_int(
+            _text(element, "resetValue"), defaults['reset_value']),
+        fields=[])
+    fields = element.find("fields")
+    if fields is not None:
+        register['fields'] = sorted(
+            [f for f in (_parse_field(e, register)
+                         for e in fields.findall("field")) if f],
+            key=lambda f: f['bit_offset'])
+    return register
+
+
+def _parse_peripheral(element, defaults):
+    defaults = dict(
+        size=parse_int(_text(element, "size"), defaults['size']),
+        access=_text(element, "access", defaults['access']),
+        reset_value=parse_int(
+            _text(element, "resetValue"), defaults['reset_value']))
+    peripheral = dict(
+        name=_text(element, "name"),
+        description=_text(element, "description", ""),
+        group=_text(element, "groupName", ""),
+        base_address=parse_int(_text(element, "baseAddress"), 0),
+        derived_from=element.get("derivedFrom"),
+        registers=[])
+    registers = element.find("registers")
+    if registers is not None:
+        peripheral['registers'] = sorted(
+            [_parse_register(r, defaults)
+             for r in registers.findall("register")],
+            key=lambda r: r['offset'])
+    return peripheral
+
+
+def parse_svd(svd_path):
+    device = dict(name=None, peripherals=[])
+    defaults = dict(size=32, access="read-write", reset_value=0)
+    depth = 0
+    for event, element in ElementTree.iterparse(
+            svd_path, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1 and element.tag in ("name", "size", "access",
+                                          "resetValue"):
+            value = " ".join((element.text or "").split())
+            if element.tag == "name":
+                device['name'] = value
+            elif element.tag == "size":
+                defaults['size'] = parse_int(value)
+            elif element.tag == "access":
+                defaults['access'] = value
+            else:
+                defaults['reset_value'] = parse_int(value)
+        elif element.tag == "peripheral" and depth == 2:
+            device['peripherals'].append(_parse_peripheral(element, defaults))
+            element.clear()
+
+    by_name = dict((p['name'], p) for p in device['peripherals'])
+    for peripheral in device['peripherals']:
+        base = by_name.get(peripheral['derived_from'])
+        if base and not peripheral['registers']:
+            peripheral['registers'] = base['registers']
+            peripheral['description'] = (
+                peripheral['description'] or base['description'])
+            peripheral['group'] = peripheral['group'] or base['group']
+    return device
+
+
+def _compress(data):
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    return zlib.compress(data, 9)
+
+
+def build_store(svd_path, store_path):
+    device = parse_svd(svd_path)
+    blobs = []
+    offset = 0
+    index = dict(device=device['name'] or splitext(basename(svd_path))[0],
+                 peripherals={})
+    for peripheral in device['peripherals']:
+        blob = _compress(json.dumps(peripheral, separators=(",", ":")))
+        index['peripherals'][peripheral['name']] = dict(
+            offset=offset, length=len(blob),
+            base_address=peripheral['base_address'],
+            group=peripheral['group'],
+            registers=dict(
+                (r['name'], r['offset']) for r in peripheral['registers']))
+        blobs.append(blob)
+        offset += len(blob)
+
+    header = _compress(json.dumps(index, separators=(",", ":")))
+    atomic_write(store_path, b"".join(
+        [STORE_MAGIC, HEADER_STRUCT.pack(len(header)), header] + blobs))
+    return store_path
+
+
+class SVDStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fp:
+            if fp.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                raise SVDError("Invalid SVD store %s" % path)
+            size = HEADER_STRUCT.unpack(fp.read(HEADER_STRUCT.size))[0]
+            self._index = json.loads(
+                zlib.decompress(fp.read(size)).decode("utf-8"))
+        self._data_offset = len(STORE_MAGIC) + HEADER_STRUCT.size + size
+        self._cache = {}
+
+    @property
+    def device(self):
+        return self._index['device']
+
+    def get_peripheral_names(self):
+        return sorted(self._index['peripherals'])
+
+    def get_peripheral_info(self, name):
+        # brief data from the index, doesn't touch the peripheral blob
+        if name not in self._index['peripherals']:
+            raise SVDError("Unknown peripheral %s in %s" % (name, self.device))
+        return self._index['peripherals'][name]
+
+    def _read_blob(self, offset, length):
+        with open(self.path, "rb") as fp:
+            fp.seek(self._data_offset + offset)
+            return zlib.decompress(fp.read(length))
+
+    def get_peripheral(self, name):
+        if name not in self._cache:
+            info = self.get_peripheral_info(name)
+            self._cache[name] = json.loads(self._read_blob(
+                info['offset'], info['length']).decode("utf-8"))
+        return self._cache[name]
+
+    def get_register(self, peripheral, register):
+        if register not in self.get_peripheral_info(
+                peripheral)['registers']:
+            raise SVDError("Unknown register %s.%s" % (peripheral, register))
+        for item in self.get_peripheral(peripheral)['registers']:
+            if item['name'] == register:
+                return item
+        return None
+
+
+def get_store_path(svd_path, store_dir=None):
+    name = splitext(basename(svd_path))[0]
+    if isfile(svd_path):
+        name += "-" + calculate_hash(getsize(svd_path),
+                                     getmtime(svd_path))[:8]
+    return join(store_dir or DEFAULT_STORE_DIR, name + STORE_SUFFIX)
+
+
+def _remove_stale_stores(store_path):
+    # stores of the previous versions of the SVD file
+    name = basename(store_path)[:-len(STORE_SUFFIX) - 9]
+    for item in os.listdir(dirname(store_path)):
+        if item != basename(store_path) and re.match(
+                r"^%s-[0-9a-f]{8}%s$" % (re.escape(name),
+                                         re.escape(STORE_SUFFIX)), item):
+            os.remove(join(dirname(store_path), item))
+
+
+def open_store(svd_path, store_dir=None):
+    # build the store on the first use or when the SVD file is updated
+    if svd_path.endswith(STORE_SUFFIX):
+        return SVDStore(svd_path)
+    store_path = get_store_path(svd_path, store_dir)
+    if not isfile(store_path):
+        build_store(svd_path, store_path)
+        _remove_stale_stores(store_path)
+    try:
+        return SVDStore(store_path)
+    except SVDError:
+        # a store of the previous format
+        build_store(svd_path, store_path)
+        return SVDStore(store_path)
+
+
+def build_all(svd_dir, store_dir=None):
+    store_dir = ensure_dir(store_dir or DEFAULT_STORE_DIR)
+    result = []
+    for name in sorted(os.listdir(svd_dir)):
+        if name.lower().endswith(".svd"):
+            result.append(
+                build_store(join(svd_dir, name), get_store_path(
+                    join(svd_dir, name), store_dir)))
+    return result
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] not in ("build", "show"):
+        sys.stderr.write(__doc__.split("Usage:")[1])
+        return 1
+    command, path = argv[1], argv[2]
+    if command == "build":
+        store_dir = argv[4] if len(argv) > 4 and argv[3] == "-o" else None
+        paths = build_all(path, store_dir) if isdir(path) else [
+            build_store(path, get_store_path(path, store_dir))]
+        for item in paths:
+            print(item)
+    else:
+        store = open_store(path)
+        if len(argv) == 3:
+            data = store.get_peripheral_names()
+        elif len(argv) == 4:
+            data = store.get_peripheral(argv[3])
+        else:
+            data = store.get_register(argv[3], argv[4])
+        print(json.dumps(data, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
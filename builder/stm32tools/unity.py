@@ -0,0 +1,229 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unity builds of framework sources
+
+The Arduino cores are made of many small sources which read the same
+headers. With "board_build.unity_build = yes" framework sources which
+are linked as objects ("BuildFrameworkSources") are combined into a few
+generated translation units ("$BUILD_DIR/unity/<library>/__unity_<n>.c")
+which "#include" them, at most "board_build.unity_batch" (16) sources
+each. Archives ("BuildFrameworkLibrary") are built as before, a linker
+takes only the members of an archive which are referenced and a unit
+would bring in the definitions of all its sources.
+
+Sources are combined only when it can't change their meaning:
+
+* names local to a source (static objects and functions, macros, types)
+  don't appear in the other sources of the unit, macros of a source are
+  undefined after it;
+* a source which defines macros or pragmas before its last "#include",
+  or which uses "using namespace", anonymous namespaces or
+  "__BASE_FILE__", is compiled alone;
+* templates, interrupt handlers and system calls ("UNITY_EXCLUDE") and
+  patterns of "board_build.unity_exclude" are compiled alone.
+
+Results of the scan are cached by the modification time and size of
+every source in "$BUILD_DIR/unity/<library>/scan.json".
+"""
+
+import json
+import os
+import re
+from fnmatch import fnmatch
+from os.path import basename, isfile, join, splitext
+
+from stm32tools.helpers import (atomic_write, ensure_dir, get_build_flag,
+                                get_build_option, update_file)
+
+UNITY_BATCH = 16
+# sources which are never combined
+UNITY_EXCLUDE = ("*_template.c", "*_template.cpp", "*_it.c", "*_it.cpp",
+                 "syscalls*.c", "main.c", "main.cpp")
+# language: suffix of the unit and of sources it combines
+LANGUAGES = (
+    (".c", (".c", )),
+    (".cpp", (".cc", ".cpp", ".cxx"))
+)
+
+COMMENT_RE = re.compile(r"/\*.*?\*/|//[^\n]*", re.DOTALL)
+STRING_RE = re.compile(r"\"(?:\\.|[^\"\\\n])*\"")
+DIRECTIVE_RE = re.compile(r"^\s*#\s*(include|define|undef|pragma)\b\s*(\w*)",
+                          re.MULTILINE)
+STATIC_RE = re.compile(
+    r"^\s*static\b[^;{=]*?\b([A-Za-z_]\w*)\s*(?:\(|\[|=|;)", re.MULTILINE)
+TYPE_RE = re.compile(r"\b(?:struct|union|enum|class)\s+([A-Za-z_]\w*)\s*[:{]")
+TYPEDEF_RE = re.compile(r"\btypedef\b[^;{]*(?:\{[^{}]*\})?[^;{]*?"
+                        r"\b([A-Za-z_]\w*)\s*(?:\[[^\]]*\])?\s*;")
+TOKEN_RE = re.compile(r"\b[A-Za-z_]\w*\b")
+UNSAFE_RE = re.compile(r"\busing\s+namespace\b|\bnamespace\s*\{|"
+                       r"\b__BASE_FILE__\b")
+
+
+def is_enabled(env):
+    return get_build_flag(env, "unity_build")
+
+
+def get_batch_size(env):
+    try:
+        return max(1, int(get_build_option(env, "unity_batch", UNITY_BATCH)))
+    except ValueError:
+        return UNITY_BATCH
+
+
+def get_exclude_patterns(env):
+    option = get_build_option(env, "unity_exclude", "")
+    if isinstance(option, (list, tuple)):
+        option = ",".join(option)
+    return list(UNITY_EXCLUDE) + [
+        p.strip() for p in str(option).split(",") if p.strip()]
+
+
+def get_signature(env):
+    # settings which change objects of a library
+    return [get_batch_size(env)] + get_exclude_patterns(env)
+
+
+def scan_source(path):
+    # None when the source must be compiled alone, otherwise its local
+    # names, macros and all identifiers it uses
+    with open(path, "rb") as fp:
+        content = COMMENT_RE.sub(" ", fp.read().decode("utf-8", "replace"))
+    if UNSAFE_RE.search(content):
+        return None
+
+    directives = DIRECTIVE_RE.findall(content)
+    includes = [i for i, (d, _) in enumerate(directives) if d == "include"]
+    macros = []
+    for i, (directive, name) in enumerate(directives):
+        # "#define ARDUINO_MAIN", "#pragma GCC optimize", ...
+        if directive == "pragma" or (
+                directive != "include" and includes and i < includes[-1]):
+            return None
+        if directive != "include" and name and name not in macros:
+            macros.append(name)
+
+    code = STRING_RE.sub("\"\"", content)
+    local = set(macros)
+    local.update(STATIC_RE.findall(code))
+    local.update(TYPE_RE.findall(code))
+    local.update(TYPEDEF_RE.findall(code))
+    return dict(local=local, macros=macros,
+                tokens=set(TOKEN_RE.findall(code)))
+
+
+def scan_sources(paths, cache_path):
+    # {path: scan_source() result}, a no-op build reads only the cache
+    cache = {}
+    if isfile(cache_path):
+        try:
+            with open(cache_path) as fp:
+                cache = json.load(fp)
+        except (IOError, ValueError):
+            cache = {}
+    files = {}
+    result = {}
+    for path in paths:
+        stat = os.stat(path)
+        state = "%d:%d" % (stat.st_mtime, stat.st_size)
+        item = cache.get(path)
+        if not item or item[0] != state:
+            info = scan_source(path)
+            item = [state, info and dict(
+                (k, sorted(v) if isinstance(v, set) else v)
+                for k, v in info.items())]
+        files[path] = item
+        info = item[1]
+        result[path] = info and dict(
+            local=set(info['local']), macros=info['macros'],
+            tokens=set(info['tokens']))
+    if files != cache:
+        atomic_write(cache_path, json.dumps(files, separators=(",", ":")))
+    return result
+
+
+def _conflicts(info, batch):
+    for item in batch:
+        if info['local'] & item['tokens'] or item['local'] & info['tokens']:
+            return True
+    return False
+
+
+def make_batches(sources, batch_size):
+    # first fit, "sources" is a list of (node, scan_source() result)
+    batches = []
+    for node, info in sources:
+        for batch in batches:
+            if len(batch) < batch_size and not _conflicts(
+                    info, [i for _, i in batch]):
+                batch.append((node, info))
+                break
+        else:
+            batches.append([(node, info)])
+    return batches
+
+
+def get_unit_contents(batch):
+    lines = ["/* Generated by stm32tools.unity, do not edit */"]
+    for node, info in batch:
+        lines.append("#include \"%s\"" % node.srcnode().get_abspath().replace(
+            "\\", "/"))
+        lines.extend("#undef %s" % name for name in info['macros'])
+    return "\n".join(lines) + "\n"
+
+
+def _is_excluded(path, patterns):
+    return any(fnmatch(basename(path), p) for p in patterns)
+
+
+def build_objects(env, variant_dir, src_dir, src_filter=None):
+    nodes = env.CollectBuildFiles(variant_dir, src_dir, src_filter)
+    if not is_enabled(env):
+        return [o for node in nodes for o in env.Object(node)]
+
+    patterns = get_exclude_patterns(env)
+    candidates = []
+    for node in nodes:
+        path = node.srcnode().get_abspath()
+        suffix = splitext(path)[1]
+        group = [s for s, suffixes in LANGUAGES if suffix in suffixes]
+        if group and not _is_excluded(path, patterns):
+            candidates.append((node, path, group[0]))
+    unity_dir = ensure_dir(env.subst(join(
+        "$BUILD_DIR", "unity", basename(env.subst(variant_dir)))))
+    infos = scan_sources([path for _, path, _ in candidates],
+                         join(unity_dir, "scan.json"))
+
+    groups = dict((suffix, []) for suffix, _ in LANGUAGES)
+    combined = set()
+    for node, path, group in candidates:
+        if infos[path] is not None:
+            groups[group].append((node, infos[path]))
+            combined.add(node)
+    objects = [o for node in nodes if node not in combined
+               for o in env.Object(node)]
+
+    index = 0
+    for suffix, _ in LANGUAGES:
+        for batch in make_batches(groups[suffix], get_batch_size(env)):
+            if len(batch) == 1:
+                objects.extend(env.Object(batch[0][0]))
+                continue
+            unit = join(unity_dir, "__unity_%d%s" % (index, suffix))
+            update_file(unit, get_unit_contents(batch))
+            objects.extend(env.Object(
+                join(variant_dir, "__unity_%d" % index), unit))
+            index += 1
+    return objects
@@ -12,13 +12,104 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
+from os import listdir
+from os.path import basename, dirname, isdir, isfile, join
 from platform import system
 
-from platformio.managers.platform import PlatformBase
+from platformio.managers.platform import PlatformBase, PlatformBoardConfig
+
+sys.path.insert(0, join(dirname(__file__), "builder"))
+
+from stm32tools import boardindex, identical, ocdsession, svd
+from stm32tools.helpers import get_platform_cache_dir
+
+
+class IndexedBoardConfig(PlatformBoardConfig):
+
+    # The brief data (board lists) is taken from the board index, the
+    # manifest file is loaded by "PlatformBoardConfig" on the first access
+    # to the board options and default debug tools are added then
+
+    def __init__(self, manifest_path, manifest, debug_tools_callback):
+        # pylint: disable=super-init-not-called
+        # "PlatformBoardConfig" accepts only the path of the manifest
+        self.manifest_path = manifest_path
+        self._indexed_manifest = manifest
+        self._debug_tools_callback = debug_tools_callback
+
+    def __getattr__(self, name):
+        # the state of "PlatformBoardConfig" is created on demand
+        if name not in ("_id", "_manifest"):
+            raise AttributeError(name)
+        super(IndexedBoardConfig, self).__init__(self.manifest_path)
+        self.manifest['platform'] = self._indexed_manifest['platform']
+        self._debug_tools_callback(self)
+        return getattr(self, name)
+
+    @property
+    def id(self):
+        return basename(self.manifest_path)[:-5]
+
+    def get_brief_data(self):
+        # the same data as "PlatformBoardConfig" returns, without loading
+        # the manifest and expanding debug tools
+        manifest = self._indexed_manifest
+        build = manifest.get("build", {})
+        upload = manifest.get("upload", {})
+        tools = get_debug_tool_flags(manifest)
+        return {
+            "id": self.id,
+            "name": manifest['name'],
+            "platform": manifest.get("platform"),
+            "mcu": build.get("mcu", "").upper(),
+            "fcpu": int("".join(
+                c for c in str(build.get("f_cpu", "0L")) if c.isdigit())),
+            "ram": upload.get("maximum_ram_size", 0),
+            "rom": upload.get("maximum_size", 0),
+            "connectivity": manifest.get("connectivity"),
+            "frameworks": manifest.get("frameworks"),
+            "debug": {"tools": tools} if tools else None,
+            "vendor": manifest['vendor'],
+            "url": manifest['url']
+        }
+
+
+def get_default_debug_links(manifest):
+    # probes which get a default debug tool
+    debug = manifest.get("debug", {})
+    upload_protocols = manifest.get("upload", {}).get("protocols", [])
+    return [link for link in ("blackmagic", "jlink", "stlink", "cmsis-dap")
+            if link in upload_protocols and link not in debug.get(
+                "tools", {})]
+
+
+def get_debug_tool_flags(manifest):
+    # "default" and "onboard" flags of the debug tools of the board
+    debug = manifest.get("debug", {})
+    tools = {}
+    for name, options in debug.get("tools", {}).items():
+        tools[name] = dict((key, value) for key, value in options.items()
+                           if key in ("default", "onboard"))
+    for link in get_default_debug_links(manifest):
+        if link == "blackmagic":
+            tools[link] = {}
+            continue
+        tools[link] = {
+            "onboard": link in debug.get("onboard_tools", []),
+            "default": link in debug.get("default_tools", [])
+        }
+        if debug.get("openocd_session"):
+            tools[link + "-session"] = {
+                "onboard": link in debug.get("onboard_tools", [])
+            }
+    return tools
 
 
 class Corestm32Platform(PlatformBase):
 
+    _board_index = None
+
     def configure_default_packages(self, variables, targets):
         board = variables.get("board")
         build_core = variables.get(
@@ -55,28 +146,106 @@ class Corestm32Platform(PlatformBase):
         return PlatformBase.configure_default_packages(self, variables,
                                                        targets)
 
+    def configure_debug_options(self, initial_debug_options, ide_data):
+        # the IDE reads the SVD file itself, its store is built for the
+        # register tools ("regsnapshot", "stm32tools.svd show") used
+        # while debugging
+        svd_path = ide_data.get("svd_path")
+        if svd_path and isfile(svd_path):
+            try:
+                svd.open_store(svd_path, join(self._get_cache_dir(
+                    env_name=ide_data.get("env_name")), "svd"))
+            except (IOError, OSError, SyntaxError, svd.SVDError) as e:
+                print("Warning! Cannot build SVD store of %s: %s" % (
+                    svd_path, e))
+        return initial_debug_options
+
     def get_boards(self, id_=None):
+        self._add_indexed_boards(id_)
         result = PlatformBase.get_boards(self, id_)
         if not result:
             return result
         if id_:
-            return self._add_default_debug_tools(result)
+            if not isinstance(result, IndexedBoardConfig):
+                result = self._add_default_debug_tools(result)
+            return result
         else:
             for key, value in result.items():
-                result[key] = self._add_default_debug_tools(result[key])
+                if not isinstance(value, IndexedBoardConfig):
+                    result[key] = self._add_default_debug_tools(value)
         return result
 
+    def query_boards(self, **criteria):
+        # mcu, framework, upload_protocol, min_flash_size, min_ram_size
+        return boardindex.query_boards(self._get_board_index(), **criteria)
+
+    def _get_board_index(self):
+        if self._board_index is None:
+            self._board_index = boardindex.load_index(
+                join(self.get_dir(), "boards"),
+                join(self._get_cache_dir(), "boards.json"))
+        return self._board_index
+
+    def _get_cache_dir(self, board_id=None, env_name=None):
+        # "board_build.cache_dir" of the project environment (of the board),
+        # the builder reads the same option with "get_cache_dir()"
+        cache_dir = None
+        config = getattr(self, "config", None)
+        env_names = [env_name] if env_name else (
+            config.envs() if config else [])
+        for name in env_names:
+            section = "env:" + name
+            if board_id and config.get(section, "board", None) != board_id:
+                continue
+            cache_dir = config.get(section, "board_build.cache_dir", None)
+            if cache_dir:
+                break
+        return get_platform_cache_dir(self.name, cache_dir)
+
+    def _get_custom_board_ids(self):
+        result = set()
+        try:
+            boards_dirs = [
+                self.config.get_optional_dir("boards"),
+                join(self.config.get_optional_dir("core"), "boards")
+            ]
+        except AttributeError:
+            return result
+        for boards_dir in boards_dirs:
+            if boards_dir and isdir(boards_dir):
+                result.update(
+                    item[:-5] for item in listdir(boards_dir)
+                    if item.endswith(".json"))
+        return result
+
+    def _add_indexed_boards(self, id_=None):
+        boards_cache = getattr(self, "_BOARDS_CACHE", None)
+        if boards_cache is None or (id_ and id_ in boards_cache):
+            return
+        # boards from the project and core "boards" dirs have priority
+        custom_ids = self._get_custom_board_ids()
+        for board_id, manifest in self._get_board_index().items():
+            if id_ and board_id != id_:
+                continue
+            if board_id in boards_cache or board_id in custom_ids:
+                continue
+            if manifest.get("platform", self.name) != self.name or (
+                    self.name not in manifest.get("platforms", [self.name])):
+                continue
+            manifest['platform'] = self.name
+            boards_cache[board_id] = IndexedBoardConfig(
+                join(self.get_dir(), "boards", board_id + ".json"), manifest,
+                self._add_default_debug_tools)
+
     def _add_default_debug_tools(self, board):
-        debug = board.manifest.get("debug", {})
-        upload_protocols = board.manifest.get("upload", {}).get(
-            "protocols", [])
+        manifest = board.manifest
+        debug = manifest.get("debug", {})
+        links = get_default_debug_links(manifest)
         if "tools" not in debug:
             debug['tools'] = {}
 
         # BlackMagic, J-Link, ST-Link
-        for link in ("blackmagic", "jlink", "stlink", "cmsis-dap"):
-            if link not in upload_protocols or link in debug['tools']:
-                continue
+        for link in links:
             if link == "blackmagic":
                 debug['tools']['blackmagic'] = {
                     "hwids": [["0x1d50", "0x6018"]],
@@ -131,5 +300,23 @@ class Corestm32Platform(PlatformBase):
                     "default": link in debug.get("default_tools", [])
                 }
 
-        board.manifest['debug'] = debug
+                # load only when flash differs from the firmware
+                if debug.get("skip_identical"):
+                    debug['tools'][link]['server']['arguments'] = (
+                        server_args + ["-c", identical.OPENOCD_LOAD_PROC])
+                    debug['tools'][link]['load_cmds'] = [
+                        "monitor pio_load_if_changed"
+                    ]
+
+                # attach to the background server of "upload" sessions,
+                # its ports depend on the probe ("upload_port")
+                if debug.get("openocd_session"):
+                    debug['tools'][link + "-session"] = {
+                        "port": "localhost:%d" % ocdsession.find_gdb_port(
+                            ocdsession.get_sessions_dir(
+                                self._get_cache_dir(board.id)), link),
+                        "onboard": link in debug.get("onboard_tools", [])
+                    }
+
+        manifest['debug'] = debug
         return board
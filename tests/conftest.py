@@ -0,0 +1,155 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import sys
+from os.path import dirname, join
+
+import pytest
+
+# "stm32tools" is imported the same way as by "builder/main.py"
+sys.path.insert(0, join(dirname(dirname(__file__)), "builder"))
+
+# PlatformIO projects of the integration tests aren't Python packages
+collect_ignore_glob = ["*/src/*", "*/lib/*"]
+
+
+class FakeNode(object):
+
+    def __init__(self, path):
+        self.path = self.abspath = path
+
+    def __str__(self):
+        return self.path
+
+    def get_abspath(self):
+        return self.path
+
+    def srcnode(self):
+        return self
+
+
+class FakeBuilder(object):
+
+    def __init__(self, emitter=None):
+        self.emitter = emitter
+
+
+class FakePlatform(object):
+
+    name = "ststm32"
+    version = "5.4.1"
+
+    def __init__(self, platform_dir=None, packages=None):
+        self.platform_dir = platform_dir
+        self.packages = packages or {}
+
+    def get_dir(self):
+        return self.platform_dir
+
+    def get_package_dir(self, name):
+        return self.packages.get(name)
+
+    def get_package_version(self, name):
+        return "1.0.0"
+
+
+class FakeEnv(dict):
+
+    # SCons environment of the builder scripts: construction variables
+    # are the items ("$NAME" and "${NAME}" are substituted from them),
+    # "board" has "board_*" options, "options" has project options
+
+    def __init__(self, board=None, options=None, platform=None,
+                 **variables):
+        dict.__init__(self, **variables)
+        self.setdefault("BUILDERS", dict(
+            Program=FakeBuilder(),
+            StaticObject=FakeBuilder(dict.fromkeys([".c", ".cpp", ".S"]))))
+        self.board = board if board is not None else {}
+        self.options = options or {}
+        self.platform = platform or FakePlatform()
+        self.depends = []
+        self.commands = []
+        self.libraries = []
+
+    def BoardConfig(self):
+        return self.board
+
+    def PioPlatform(self):
+        return self.platform
+
+    def GetProjectOption(self, name, default=None):
+        return self.options.get(name, default)
+
+    def subst(self, value):
+
+        def _expand(match):
+            items = self.Flatten(self.get(match.group(1), ""))
+            return " ".join(str(i) for i in items if not callable(i))
+
+        return re.sub(r"\$\{?(\w+)\}?", _expand, value)
+
+    def Flatten(self, value):
+        if not isinstance(value, (list, tuple)):
+            return [value]
+        return [i for item in value for i in self.Flatten(item)]
+
+    def AddMethod(self, function):
+        setattr(self, function.__name__,
+                lambda *args, **kwargs: function(self, *args, **kwargs))
+
+    def Replace(self, **kwargs):
+        self.update(kwargs)
+
+    def Append(self, **kwargs):
+        for name, value in kwargs.items():
+            self[name] = self.Flatten(self.get(name, [])) + self.Flatten(
+                value)
+
+    def ProcessUnFlags(self, flags):
+        for flag in flags or []:
+            for name, value in self.items():
+                if isinstance(value, list) and flag in value:
+                    value.remove(flag)
+
+    def File(self, path):
+        return FakeNode(path)
+
+    def Command(self, target, source, action):
+        self.commands.append((target, source))
+        return [FakeNode(target)]
+
+    def StaticLibrary(self, target, source):
+        self.libraries.append((target, source))
+        return [FakeNode(target)]
+
+    def VerboseAction(self, action, message):
+        return action
+
+    def Depends(self, target, dependency):
+        self.depends.append((target, dependency))
+
+    def AlwaysBuild(self, node):
+        pass
+
+
+@pytest.fixture
+def fake_env():
+    return FakeEnv
+
+
+@pytest.fixture
+def fake_node():
+    return FakeNode
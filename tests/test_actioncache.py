@@ -0,0 +1,133 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+
+import pytest
+
+from stm32tools import actioncache
+from stm32tools.actioncache import (DirectoryBackend, HTTPBackend,
+                                    PathNormalizer, pack, unpack)
+
+KEYS = ["%040x" % i for i in range(1, 33)]
+
+
+@pytest.fixture
+def server(tmpdir):
+    server = actioncache.serve(str(tmpdir.join("server")))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _get_url(server):
+    return "http://%s:%d" % server.server_address[:2]
+
+
+def test_http_round_trip(server):
+    backend = HTTPBackend(_get_url(server))
+    data = pack([("output", b"\x7fELF" + bytes(bytearray(range(256)))),
+                 ("depfile", "@BUILD_DIR@/main.o: main.c\n")])
+    assert backend.get(KEYS[0]) is None
+    backend.put(KEYS[0], data)
+    assert backend.get(KEYS[0]) == data
+    assert dict(unpack(backend.get(KEYS[0])))['output'].startswith(b"\x7fELF")
+    # a missed entry doesn't disable the server
+    assert backend.available
+
+
+def test_http_read_only(server):
+    HTTPBackend(_get_url(server), upload=False).put(KEYS[0], b"data")
+    assert HTTPBackend(_get_url(server)).get(KEYS[0]) is None
+
+
+def test_http_unavailable(capsys):
+    backend = HTTPBackend("http://127.0.0.1:1", timeout=1)
+    assert backend.get(KEYS[0]) is None
+    assert not backend.available
+    assert "is not available" in capsys.readouterr().out
+
+
+def _put_concurrently(backend):
+    def _put(keys):
+        for key in keys:
+            backend.put(key, key.encode() * 64)
+
+    threads = [threading.Thread(target=_put, args=(KEYS[i::4], ))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_concurrent_puts(tmpdir, server):
+    for backend in (DirectoryBackend(str(tmpdir.join("local"))),
+                    HTTPBackend(_get_url(server))):
+        _put_concurrently(backend)
+        for key in KEYS:
+            assert backend.get(key) == key.encode() * 64
+
+
+def _put_entries(backend, count, size=1024):
+    for index, key in enumerate(KEYS[:count]):
+        backend.put(key, b"x" * size)
+        path = backend._get_path(key)
+        os.utime(path, (1000 + index, 1000 + index))
+
+
+def test_lru_eviction(tmpdir):
+    backend = DirectoryBackend(str(tmpdir), max_size=8 * 1024)
+    _put_entries(backend, 10)
+    # the oldest entry is used again
+    assert backend.get(KEYS[0])
+
+    assert backend.evict() == 3
+    assert [key for key in KEYS[:10] if backend.get(key)] == (
+        [KEYS[0]] + KEYS[4:10])
+    assert backend._load_record()[0] == 7 * 1024
+
+
+def test_eviction_after_writes_only(tmpdir):
+    backend = DirectoryBackend(str(tmpdir), max_size=8 * 1024)
+    assert backend.evict() == 0
+    assert backend._load_record() is None
+
+    _put_entries(backend, 4)
+    assert backend.evict() == 0
+    assert backend._load_record()[0] == 4 * 1024
+
+    # the record is below the limit, the directory isn't walked (two
+    # entries are replaced)
+    _put_entries(backend, 2)
+    assert backend.evict() == 0
+    assert backend._load_record()[0] == 6 * 1024
+
+    # the record exceeds the limit, the directory is counted again
+    backend.put(KEYS[10], b"x" * 3 * 1024)
+    assert backend.evict() == 0
+    assert backend._load_record()[0] == 7 * 1024
+
+
+def test_normalizer_root_home():
+    normalizer = PathNormalizer([("PROJECT_DIR", "/work/blink"),
+                                 ("HOME", "/"), ("PACKAGES_DIR", None)])
+    text = "-I/work/blink/include -I/usr/include"
+    assert normalizer.normalize(text) == (
+        "-I@PROJECT_DIR@/include -I/usr/include")
+    assert normalizer.restore(normalizer.normalize(text)) == text
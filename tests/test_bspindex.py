@@ -0,0 +1,35 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from stm32tools import bspindex
+
+
+def test_components_of_shared_headers(tmpdir):
+    components = tmpdir.join("Components")
+    components.join("Common", "audio.h").write("", ensure=True)
+    components.join("cs43l22", "cs43l22.h").write(
+        "#include \"../Common/audio.h\"\n", ensure=True)
+    components.join("wm8994", "wm8994.h").write(
+        "#include \"../Common/audio.h\"\n", ensure=True)
+    # both codecs ship a header of the same name
+    components.join("cs43l22", "codec.h").write("", ensure=True)
+    components.join("wm8994", "codec.h").write("", ensure=True)
+    components.join("lsm6ds0", "lsm6ds0.h").write("", ensure=True)
+
+    index = bspindex.build_index(str(components))
+    assert bspindex.resolve_components(index, ["cs43l22.h"]) == [
+        "Common", "cs43l22"]
+    assert bspindex.resolve_components(index, ["codec.h"]) == [
+        "Common", "cs43l22", "wm8994"]
+    assert bspindex.resolve_components(index, ["stdint.h"]) == []
@@ -0,0 +1,116 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import json
+import sys
+import types
+
+import pytest
+
+from stm32tools import buildtrace
+
+
+@pytest.fixture
+def scons(monkeypatch):
+    # a stand-in of SCons modules which "install()" patches and reads
+
+    class _ActionAction(object):
+
+        def __init__(self, error=None):
+            self.error = error
+
+        def __call__(self, target, source, env):
+            if self.error:
+                raise self.error
+            return 0
+
+    action = types.ModuleType("SCons.Action")
+    action._ActionAction = _ActionAction
+    script = types.ModuleType("SCons.Script")
+    script.GetOption = lambda name: 4
+    package = types.ModuleType("SCons")
+    package.Action = action
+    package.Script = script
+    for name, module in (("SCons", package), ("SCons.Action", action),
+                         ("SCons.Script", script)):
+        monkeypatch.setitem(sys.modules, name, module)
+
+    monkeypatch.setattr(buildtrace, "_events", [])
+    monkeypatch.setattr(buildtrace, "_threads", {})
+    monkeypatch.setattr(buildtrace, "_state", dict(buildtrace._state))
+    buildtrace._state.update(enabled=False, registered=False)
+    return _ActionAction
+
+
+def test_trace_actions(tmpdir, monkeypatch, capsys, scons, fake_env,
+                       fake_node):
+    finish = []
+    monkeypatch.setattr(atexit, "register", finish.append)
+    env = fake_env({"build.trace": "yes", "build.trace_top": 2},
+                   BUILD_DIR=str(tmpdir))
+    buildtrace.install(env)
+    # the second install (another script of the build) changes nothing
+    buildtrace._state['enabled'] = False
+    buildtrace.install(env)
+    assert len(finish) == 1
+
+    obj = tmpdir.join("FrameworkHALDriver", "stm32f4xx_hal.o")
+    assert scons()([fake_node(str(obj))], [], env) == 0
+    with pytest.raises(OSError):
+        scons(OSError("arm-none-eabi-gcc not found"))(
+            [fake_node(str(tmpdir.join("src", "main.o")))], [], env)
+    scons()([fake_node(str(tmpdir.join("firmware.elf")))], [], env)
+    with buildtrace.span("LDF"):
+        pass
+
+    events = buildtrace._events
+    assert [(e['name'], e['cat']) for e in events] == [
+        ("stm32f4xx_hal.o", "FrameworkHALDriver"), ("main.o", "src"),
+        ("firmware.elf", "link"), ("LDF", "configure")]
+    assert events[0]['args'] == dict(
+        target="FrameworkHALDriver/stm32f4xx_hal.o")
+    assert all(e['dur'] >= 0 and e['ts'] >= 0 for e in events)
+
+    finish[0]()
+    with open(str(tmpdir.join("trace.json"))) as fp:
+        trace = json.load(fp)
+    assert trace['otherData'] == dict(jobs=4)
+    assert trace['traceEvents'][0] == dict(
+        name="thread_name", ph="M", pid=1, tid=1,
+        args=dict(name="worker 1"))
+    assert len(trace['traceEvents']) == 5
+    output = capsys.readouterr().out
+    assert "4 worker(s)" in output
+    for category in ("FrameworkHALDriver", "src", "link"):
+        assert category in output
+
+
+def test_summary():
+    events = [
+        dict(name="a.o", cat="src", ts=0, dur=2000000,
+             args=dict(target="src/a.o")),
+        dict(name="b.o", cat="src", ts=0, dur=1000000,
+             args=dict(target="src/b.o")),
+        dict(name="firmware.elf", cat="link", ts=2000000, dur=500000,
+             args=dict(target="firmware.elf")),
+        dict(name="LDF", cat="configure", ts=0, dur=300000, args={})
+    ]
+    summary = buildtrace.get_summary(events, 2, top=2)
+    assert summary['configure'] == 0.3
+    assert summary['wall'] == 2.5
+    assert summary['busy'] == 3.5
+    assert summary['categories'] == [("src", 2, 3.0), ("link", 1, 0.5)]
+    assert summary['units'] == [("src", "src/a.o", 2.0),
+                                ("src", "src/b.o", 1.0)]
@@ -0,0 +1,143 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from stm32tools import delta
+
+KB = 1024
+BASE = delta.FLASH_START
+
+
+def test_sectors_f4():
+    sectors = delta.get_sectors("stm32f407vgt6", 1024 * KB)
+    assert sectors[:6] == [
+        (BASE, 16 * KB), (BASE + 16 * KB, 16 * KB),
+        (BASE + 32 * KB, 16 * KB), (BASE + 48 * KB, 16 * KB),
+        (BASE + 64 * KB, 64 * KB), (BASE + 128 * KB, 128 * KB)]
+    assert sum(size for _, size in sectors) == 1024 * KB
+    assert delta.get_sectors("unknown", 1024 * KB) is None
+
+
+def test_merge_sectors():
+    assert delta.merge_sectors([]) == []
+    assert delta.merge_sectors([
+        (BASE + 2 * KB, KB), (BASE, KB), (BASE + KB, KB),
+        (BASE + 8 * KB, KB)]) == [(BASE, 3 * KB), (BASE + 8 * KB, KB)]
+
+
+def test_dirty_sectors():
+    sectors = delta.get_sectors("stm32f103c8", 64 * KB)
+    old = b"\x00" * (4 * KB)
+    assert delta.get_dirty_sectors(old, old, BASE, sectors) == []
+
+    new = bytearray(old)
+    new[KB + 10] = 1
+    new[3 * KB] = 1
+    assert delta.get_dirty_sectors(old, bytes(new), BASE, sectors) == [
+        (BASE + KB, KB), (BASE + 3 * KB, KB)]
+
+    # the tail of the last sector stays erased, a longer image which
+    # fills it with erased bytes doesn't need the sector again
+    old = b"\x00" * (KB + 100)
+    new = old + b"\xff" * 50
+    assert delta.get_dirty_sectors(old, new, BASE, sectors) == []
+    new = old + b"\x00" * 50
+    assert delta.get_dirty_sectors(old, new, BASE, sectors) == [
+        (BASE + KB, KB)]
+    # a sector past the old image
+    new = old + b"\x00" * KB
+    assert delta.get_dirty_sectors(old, new, BASE, sectors) == [
+        (BASE + KB, KB), (BASE + 2 * KB, KB)]
+
+
+def test_dirty_sectors_offset_image():
+    sectors = delta.get_sectors("stm32f103c8", 64 * KB)
+    address = BASE + KB + 512
+    old = b"\x00" * KB
+    new = b"\x00" * 600 + b"\x01" + b"\x00" * (KB - 601)
+    # the image starts in the middle of the second page
+    assert delta.get_dirty_sectors(old, new, address, sectors) == [
+        (BASE + 2 * KB, KB)]
+
+
+def test_plan_update():
+    sectors = delta.get_sectors("stm32f103c8", 64 * KB)
+    old = b"\x00" * (5 * KB)
+    new = bytearray(old)
+    new[KB] = 1
+    new[2 * KB + 1] = 2
+    new[4 * KB + 7] = 3
+    updates = delta.plan_update(old, bytes(new), BASE, sectors)
+    assert updates == [
+        (BASE + KB, bytes(new[KB:3 * KB])),
+        (BASE + 4 * KB, bytes(new[4 * KB:5 * KB]))]
+    assert delta.plan_update(old, old, BASE, sectors) == []
+
+    # the last range ends with the image
+    new = old + b"\x05" * 100
+    assert delta.plan_update(old, new, BASE, sectors) == [
+        (BASE + 5 * KB, b"\x05" * 100)]
+
+
+def test_update_commands_verify_base():
+    commands = delta.get_openocd_commands(
+        [(BASE + KB, b"x")], ["chunk.bin"], "base.bin", "image.bin", BASE)
+    assert commands[:2] == ["init", "reset init"]
+    assert commands[-2:] == ["reset run", "shutdown"]
+    script = commands[2]
+    assert script.startswith(
+        "if {[catch {verify_image_checksum {base.bin} 0x08000000 bin}]}")
+    # a mismatch programs the whole image, the chunks otherwise
+    mismatch, match = script.split("} else {")
+    assert "flash write_image erase {image.bin} 0x08000000 bin" in mismatch
+    assert "chunk.bin" not in mismatch
+    assert "flash write_image erase {chunk.bin} 0x08000400 bin" in match
+    assert "verify_image {chunk.bin} 0x08000400 bin" in match
+
+
+def _write_image(tmpdir, data):
+    image = tmpdir.join("firmware.bin")
+    image.write_binary(data)
+    tmpdir.join("firmware.segments.json").write(
+        '{"images": [{"file": "firmware.bin", "address": %d}]}' % BASE)
+    return str(image)
+
+
+def test_upload_checks_recorded_image(tmpdir, fake_env):
+    env = fake_env({"build.mcu": "stm32f103c8t6",
+                    "upload.maximum_size": 64 * KB}, BUILD_DIR=str(tmpdir))
+    calls = []
+
+    def _execute(env, commands, message):
+        calls.append(commands)
+        return None
+
+    image = _write_image(tmpdir, b"\x00" * (2 * KB))
+    assert delta.upload(env, image, "stlink", [], _execute) is None
+    assert calls[-1][0].startswith("program {%s}" % image)
+
+    image = _write_image(tmpdir, b"\x00" * KB + b"\x01" * KB)
+    assert delta.upload(env, image, "stlink", [], _execute) is None
+    script = calls[-1][2]
+    assert script.startswith("if {[catch {verify_image_checksum {%s.base}" %
+                             image)
+    # temporary files are removed, the new image is recorded
+    assert not tmpdir.join("firmware.bin.base").check()
+    assert delta.load_state(
+        env, delta.get_probe_id(env, "stlink"), "stm32f103c8t6",
+        BASE) == b"\x00" * KB + b"\x01" * KB
+
+    # a failed run drops the record, the next upload programs everything
+    assert delta.upload(env, image, "stlink", [], lambda *a: 1) == 1
+    delta.upload(env, image, "stlink", [], _execute)
+    assert calls[-1][0].startswith("program {")
@@ -0,0 +1,58 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+
+from stm32tools import identical, openocd
+
+
+def test_image_offset(tmpdir, fake_env):
+    image = tmpdir.join("firmware.bin")
+    image.write_binary(b"\x00" * 16)
+    assert identical.get_image_offset(fake_env(), str(image)) == "0x08000000"
+
+    tmpdir.join("firmware.segments.json").write(
+        '{"images": [{"file": "firmware.bin", "address": 134250496}]}')
+    assert identical.get_image_offset(fake_env(), str(image)) == "0x08008000"
+    assert identical.get_image_offset(
+        fake_env({"upload.offset_address": "0x08004000"}),
+        str(image)) == "0x08004000"
+    assert identical.get_image_offset(
+        fake_env(), str(tmpdir.join("firmware.elf"))) == ""
+
+
+def test_openocd_check_at_offset(monkeypatch, fake_env):
+    calls = []
+    monkeypatch.setattr(identical, "_run", lambda env, args: (
+        calls.append(args) or (0, "")))
+    assert identical.openocd_image_matches(
+        fake_env(UPLOADER="openocd"), ["-f", "board.cfg"], "firmware.bin",
+        "0x08008000")
+    assert calls[0][:3] == ["openocd", "-f", "board.cfg"]
+    assert "verify_image_checksum {firmware.bin} 0x08008000" in calls[0]
+
+
+def test_upload_when_check_fails(fake_env):
+    uploads = []
+
+    def _matches(target, source, env):
+        raise errors.pop(0)
+
+    errors = [openocd.OpenOCDError("Probe is busy"), socket.error(111)]
+    action = identical.wrap_upload_action(
+        fake_env(), lambda target, source, env: uploads.append(source),
+        _matches)
+    for _ in range(2):
+        action(None, ["firmware.bin"], None)
+    assert uploads == [["firmware.bin"], ["firmware.bin"]]
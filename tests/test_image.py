@@ -0,0 +1,48 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from stm32tools import image
+
+
+def test_group_chunks():
+    chunks = [(0x08000000, b"a" * 16), (0x08000020, b"b" * 4),
+              (0x1FFFC000, b"c" * 8)]
+    groups = image.group_chunks(chunks, 0x100)
+    assert [len(g) for g in groups] == [2, 1]
+    assert image.get_main_group(groups, 0x08000000) is groups[0]
+    assert image.build_binary(groups[0]) == (
+        b"a" * 16 + image.PADDING_BYTE * 16 + b"b" * 4)
+
+
+def _write_manifest(tmpdir, files):
+    tmpdir.join("firmware.segments.json").write(json.dumps(dict(
+        images=[dict(file=f, address=0) for f in files])))
+    return str(tmpdir.join("firmware.bin"))
+
+
+def test_upload_of_split_images_fails(tmpdir, capsys, fake_node):
+    source = [fake_node(_write_manifest(tmpdir, ["firmware.bin"]))]
+    assert image.CheckSplitImages(None, source, None) is None
+
+    source = [fake_node(_write_manifest(
+        tmpdir, ["firmware.bin", "firmware_0x1fffc000.bin"]))]
+    assert image.CheckSplitImages(None, source, None) == 1
+    assert "firmware_0x1fffc000.bin" in capsys.readouterr().err
+
+
+def test_side_images():
+    assert image.get_side_images("/build/firmware.bin") == [
+        "/build/firmware.hex", "/build/firmware.segments.json"]
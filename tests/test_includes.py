@@ -0,0 +1,74 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os.path import join
+
+from stm32tools import includes, libindex
+
+
+def _get_env(fake_env, root, options):
+    return fake_env(
+        options=options, PROJECT_DIR=root,
+        PROJECT_SRC_DIR=join(root, "src"),
+        PROJECT_INCLUDE_DIR=join(root, "include"),
+        PROJECT_TEST_DIR=join(root, "test"),
+        PROJECT_LIB_DIR=join(root, "lib"),
+        PROJECT_LIBDEPS_DIR=join(root, ".pio", "libdeps"),
+        PIOENV="bluepill", BUILD_DIR=join(root, "build"))
+
+
+def test_project_includes_of_library_storages(tmpdir, fake_env):
+    tmpdir.join("src", "main.cpp").write("#include <Arduino.h>\n",
+                                         ensure=True)
+    tmpdir.join("test", "test_main.cpp").write("#include <unity.h>\n",
+                                               ensure=True)
+    tmpdir.join("extra", "Sensor", "Sensor.cpp").write(
+        "#include <Wire.h>\n", ensure=True)
+    tmpdir.join(".pio", "libdeps", "bluepill", "Display", "Display.h").write(
+        "#include <SPI.h>\n", ensure=True)
+    tmpdir.join("global", "Servo", "Servo.cpp").write(
+        "#include <Servo.h>\n", ensure=True)
+    tmpdir.join("packages", "framework", "libraries", "EEPROM",
+                "EEPROM.cpp").write("#include <EEPROM.h>\n", ensure=True)
+    env = _get_env(fake_env, str(tmpdir), {"lib_extra_dirs": ["extra"]})
+    result = includes.get_project_includes(env)
+    # the global storage and storages of framework packages aren't a
+    # part of the project
+    assert result == set(["Arduino.h", "unity.h", "Wire.h", "SPI.h"])
+
+    framework = tmpdir.join("framework")
+    framework.join("Wire", "src", "Wire.h").write(
+        "#include <Arduino.h>\n", ensure=True)
+    framework.join("SPI", "src", "SPI.h").write("", ensure=True)
+    index = libindex.build_index([str(framework)])
+    assert libindex.resolve_libraries(index, result) == [
+        str(framework.join("SPI")), str(framework.join("Wire"))]
+
+
+def test_required_libraries(tmpdir, fake_env):
+    assert [libindex.parse_lib_dep(spec) for spec in [
+        "SPI", "SPI@1.0", "Servo @ ^1.1.2", "arduino-libraries/Ethernet",
+        "bblanchon/ArduinoJson@~6.15", "Wire=https://github.com/x/y.git",
+        "https://github.com/owner/OneWire.git#v2.3.5",
+        "git@github.com:owner/RTCZero.git", "64", "id=64"
+    ]] == ["SPI", "SPI", "Servo", "Ethernet", "ArduinoJson", "Wire",
+           "OneWire", "RTCZero", None, None]
+
+    framework = tmpdir.join("framework")
+    for name in ("SPI", "Servo", "Wire", "EEPROM"):
+        framework.ensure_dir(name)
+    env = _get_env(fake_env, str(tmpdir), {"lib_deps": [
+        "SPI@1.0", "arduino-libraries/Servo", "wire", "Ethernet"]})
+    assert libindex.get_required_libraries(env, [str(framework)]) == [
+        str(framework.join(name)) for name in ("SPI", "Servo", "Wire")]
@@ -0,0 +1,54 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from stm32tools import ldscripts
+
+
+def test_default_ldscript(tmpdir, fake_env):
+    ldscripts_dir = tmpdir.mkdir("ldscripts")
+    template = ldscripts_dir.mkdir("tpl").join("linker.tpl")
+    template.write("_estack = $stack; RAM $ram; FLASH $flash;\n")
+    env = fake_env({"upload.maximum_ram_size": 20480,
+                    "upload.maximum_size": 65536,
+                    "build.cache_dir": str(tmpdir.join("cache"))})
+
+    ldscript = ldscripts.generate_default_ldscript(
+        env, str(template), "STM32F103C8_DEFAULT.ld")
+    assert ldscript.startswith(str(tmpdir.join("cache", "ldscripts")))
+    with open(ldscript) as fp:
+        assert fp.read() == "_estack = 0x20005000; RAM 20K; FLASH 64K;\n"
+
+    # the packaged script of the framework
+    ldscripts_dir.join("STM32F103C8_DEFAULT.ld").write("/* packaged */\n")
+    assert ldscripts.generate_default_ldscript(
+        env, str(template), "STM32F103C8_DEFAULT.ld") == str(
+            ldscripts_dir.join("STM32F103C8_DEFAULT.ld"))
+
+
+def test_included_files(tmpdir, fake_env):
+    include_dir = tmpdir.mkdir("include")
+    lib_dir = tmpdir.mkdir("lib")
+    include_dir.join("memory.h").write("#define FLASH_SIZE 64K\n")
+    lib_dir.join("sections.ld").write('INCLUDE "common.ld"\n')
+    lib_dir.join("common.ld").write("/* INCLUDE missing.ld */\n")
+    tmpdir.join("local.ld").write("_estack = 0x20005000;\n")
+    script = tmpdir.join("script.ld")
+    script.write("\n".join([
+        '#include "memory.h"', "#include <local.ld>",
+        "INCLUDE sections.ld", "INCLUDE unknown.ld"]))
+
+    env = fake_env(CPPPATH=[str(include_dir)], LIBPATH=[str(lib_dir)])
+    assert ldscripts.get_included_files(env, str(script)) == [
+        str(include_dir.join("memory.h")), str(tmpdir.join("local.ld")),
+        str(lib_dir.join("sections.ld")), str(lib_dir.join("common.ld"))]
@@ -0,0 +1,78 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from stm32tools import libcache
+
+
+def _get_env(fake_env, cache_dir):
+    env = fake_env(
+        {"build.framework_cache": "yes", "build.cache_dir": cache_dir,
+         "build.mcu": "stm32f103c8t6"},
+        BUILD_DIR="/build", LIBPREFIX="lib", LIBSUFFIX=".a", CCFLAGS=["-Os"])
+    env.CollectBuildFiles = lambda variant_dir, src_dir, src_filter: [
+        env.File(variant_dir + "/main.o")]
+    return env
+
+
+def _get_entry(env, src_dir):
+    return libcache._get_entry_dir(
+        env, libcache.get_cache_key(env, str(src_dir)))
+
+
+def test_debug_flags_after_framework(tmpdir, fake_env):
+    src_dir = tmpdir.mkdir("hal")
+    src_dir.join("hal.c").write("int hal;\n")
+    cache_dir = str(tmpdir.join("cache"))
+
+    # a release build has stored its archive
+    release = _get_env(fake_env, cache_dir)
+    entry_dir = _get_entry(release, src_dir)
+    libcache._store_entry(entry_dir, [(str(src_dir.join("hal.c")),
+                                       "libFrameworkHAL.a")], "library")
+
+    env = libcache.generate(_get_env(fake_env, cache_dir))
+    lib = env.BuildFrameworkLibrary("$BUILD_DIR/FrameworkHAL",
+                                    str(src_dir))
+    assert lib.abspath == "/build/libFrameworkHAL.a"
+    # "ConfigureDebugFlags" runs after framework scripts
+    env['CCFLAGS'] = ["-Og", "-g3"]
+    env['BUILD_UNFLAGS'] = ["-g3"]
+    env['BUILDERS']['Program'].emitter(["firmware.elf"], [], env)
+    # compiled with the final flags and stored as another entry
+    assert env.libraries[0][0] == "/build/libFrameworkHAL.a"
+    assert env['CCFLAGS'] == ["-Og"]
+    assert _get_entry(env, src_dir) != entry_dir
+
+    env = libcache.generate(_get_env(fake_env, cache_dir))
+    env.BuildFrameworkLibrary("$BUILD_DIR/FrameworkHAL", str(src_dir))
+    env['BUILDERS']['Program'].emitter(["firmware.elf"], [], env)
+    assert not env.libraries
+    assert env.commands == [("/build/libFrameworkHAL.a",
+                             os.path.join(entry_dir, "libFrameworkHAL.a"))]
+
+
+def test_sources_added_to_program(tmpdir, monkeypatch, fake_env):
+    monkeypatch.setattr(libcache.unity, "build_objects",
+                        lambda env, variant_dir, src_dir, src_filter: [
+                            env.File(variant_dir + "/main.o")])
+    env = libcache.generate(_get_env(fake_env, str(tmpdir.join("cache"))))
+    assert env.BuildFrameworkSources("$BUILD_DIR/FrameworkArduino",
+                                     str(tmpdir.mkdir("core"))) == []
+    target, source = env['BUILDERS']['Program'].emitter(
+        ["firmware.elf"], ["src/main.o"], env)
+    assert source[0] == "src/main.o"
+    assert [n.abspath for n in source[1:]] == [
+        "$BUILD_DIR/FrameworkArduino/main.o"]
@@ -0,0 +1,47 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import time
+
+from stm32tools.matrix import _load_size
+
+
+def _write_size(build_dir, mtime):
+    env_dir = build_dir.mkdir("nucleo_f401re")
+    size_path = env_dir.join("size.json")
+    size_path.write(json.dumps(dict(program_size=1024, data_size=256)))
+    os.utime(str(size_path), (mtime, mtime))
+
+
+def test_load_size(tmpdir):
+    started = time.time()
+    result = dict(env="nucleo_f401re", returncode=0, started=started)
+    assert _load_size(str(tmpdir), result) is None
+
+    # an up to date firmware keeps the size of the previous build
+    _write_size(tmpdir, started - 60)
+    assert _load_size(str(tmpdir), result) == dict(program=1024, data=256)
+
+
+def test_load_size_of_failed_build(tmpdir):
+    started = time.time()
+    result = dict(env="nucleo_f401re", returncode=1, started=started)
+    _write_size(tmpdir, started - 60)
+    assert _load_size(str(tmpdir), result) is None
+
+    # the firmware was linked, a later step failed
+    os.utime(str(tmpdir.join("nucleo_f401re", "size.json")), None)
+    assert _load_size(str(tmpdir), result) == dict(program=1024, data=256)
@@ -0,0 +1,78 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from stm32tools import mcuindex
+
+
+def _get_env(fake_env, tmpdir):
+    env = fake_env({"build.cache_dir": str(tmpdir.join("cache"))})
+    env.PioPlatform().platform_dir = str(tmpdir)
+    return env
+
+
+def test_match_part_number():
+    names = ["startup_stm32f407xx.s", "startup_stm32f407vg.s",
+             "startup_stm32f417xx.s"]
+    assert mcuindex.match_part_number(
+        "stm32f407vgt6", names, "startup_", (".s", )) == (
+            "startup_stm32f407vg.s")
+    assert mcuindex.match_part_number(
+        "stm32f407zet6", names, "startup_", (".s", )) == (
+            "startup_stm32f407xx.s")
+    assert mcuindex.match_part_number(
+        "stm32f103c8t6", names, "startup_", (".s", )) is None
+
+
+def _add_board(tmpdir, name, mcu, frameworks=("spl", )):
+    tmpdir.ensure_dir("boards").join(name + ".json").write(json.dumps(
+        dict(build=dict(mcu=mcu), frameworks=list(frameworks))))
+
+
+def test_board_index(tmpdir, capsys, fake_env):
+    _add_board(tmpdir, "bluepill", "stm32f103c8t6")
+    _add_board(tmpdir, "l152", "stm32l152ret6")
+    _add_board(tmpdir, "nucleo_f401re", "stm32f401ret6", ("stm32cube", ))
+    env = _get_env(fake_env, tmpdir)
+    calls = []
+
+    def _resolve(mcu):
+        calls.append(mcu)
+        return None if mcu.startswith("stm32l") else mcu.upper() + ".ld"
+
+    # MCUs of the framework boards are resolved up front
+    index = mcuindex.load_index(env, "framework-spl", dict(ldscript=_resolve),
+                                framework="spl", required=("ldscript", ))
+    assert calls == ["stm32f103c8", "stm32l152re"]
+    assert "cannot resolve ldscript for stm32l152re" in capsys.readouterr().out
+    assert index.get("stm32f103c8t6", "ldscript") == "STM32F103C8.ld"
+    assert index.get("stm32l152re", "ldscript") is None
+
+    # a custom board falls back to the lazy resolution
+    assert index.get("stm32f407vgt6", "ldscript") == "STM32F407VG.ld"
+    assert calls == ["stm32f103c8", "stm32l152re", "stm32f407vg"]
+
+    # the next build reads the index
+    index = mcuindex.load_index(env, "framework-spl", dict(ldscript=_resolve),
+                                framework="spl", required=("ldscript", ))
+    assert index.get("stm32f407vgt6", "ldscript") == "STM32F407VG.ld"
+    assert len(calls) == 3
+    assert not capsys.readouterr().out
+
+    # a new board manifest leads to a new index
+    _add_board(tmpdir, "disco_f051r8", "stm32f051r8t6")
+    mcuindex.load_index(env, "framework-spl", dict(ldscript=_resolve),
+                        framework="spl", required=("ldscript", ))
+    assert "stm32f051r8" in calls
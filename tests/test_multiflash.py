@@ -0,0 +1,88 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import sys
+import time
+
+from stm32tools import multiflash
+
+# an uploader which takes the target and the image, target "FAIL" fails
+FAKE_UPLOADER = r'''
+import sys, time
+target, image = sys.argv[1:3]
+time.sleep(0.2)
+print("Programming %s with %s" % (target, image))
+sys.exit(1 if target == "FAIL" else 0)
+'''
+
+
+def _get_image(tmpdir):
+    image = tmpdir.join("firmware.bin")
+    image.write_binary(b"\x01\x02\x03\x04")
+    return str(image)
+
+
+def test_jobs(fake_env):
+    targets = ["A", "B", "C"]
+    assert multiflash.get_jobs(
+        fake_env(UPLOAD_PROTOCOL="stlink"), targets) == 3
+    assert multiflash.get_jobs(fake_env(
+        {"upload.parallel_jobs": "2"}, UPLOAD_PROTOCOL="stlink"),
+        targets) == 2
+    assert multiflash.get_jobs(fake_env(UPLOAD_PROTOCOL="dfu"), targets) == 1
+
+
+def test_run_uploaders(tmpdir):
+    uploader = tmpdir.join("uploader.py")
+    uploader.write(FAKE_UPLOADER)
+    image = _get_image(tmpdir)
+    log_dir = str(tmpdir.join("logs"))
+    report_path = str(tmpdir.join("report.json"))
+
+    started = time.time()
+    report = multiflash.run(
+        [(t, [sys.executable, str(uploader), t, image])
+         for t in ("066DFF", "FAIL", "0670FF")],
+        3, image, log_dir, report_path)
+    # the uploads run at the same time
+    assert time.time() - started < 0.6
+    assert [r['status'] for r in report['targets']] == [
+        "success", "failed", "success"]
+    assert report['crc32'] == "0x%08x" % multiflash.crc32(
+        b"\x01\x02\x03\x04")
+    with open(report_path) as fp:
+        assert json.load(fp)['failed'] == 1
+    with open(report['targets'][0]['log']) as fp:
+        assert "Programming 066DFF with %s" % image in fp.read()
+
+
+def test_function_output_goes_to_log(tmpdir, capsys):
+    image = _get_image(tmpdir)
+
+    def _upload(target):
+        print("Writing to %s" % target)
+        sys.stderr.write("Error: %s is busy\n" % target)
+        return 1 if target == "COM4" else None
+
+    report = multiflash.run(
+        [(t, _upload) for t in ("COM3", "COM4")], 2, image,
+        str(tmpdir.join("logs")), str(tmpdir.join("report.json")))
+    captured = capsys.readouterr()
+    assert "COM3" not in captured.out + captured.err
+    assert [r['status'] for r in report['targets']] == ["success", "failed"]
+    for result in report['targets']:
+        with open(result['log']) as fp:
+            assert fp.read() == "Writing to %s\nError: %s is busy\n" % (
+                result['target'], result['target'])
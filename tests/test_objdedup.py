@@ -0,0 +1,45 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+
+from stm32tools import objdedup
+
+KEY = "ab" * 20
+
+
+def test_reuse_object(tmpdir, monkeypatch, fake_env):
+    calls = []
+
+    def _spawn(sh, escape, cmd, args, spawn_env):
+        calls.append(args)
+        with open(args[-1], "wb") as fp:
+            fp.write(b"\x7fELF object")
+        return 0
+
+    monkeypatch.setattr(atexit, "register", lambda func: func)
+    monkeypatch.setattr(objdedup, "get_key", lambda argv, command, environ: (
+        KEY if "main.c" in argv else None))
+    env = objdedup.generate(fake_env(
+        {"build.object_dedup": "yes",
+         "build.cache_dir": str(tmpdir.join("cache"))}, SPAWN=_spawn))
+
+    outputs = [str(tmpdir.join("%s.o" % name)) for name in ("a", "b")]
+    for output in outputs:
+        assert env['SPAWN'](None, None, "arm-none-eabi-gcc", [
+            "arm-none-eabi-gcc", "-c", "main.c", "-o", output], {}) == 0
+    assert len(calls) == 1
+    with open(outputs[1], "rb") as fp:
+        assert fp.read() == b"\x7fELF object"
+    assert tmpdir.join("cache", "objects", KEY[:2], KEY).check()
@@ -0,0 +1,198 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import signal
+import socket
+import sys
+import time
+from os.path import isfile, join
+
+import pytest
+
+from stm32tools import ocdsession
+from stm32tools.helpers import get_platform_cache_dir
+from stm32tools.openocd import get_server_args, is_server_running
+
+pytestmark = pytest.mark.skipif(os.name == "nt", reason="uses signals")
+
+# OpenOCD with a TCL server which answers every command and exits on
+# "shutdown", the GDB port only accepts connections
+FAKE_OPENOCD = r'''
+import os, re, socket, sys, threading
+
+ports = dict(re.match(r"(\w+) (\S+)$", a).groups()
+             for a in sys.argv[1:] if re.match(r"\w+_port ", a))
+
+
+def handle(conn):
+    data = b""
+    while True:
+        chunk = conn.recv(4096)
+        if not chunk:
+            return
+        data += chunk
+        while b"\x1a" in data:
+            command, data = data.split(b"\x1a", 1)
+            conn.sendall(b"0.10.0\x1a")
+            if b"shutdown" in command:
+                os._exit(0)
+
+
+def listen(port, handler):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("localhost", int(port)))
+    sock.listen(5)
+    while True:
+        conn, _ = sock.accept()
+        threading.Thread(target=handler, args=(conn, )).start()
+
+
+threading.Thread(target=listen, args=(
+    ports["gdb_port"], lambda conn: conn.recv(1))).start()
+sock = socket.socket()
+sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+sock.bind(("localhost", int(ports["tcl_port"])))
+sock.listen(5)
+while True:
+    conn, _ = sock.accept()
+    handle(conn)
+    conn.close()
+'''
+
+
+@pytest.fixture
+def openocd(tmpdir):
+    path = str(tmpdir.join("openocd.py"))
+    with open(path, "w") as fp:
+        fp.write(FAKE_OPENOCD)
+    return path
+
+
+def _wait_exit(pid, timeout=10):
+    # the supervisor is a child of the test process
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                return True
+        except OSError:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def _start(tmpdir, openocd, probe_id, idle_timeout=60):
+    state_path = str(tmpdir.join(probe_id + ".json"))
+    state = ocdsession.start_session(state_path, probe_id, sys.executable,
+                                     ["-u", openocd], idle_timeout)
+    return state_path, state
+
+
+def test_get_arg_port():
+    args = get_server_args("openocd", ["-f", "board.cfg"], 51000, 51001)
+    assert ocdsession.get_arg_port(args, "tcl_port") == 51000
+    assert ocdsession.get_arg_port(args, "gdb_port") == 51001
+    assert ocdsession.get_arg_port(["-f", "board.cfg"], "tcl_port") is None
+
+
+def test_has_clients():
+    server = socket.socket()
+    server.bind(("localhost", 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+    try:
+        assert not ocdsession.has_clients(port)
+        client = socket.create_connection(("localhost", port))
+        conn, _ = server.accept()
+        assert ocdsession.has_clients(port)
+        client.close()
+        conn.close()
+    finally:
+        server.close()
+
+
+def test_find_gdb_port(tmpdir):
+    sessions_dir = str(tmpdir)
+    assert ocdsession.find_gdb_port(sessions_dir, "stlink") == (
+        ocdsession.get_ports("stlink-default")[1])
+    for name, port, mtime in (("stlink-066DFF", 51101, 100),
+                              ("stlink-0670FF", 51201, 200),
+                              ("jlink-default", 51301, 300)):
+        path = join(sessions_dir, name + ".json")
+        with open(path, "w") as fp:
+            json.dump(dict(tcl_port=port - 1, gdb_port=port), fp)
+        os.utime(path, (mtime, mtime))
+    assert ocdsession.find_gdb_port(sessions_dir, "stlink") == 51201
+    assert ocdsession.find_gdb_port(sessions_dir, "jlink") == 51301
+
+
+def test_sessions_dir(tmpdir, fake_env):
+    # the builder and debug tools of "platform.py" see the same sessions
+    cache_dir = str(tmpdir.join("cache"))
+    env = fake_env({"build.cache_dir": cache_dir})
+    sessions_dir = ocdsession.get_sessions_dir(
+        get_platform_cache_dir("ststm32", cache_dir))
+    assert ocdsession.get_state_path(env, "stlink-066DFF") == join(
+        sessions_dir, "stlink-066DFF.json")
+
+
+def test_session_reuse_and_stop(tmpdir, openocd):
+    state_path, state = _start(tmpdir, openocd, "test-reuse")
+    assert ocdsession.is_healthy(state)
+    reused = ocdsession.ensure_session(
+        state_path, "test-reuse", sys.executable, ["-u", openocd])
+    assert reused['pid'] == state['pid']
+
+    ocdsession.stop_session(state_path)
+    assert _wait_exit(state['pid'])
+    assert not isfile(state_path)
+    assert not is_server_running(port=state['tcl_port'])
+
+
+def test_replaced_session(tmpdir, openocd):
+    state_path, state = _start(tmpdir, openocd, "test-replaced")
+    other_path, other = _start(tmpdir, openocd, "test-other")
+    try:
+        # the next session took over the state with its own ports
+        with open(state_path, "w") as fp:
+            json.dump(other, fp)
+        assert _wait_exit(state['pid'])
+        assert not is_server_running(port=state['tcl_port'])
+        assert ocdsession.is_healthy(other)
+    finally:
+        ocdsession.stop_session(other_path)
+        _wait_exit(other['pid'])
+
+
+def test_terminated_supervisor(tmpdir, openocd):
+    state_path, state = _start(tmpdir, openocd, "test-terminated")
+    os.kill(state['pid'], signal.SIGTERM)
+    assert _wait_exit(state['pid'])
+    assert not is_server_running(port=state['tcl_port'])
+    assert not isfile(state_path)
+
+
+def test_idle_session_with_client(tmpdir, openocd):
+    state_path, state = _start(tmpdir, openocd, "test-idle", idle_timeout=1)
+    gdb = socket.create_connection(("localhost", state['gdb_port']))
+    try:
+        time.sleep(3)
+        assert ocdsession.is_healthy(state)
+    finally:
+        gdb.close()
+    assert _wait_exit(state['pid'])
+    assert not is_server_running(port=state['tcl_port'])
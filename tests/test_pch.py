@@ -0,0 +1,72 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os.path import join
+
+from stm32tools import pch
+
+
+def test_first_include(tmpdir):
+    source = tmpdir.join("main.cpp")
+    source.write('/* header */\n// comment\n\n#include "Arduino.h"\n')
+    assert pch.get_first_include(str(source)) == "Arduino.h"
+    source = tmpdir.join("config.cpp")
+    source.write("#define USE_FULL_LL_DRIVER\n#include <Arduino.h>\n")
+    assert pch.get_first_include(str(source)) is None
+
+
+def test_include_only_for_project_sources(tmpdir, monkeypatch, fake_env,
+                                          fake_node):
+    build_dir = str(tmpdir.join("build"))
+    src_dir = tmpdir.mkdir("src")
+    src_dir.join("main.cpp").write("#include <Arduino.h>\n")
+    src_dir.join("other.cpp").write("#include <Wire.h>\n")
+    src_dir.join("main.c").write("#include <Arduino.h>\n")
+    monkeypatch.setattr(pch, "_add_pch", lambda env, lang: ["pch-" + lang])
+
+    env = fake_env({"build.pch": "yes"}, BUILD_DIR=build_dir, CXX="g++",
+                   CXXFLAGS=["-std=gnu++14"], CCFLAGS=["-Os"])
+    pch.configure(env, "/framework/cores/arduino/Arduino.h", ["c++"])
+    emitter = env['BUILDERS']['StaticObject'].emitter['.cpp']
+
+    def _compile(obj, source):
+        target, source = emitter([fake_node(obj)],
+                                 [fake_node(str(src_dir.join(source)))],
+                                 env)
+        return env['_PCH_FLAGS'](target, source, env, False)
+
+    flags = _compile(join(build_dir, "src", "main.o"), "main.cpp")
+    assert flags[:2] == ["-Winvalid-pch", "-include"]
+    assert flags[2].startswith(join(build_dir, "pch", ""))
+    assert flags[2].endswith(join("", "Arduino.h"))
+    assert env.depends[-1][1] == ["pch-c++"]
+    # another first include, a framework library, a C source
+    assert not _compile(join(build_dir, "src", "other.o"), "other.cpp")
+    assert not _compile(join(build_dir, "FrameworkArduino", "main.o"),
+                        "main.cpp")
+    assert not env['_PCH_FLAGS'](
+        [fake_node(join(build_dir, "src", "main.c.o"))],
+        [fake_node(str(src_dir.join("main.c")))], env, False)
+    assert len(env.depends) == 1
+
+    # the project sources with their own flags get another header
+    project_env = fake_env({"build.pch": "yes"})
+    project_env.update(env)
+    project_env['CCFLAGS'] = ["-Os", "-DPROJECT"]
+    target, source = emitter([fake_node(join(build_dir, "src", "app.o"))],
+                             [fake_node(str(src_dir.join("main.cpp")))],
+                             project_env)
+    project_flags = env['_PCH_FLAGS'](target, source, project_env, False)
+    assert project_flags[2] != flags[2]
+    assert project_flags[2] == pch.get_stub_path(project_env, "c++")
@@ -0,0 +1,144 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import socket
+import threading
+
+import pytest
+
+from stm32tools import regsnap, svd
+from stm32tools.openocd import COMMAND_TERMINATOR, TclClient
+
+SVD = """<?xml version="1.0" encoding="utf-8"?>
+<device>
+  <name>STM32F401</name>
+  <peripherals>
+    <peripheral>
+      <name>USART2</name>
+      <baseAddress>0x40004400</baseAddress>
+      <registers>
+        <register><name>SR</name><addressOffset>0x0</addressOffset>
+          <fields>
+            <field><name>TXE</name><bitOffset>7</bitOffset>
+              <bitWidth>1</bitWidth>
+              <enumeratedValues>
+                <enumeratedValue><name>Empty</name><value>1</value>
+                </enumeratedValue>
+              </enumeratedValues></field>
+          </fields></register>
+        <register><name>DR</name><addressOffset>0x4</addressOffset>
+        </register>
+        <register><name>BRR</name><addressOffset>0x8</addressOffset>
+        </register>
+        <register><name>KEYR</name><addressOffset>0xC</addressOffset>
+          <access>write-only</access></register>
+        <register><name>LOCK</name><addressOffset>0x10</addressOffset>
+          <access>writeOnce</access></register>
+      </registers>
+    </peripheral>
+  </peripherals>
+</device>
+"""
+
+
+class FakeTclServer(threading.Thread):
+    # OpenOCD TCL server with a memory map, "legacy" servers don't have
+    # "read_memory" (OpenOCD < 0.11)
+
+    def __init__(self, memory, legacy=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.memory = memory
+        self.legacy = legacy
+        self.commands = []
+        self.sock = socket.socket()
+        self.sock.bind(("localhost", 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+
+    def respond(self, command):
+        match = re.search(r"read_memory 0x([0-9a-f]+) 32 (\d+)", command)
+        if match:
+            if self.legacy:
+                return "error: invalid command name \"read_memory\""
+            address, count = int(match.group(1), 16), int(match.group(2))
+            return " ".join("0x%x" % self.memory.get(address + i * 4, 0)
+                            for i in range(count))
+        match = re.search(r"mem2array _pio_mem 32 0x([0-9a-f]+) (\d+)",
+                          command)
+        if match:
+            address, count = int(match.group(1), 16), int(match.group(2))
+            return " ".join("%d 0x%x" % (
+                i, self.memory.get(address + i * 4, 0))
+                for i in range(count))
+        return "0.11.0"
+
+    def run(self):
+        conn, _ = self.sock.accept()
+        data = b""
+        while True:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+            while COMMAND_TERMINATOR in data:
+                command, data = data.split(COMMAND_TERMINATOR, 1)
+                self.commands.append(command.decode())
+                conn.sendall(self.respond(command.decode()).encode() +
+                             COMMAND_TERMINATOR)
+        conn.close()
+        self.sock.close()
+
+
+MEMORY = {0x40004400: 0xC0, 0x40004404: 0x55, 0x40004408: 0x683,
+          0x4000440C: 0x12345678, 0x40004410: 0x1}
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_read_memory(legacy):
+    server = FakeTclServer(MEMORY, legacy)
+    server.start()
+    with TclClient(port=server.port) as client:
+        assert client.read_memory(0x40004400, 3) == [0xC0, 0x55, 0x683]
+    server.join(5)
+    assert any("mem2array" in c for c in server.commands) == legacy
+
+
+def test_is_readable():
+    assert regsnap.is_readable(dict(name="BRR", access="read-write"))
+    assert regsnap.is_readable(dict(name="LOCK", access="writeOnce"))
+    assert not regsnap.is_readable(dict(name="KEYR", access="write-only"))
+    assert not regsnap.is_readable(dict(name="DR", access="read-write"))
+
+
+def test_snapshot(tmpdir):
+    svd_path = tmpdir.join("STM32F401.svd")
+    svd_path.write(SVD)
+    store = svd.open_store(str(svd_path), str(tmpdir))
+    server = FakeTclServer(MEMORY)
+    server.start()
+    with TclClient(port=server.port) as client:
+        snapshot = regsnap.take_snapshot(client, store, ["USART2"])
+    server.join(5)
+
+    registers = snapshot['peripherals']['USART2']['registers']
+    assert sorted(registers) == ["BRR", "LOCK", "SR"]
+    assert registers['SR']['value'] == "0x000000c0"
+    assert registers['SR']['fields'] == {"TXE": "1 (Empty)"}
+    assert registers['LOCK']['value'] == "0x00000001"
+    # skipped DR and KEYR split the reads
+    assert snapshot['reads'] == 3
+    assert [c for c in server.commands if "read_memory" in c and (
+        "0x4000440c" in c or "0x40004404" in c)] == []
@@ -0,0 +1,203 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import select
+import struct
+import threading
+import time
+
+import pytest
+
+from stm32tools import stm32boot
+from stm32tools.delta import FLASH_START, get_sectors
+
+pytestmark = pytest.mark.skipif(os.name == "nt", reason="requires a PTY")
+
+
+class PtyPort(object):
+    # pySerial like end of a PTY, "baudrate" is only recorded
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.timeout = 1
+        self.baudrate = 0
+
+    def read(self, size):
+        data = b""
+        end = time.time() + self.timeout
+        while len(data) < size:
+            ready, _, _ = select.select(
+                [self.fd], [], [], max(0, end - time.time()))
+            if not ready:
+                break
+            data += os.read(self.fd, size - len(data))
+        return data
+
+    def write(self, data):
+        os.write(self.fd, data)
+
+    def reset_input_buffer(self):
+        while select.select([self.fd], [], [], 0)[0]:
+            os.read(self.fd, 4096)
+
+
+class FakeBootloader(threading.Thread):
+    # the ROM bootloader of STM32F4 with 64 KB of flash; it measures the
+    # baud rate on the first 0x7F and ignores the line at other rates
+
+    COMMANDS = [0x00, 0x02, 0x11, 0x21, 0x31, 0x44]
+
+    def __init__(self, fd, port, baudrate, checksum=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fd = fd
+        self.port = port
+        self.baudrate = baudrate
+        self.commands = self.COMMANDS + ([0xA1] if checksum else [])
+        self.flash = bytearray(b"\x00" * 65536)
+        self.erased = []
+        self.writes = 0
+        self.started = None
+
+    def _read(self, size):
+        data = b""
+        while len(data) < size:
+            data += os.read(self.fd, size - len(data))
+        return bytearray(data)
+
+    def _ack(self):
+        os.write(self.fd, b"\x79")
+
+    def _read_address(self):
+        data = self._read(5)
+        assert stm32boot._xor(data[:4]) == data[4]
+        return struct.unpack(">I", bytes(data[:4]))[0] - FLASH_START
+
+    def run(self):
+        while self._read(1)[0] != stm32boot.SYNC or (
+                self.port.baudrate != self.baudrate):
+            pass
+        self._ack()
+        while True:
+            data = self._read(2)
+            assert data[0] ^ data[1] == 0xFF
+            command = data[0]
+            self._ack()
+            if command == 0x00:
+                os.write(self.fd, bytes(bytearray(
+                    [len(self.commands), 0x31] + self.commands + [0x79])))
+            elif command == 0x02:
+                os.write(self.fd, b"\x01\x04\x13\x79")
+            elif command == 0x44:
+                count = struct.unpack(">H", bytes(self._read(2)))[0] + 1
+                pages = struct.unpack(
+                    ">%dH" % count, bytes(self._read(2 * count)))
+                self._read(1)
+                for page in pages:
+                    self.erased.append(page)
+                    self.flash[page * 16384:(page + 1) * 16384] = (
+                        b"\xff" * 16384)
+                self._ack()
+            elif command == 0x31:
+                address = self._read_address()
+                self._ack()
+                size = self._read(1)[0] + 1
+                data = self._read(size + 1)
+                assert stm32boot._xor(bytearray([size - 1]) + data) == 0
+                self.flash[address:address + size] = data[:size]
+                self.writes += 1
+                self._ack()
+            elif command == 0x11:
+                address = self._read_address()
+                self._ack()
+                size = self._read(2)[0] + 1
+                self._ack()
+                os.write(self.fd, bytes(self.flash[address:address + size]))
+            elif command == 0xA1:
+                address = self._read_address()
+                self._ack()
+                size = struct.unpack(">I", bytes(self._read(5)[:4]))[0]
+                self._ack()
+                self._read(5)
+                self._ack()
+                self._read(5)
+                self._ack()
+                self._ack()
+                os.write(self.fd, stm32boot._with_checksum(struct.pack(
+                    ">I", stm32boot.crc32_stm32(
+                        bytes(self.flash[address:address + size])))))
+            elif command == 0x21:
+                self.started = self._read_address()
+                self._ack()
+                return
+
+
+def _connect(baudrate=115200, checksum=True):
+    import pty
+    import tty
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    port = PtyPort(slave)
+    target = FakeBootloader(master, port, baudrate, checksum)
+    target.start()
+    return stm32boot.Bootloader(port), target
+
+
+@pytest.mark.parametrize("checksum", [True, False])
+def test_flash(checksum):
+    image = os.urandom(1000) + b"\xff" * 2000 + os.urandom(1001)
+    bootloader, target = _connect(checksum=checksum)
+    assert bootloader.synchronize() == 115200
+    stm32boot.flash(bootloader, image, FLASH_START,
+                    get_sectors("stm32f407vg", 65536))
+    target.join(2)
+    assert target.started == 0
+    # only the first sector is erased, blocks of 0xFF are skipped
+    assert target.erased == [0]
+    assert target.writes == 9
+    assert bytes(target.flash[:len(image)]) == image
+
+
+def test_synchronize_at_another_rate():
+    bootloader, _ = _connect(baudrate=57600)
+    with pytest.raises(stm32boot.BootloaderError):
+        bootloader.synchronize(115200)
+
+
+def test_crc():
+    # CRC unit of STM32 for the word 0x12345678
+    assert stm32boot.crc32_stm32(b"\x78\x56\x34\x12") == 0xdf8a8a2b
+    assert stm32boot.get_blocks(b"\xff" * 300 + b"\x00", 0, 256) == [
+        (256, b"\xff" * 44 + b"\x00")]
+
+
+def test_serial_upload_errors(tmpdir, capsys, fake_env, fake_node):
+    env = fake_env({"build.mcu": "stm32f103c8t6",
+                    "upload.maximum_size": 65536},
+                   UPLOAD_PORT="/dev/missing-port")
+    image = tmpdir.join("firmware.bin")
+    image.write_binary(b"\x00" * 16)
+    # no segment manifest next to the image
+    assert stm32boot.SerialUpload(
+        None, [fake_node(str(image))], env) == 1
+    assert capsys.readouterr().err.startswith("Error: ")
+
+    # missing port (or pySerial)
+    tmpdir.join("firmware.segments.json").write(
+        '{"images": [{"file": "firmware.bin", "address": %d}]}' % FLASH_START)
+    assert stm32boot.SerialUpload(
+        None, [fake_node(str(image))], env) == 1
+    assert capsys.readouterr().err.startswith("Error: ")
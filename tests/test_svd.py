@@ -0,0 +1,95 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os.path import isfile
+
+from stm32tools import svd
+
+SVD = """<?xml version="1.0" encoding="utf-8"?>
+<device>
+  <name>STM32F401</name>
+  <size>32</size>
+  <resetValue>0x00000000</resetValue>
+  <peripherals>
+    <peripheral>
+      <name>GPIOA</name>
+      <groupName>GPIO</groupName>
+      <baseAddress>0x40020000</baseAddress>
+      <registers>
+        <register>
+          <name>MODER</name>
+          <addressOffset>0x0</addressOffset>
+          <resetValue>0xA8000000</resetValue>
+          <fields>
+            <field><name>MODER1</name><bitOffset>2</bitOffset>
+              <bitWidth>2</bitWidth></field>
+            <field><name>MODER0</name><lsb>0</lsb><msb>1</msb></field>
+            <field><name>MODER2</name><bitRange>[5:4]</bitRange></field>
+            <field><name>BROKEN</name><description>no offset</description>
+            </field>
+          </fields>
+        </register>
+      </registers>
+    </peripheral>
+    <peripheral derivedFrom="GPIOA">
+      <name>GPIOB</name>
+      <baseAddress>0x40020400</baseAddress>
+    </peripheral>
+  </peripherals>
+</device>
+"""
+
+
+def test_store(tmpdir):
+    svd_path = tmpdir.join("STM32F401.svd")
+    svd_path.write(SVD)
+    store_dir = str(tmpdir.join("cache"))
+    store = svd.open_store(str(svd_path), store_dir)
+    assert isfile(svd.get_store_path(str(svd_path), store_dir))
+    assert store.device == "STM32F401"
+    assert store.get_peripheral_names() == ["GPIOA", "GPIOB"]
+    assert store.get_peripheral_info("GPIOB")['base_address'] == 0x40020400
+
+    register = store.get_register("GPIOB", "MODER")
+    assert register['reset_value'] == 0xA8000000
+    # the field without a position is skipped
+    assert [(f['name'], f['bit_offset'], f['bit_width'])
+            for f in register['fields']] == [
+                ("MODER0", 0, 2), ("MODER1", 2, 2), ("MODER2", 4, 2)]
+
+
+def test_store_of_previous_format(tmpdir):
+    svd_path = tmpdir.join("STM32F401.svd")
+    svd_path.write(SVD)
+    store_path = svd.get_store_path(str(svd_path), str(tmpdir))
+    with open(store_path, "wb") as fp:
+        fp.write(b"SVDB\x01" + b"\x00" * 8)
+    # rebuilt by the format
+    assert svd.open_store(str(svd_path), str(tmpdir)).device == "STM32F401"
+
+
+def test_updated_svd(tmpdir):
+    svd_path = tmpdir.join("STM32F401.svd")
+    svd_path.write(SVD)
+    store_dir = str(tmpdir.join("cache"))
+    store_path = svd.get_store_path(str(svd_path), store_dir)
+    assert svd.open_store(str(svd_path), store_dir).device == "STM32F401"
+
+    # the same modification time, another size
+    mtime = svd_path.mtime()
+    svd_path.write(SVD.replace("STM32F401", "STM32F401xE"))
+    svd_path.setmtime(mtime)
+    assert svd.get_store_path(str(svd_path), store_dir) != store_path
+    assert svd.open_store(str(svd_path), store_dir).device == "STM32F401xE"
+    assert not isfile(store_path)
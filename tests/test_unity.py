@@ -0,0 +1,65 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from stm32tools import unity
+
+
+def test_scan_source(tmpdir):
+    source = tmpdir.join("wiring_digital.c")
+    source.write("#include \"Arduino.h\"\n"
+                 "#define PIN_MASK 0xff\n"
+                 "static int last_pin;\n"
+                 "void digitalWrite(int pin, int value) { last_pin = pin; }\n")
+    info = unity.scan_source(str(source))
+    assert info['local'] == {"PIN_MASK", "last_pin"}
+    assert info['macros'] == ["PIN_MASK"]
+    assert "digitalWrite" in info['tokens']
+
+    # a macro before the last include changes the header
+    source.write("#define ARDUINO_MAIN\n#include \"Arduino.h\"\n")
+    assert unity.scan_source(str(source)) is None
+
+
+def test_make_batches():
+    a = dict(local={"buffer"}, macros=[], tokens={"buffer", "read"})
+    b = dict(local=set(), macros=[], tokens={"buffer", "write"})
+    c = dict(local=set(), macros=[], tokens={"write"})
+    batches = unity.make_batches([("a", a), ("b", b), ("c", c)], 16)
+    assert [[n for n, _ in batch] for batch in batches] == [
+        ["a", "c"], ["b"]]
+
+
+def test_scan_cache(tmpdir, monkeypatch):
+    paths = []
+    for name in ("HardwareSerial.c", "main_alone.c"):
+        source = tmpdir.join(name)
+        source.write("#pragma once\n" if "alone" in name else
+                     "static int rx_head;\n")
+        paths.append(str(source))
+    cache_path = str(tmpdir.join("scan.json"))
+    infos = unity.scan_sources(paths, cache_path)
+    assert infos[paths[0]]['local'] == {"rx_head"}
+    assert infos[paths[1]] is None
+
+    calls = []
+    scan_source = unity.scan_source
+    monkeypatch.setattr(unity, "scan_source", lambda path: (
+        calls.append(path) or scan_source(path)))
+    assert unity.scan_sources(paths, cache_path) == infos
+    assert calls == []
+
+    tmpdir.join("HardwareSerial.c").write("static char rx_buffer[64];\n")
+    assert unity.scan_sources(paths, cache_path)[paths[0]]['local'] == {
+        "rx_buffer"}
+    assert calls == [paths[0]]